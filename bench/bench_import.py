@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+""" Report cold-start latency of the aicli entry points. For every entry point the script runs a
+fresh interpreter with `-X importtime`, sums up the top-level import times, lists the slowest
+modules and checks which of the heavy provider SDKs were loaded. The wall-clock time of the whole
+command is measured separately, without `-X importtime`. """
+
+import argparse
+import sys
+from os import environ
+from os.path import join, dirname, abspath
+from statistics import median
+from subprocess import run, PIPE, DEVNULL
+from time import perf_counter
+
+ROOT = dirname(dirname(abspath(__file__)))
+PYDIR = join(ROOT, 'python')
+HEAVY = ['openai', 'gpt4all', 'PIL', 'requests', 'httpx']
+
+# Entry point name -> Python code to run in a fresh interpreter
+ENTRY_POINTS = {
+  'import sm_aicli': "import sm_aicli",
+  'import sm_aicli.main': "import sm_aicli.main",
+  'aicli --version': "from sm_aicli.main import main; main(['--version'])",
+  'aicli dummy session': ("from sm_aicli.main import main; "
+                          "main(['--rc', 'none', '-m', 'dummy:dummy', '/dev/null'])"),
+}
+
+def _env():
+  env = dict(environ)
+  env['PYTHONPATH'] = PYDIR + ((':' + env['PYTHONPATH']) if env.get('PYTHONPATH') else '')
+  env['AICLI_RC'] = 'none'
+  return env
+
+def importtime(code:str) -> tuple[int, list[tuple[int,str]], list[str]]:
+  """ Return the total import time (us), the list of (cumulative_us, module) pairs and the list of
+  loaded heavy modules. """
+  probe = (f"{code}\nimport sys\n"
+           f"print('HEAVY:', ' '.join(m for m in {HEAVY!r} if m in sys.modules))")
+  res = run([sys.executable, '-X', 'importtime', '-c', probe], stdout=PIPE, stderr=PIPE,
+            stdin=DEVNULL, env=_env(), text=True)
+  total, mods = 0, []
+  for line in res.stderr.splitlines():
+    if not line.startswith('import time:') or 'cumulative' in line:
+      continue
+    _, cumulative, name = line[len('import time:'):].split('|')
+    mods.append((int(cumulative), name.strip()))
+    if not name.startswith('  '):
+      total += int(cumulative)
+  heavy = []
+  for line in res.stdout.splitlines():
+    if line.startswith('HEAVY:'):
+      heavy = line[len('HEAVY:'):].split()
+  return total, mods, heavy
+
+def walltime(code:str, runs:int) -> float:
+  acc = []
+  for _ in range(runs):
+    t0 = perf_counter()
+    run([sys.executable, '-c', code], stdout=DEVNULL, stderr=DEVNULL, stdin=DEVNULL, env=_env())
+    acc.append(perf_counter() - t0)
+  return median(acc)
+
+def main():
+  ap = argparse.ArgumentParser(description=__doc__)
+  ap.add_argument('--runs', type=int, default=5, help="Number of wall-clock runs per entry point")
+  ap.add_argument('--top', type=int, default=10, help="Number of slowest modules to list")
+  args = ap.parse_args()
+
+  baseline = walltime("pass", args.runs)
+  print(f"Interpreter startup: {baseline*1000:.1f} ms")
+  for name, code in ENTRY_POINTS.items():
+    total, mods, heavy = importtime(code)
+    wall = walltime(code, args.runs)
+    print(f"\n{name}: wall {wall*1000:.1f} ms, imports {total/1000:.1f} ms, "
+          f"heavy modules: {', '.join(heavy) or 'none'}")
+    for cumulative, mod in sorted(mods, reverse=True)[:args.top]:
+      print(f"  {cumulative/1000:8.1f} ms  {mod}")
+
+if __name__ == "__main__":
+  main()
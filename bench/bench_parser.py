@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+""" Benchmark the REPL parser on large generated `.aicli` scripts. The script is consumed the way
+`ReplParser` does it: statements are read until the next `/ask`, then the unparsed tail is handed
+back to the parser. The legacy Earley parser re-parses the whole tail after each `/ask`. """
+
+import argparse
+from random import Random
+from time import perf_counter
+
+from lark import Lark
+from sm_aicli.actor.user import PARSER, GRAMMAR, CMD_ASK
+
+BLOCK = [
+  "/set model temp 0.{n}\n",
+  "Please summarize the following paragraph number {n}, it is important.\n",
+  "Lorem ipsum dolor sit amet, consectetur adipiscing elit # not a comment\n",
+  "/cp verbatim:\"some text {n}\" buffer:x\n",
+  "/append buffer:x buffer:in\n",
+  "# A comment line /ask\n",
+  "/echo Step {n}\n",
+]
+
+def generate(lines:int, asks_every:int, seed:int=0) -> str:
+  rnd = Random(seed)
+  acc = ["/model dummy:dummy\n"]
+  for n in range(lines):
+    acc.append(rnd.choice(BLOCK).format(n=n))
+    if n % asks_every == asks_every-1:
+      acc.append(f"{CMD_ASK}\n")
+  return ''.join(acc)
+
+def run_incremental(script:str) -> int:
+  asks = 0
+  while len(script) > 0:
+    unparsed = ''
+    for tree in PARSER.statements(script):
+      if tree.data == 'command' and str(tree.children[0]) == CMD_ASK:
+        unparsed = script[tree.meta.end_pos:]
+        asks += 1
+        break
+    script = unparsed
+  return asks
+
+def run_earley(parser:Lark, script:str) -> int:
+  asks = 0
+  while len(script) > 0:
+    unparsed = ''
+    for tree in parser.parse(script).children:
+      if tree.data == 'command' and str(tree.children[0]) == CMD_ASK:
+        unparsed = script[tree.meta.end_pos:]
+        asks += 1
+        break
+    script = unparsed
+  return asks
+
+def main():
+  ap = argparse.ArgumentParser(description=__doc__)
+  ap.add_argument('--lines', type=int, nargs='+', default=[500, 1000, 2000, 5000, 10000])
+  ap.add_argument('--asks-every', type=int, default=15, help="Insert /ask every N lines")
+  ap.add_argument('--earley-max-lines', type=int, default=500,
+                  help="Skip the legacy Earley run on larger scripts (it is quadratic)")
+  args = ap.parse_args()
+
+  earley = Lark(GRAMMAR, start='start', propagate_positions=True)
+  print(f"{'lines':>8s} {'bytes':>9s} {'asks':>6s} {'incremental,s':>14s} {'earley,s':>10s}")
+  for lines in args.lines:
+    script = generate(lines, args.asks_every)
+    t0 = perf_counter()
+    asks = run_incremental(script)
+    t_inc = perf_counter() - t0
+    t_earley = '-'
+    if lines <= args.earley_max_lines:
+      t0 = perf_counter()
+      asks2 = run_earley(earley, script)
+      t_earley = f"{perf_counter() - t0:.3f}"
+      assert asks == asks2, (asks, asks2)
+    print(f"{lines:8d} {len(script):9d} {asks:6d} {t_inc:14.3f} {t_earley:>10s}")
+
+if __name__ == "__main__":
+  main()
@@ -2,3 +2,10 @@ from .types import *
 from .actor import *
 from .utils import *
 from .main import *
+
+def __getattr__(name):
+  if name in actor.LAZY_ACTORS:
+    return getattr(actor, name)
+  if name in ('REVISION', 'VERSION'):
+    return getattr(utils, name)
+  raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
@@ -1,4 +1,17 @@
-from .gpt4all import *
-from .openai import *
-from .dummy import *
+from importlib import import_module
+
 from .user import *
+
+# Provider actors pull in heavy SDKs, so their modules are imported on first access. See also
+# `sm_aicli.main.ACTOR_PROVIDERS`.
+LAZY_ACTORS = {
+  'OpenAITextActor': '.openai',
+  'OpenAIImageActor': '.openai',
+  'GPT4AllActor': '.gpt4all',
+  'DummyActor': '.dummy',
+}
+
+def __getattr__(name):
+  if (module := LAZY_ACTORS.get(name)) is not None:
+    return getattr(import_module(module, __name__), name)
+  raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
@@ -1,5 +1,4 @@
 from contextlib import contextmanager
-from openai import OpenAI, OpenAIError
 from json import loads as json_loads, dumps as json_dumps
 from itertools import cycle
 from typing import Any
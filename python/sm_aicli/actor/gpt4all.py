@@ -1,17 +1,17 @@
 from typing import Any
 from contextlib import contextmanager
 from gpt4all import GPT4All
-from copy import deepcopy
+from copy import copy, deepcopy
 from os.path import isfile
 from dataclasses import dataclass
-from collections import OrderedDict
+from threading import Lock
 
 from ..types import (Conversation, Actor, ActorName, ActorState, ActorOptions, Utterance,
-                     Intention, ModelName, UserName, SAU, Stream)
-from ..utils import (ConsoleLogger, expandpath, find_last_message, uts_lastfullref, uts_2sau, firstfile)
+                     Intention, ModelName, UserName, SAU, Stream, ConversationException)
+from ..utils import (ConsoleLogger, IterableStream, expandpath, find_last_message, uts_lastfullref, SAULog, firstfile)
 
 
-class GPT4AllStream(Stream):
+class GPT4AllStream(IterableStream):
   def __init__(self, actor):
     super().__init__(actor.chunks)
     self.actor = actor
@@ -24,6 +24,18 @@ class GPT4AllStream(Stream):
       self.actor.chunks = None
 
 
+@dataclass
+class LoadedModel:
+  """ Model weights shared by the actors. The native model is not thread-safe and keeps the
+  context of the last generation, so it is used by one actor at a time. """
+  gpt4all:GPT4All
+  lock:Lock
+  owner:Any = None    # The actor whose conversation the native context holds
+
+# Loaded models by path or name. Models are kept for the lifetime of the process so that the
+# sessions of the aicli daemon could reuse them.
+MODELS:dict[str,LoadedModel] = {}
+
 class GPT4AllActor(Actor):
   temperature_def = 0.9
 
@@ -33,11 +45,14 @@ class GPT4AllActor(Actor):
     self.name = deepcopy(name)
     model_dir = opt.model_dir or "."
     path_or_name = firstfile(expandpath(model_dir, name.model)) or name.model
-    self.gpt4all = GPT4All(path_or_name)
+    if path_or_name not in MODELS:
+      MODELS[path_or_name] = LoadedModel(GPT4All(path_or_name), Lock())
+    self.model = MODELS[path_or_name]
+    self.gpt4all = copy(self.model.gpt4all) # Shares the weights, keeps its own chat session
     self.session = self.gpt4all.chat_session()
     self.session.__enter__()
     self.break_request = False
-    self.cache = OrderedDict()
+    self.saulog = SAULog()
     self.chunks = None
     self.logger = ConsoleLogger(self)
     self.set_options(opt)
@@ -47,24 +62,26 @@ class GPT4AllActor(Actor):
 
   def reset(self):
     self.logger.dbg("Resetting session")
+    with self.model.lock:
+      if self.model.owner is self:
+        self.model.owner = None
     self.session.__exit__(None, None, None)
     self.session = self.gpt4all.chat_session()
     self.session.__enter__()
-    self.cache = OrderedDict()
+    self.saulog.reset()
 
   def _sync(self, cnv:Conversation) -> tuple[SAU, str]:
-    uid = uts_lastfullref(cnv.utterances, self.name)
+    uid = uts_lastfullref(cnv, self.name)
     if uid is None:
       raise ConversationException("No context")
-    sau = uts_2sau(cnv.utterances[:uid+1],
-                   {UserName():"user"},
-                   "assistant",
-                   self.opt.prompt or '',
-                   self.cache)
-    if len(self.cache)>5:
-      self.cache.popitem(last=False)
+    sau = self.saulog.update(cnv.utterances,
+                             {UserName():"user"},
+                             "assistant",
+                             self.opt.prompt or '',
+                             end=uid+1)
     assert len(sau)>0, f"{sau}"
     assert sau[-1]['role'] == 'user', f"{sau}"
+    # GPT4All appends to its history, so it gets a copy of the log
     return sau[:-1], sau[-1]['content']
 
   def react(self, act:ActorState, cnv:Conversation) -> Utterance:
@@ -72,28 +89,41 @@ class GPT4AllActor(Actor):
     sau, prompt = self._sync(cnv)
     self.logger.dbg(f"sau: {sau}")
     self.logger.dbg(f"prompt: {prompt}")
-    self.gpt4all._history = sau
     def _model_callback(*args, **kwargs):
       return not self.break_request
     if self.opt.seed is not None:
-      warn(f"gpt4all actor does not support seed", actor=self)
-    self.chunks = self.gpt4all.generate(
-      prompt,
-      max_tokens=200,
-      temp=self.opt.temperature or self.temperature_def,
-      top_k=40,
-      top_p=0.9,
-      min_p=0.0,
-      repeat_penalty=1.1,
-      repeat_last_n=64,
-      n_batch=9,
-      streaming=True,
-      callback=_model_callback,
-    )
-    return Utterance.init(self.name, Intention.init(actor_next=UserName()), [GPT4AllStream(self)])
+      self.logger.warn(f"gpt4all actor does not support seed")
+    if self.opt.ctx_size is not None:
+      self.logger.warn(f"gpt4all actor does not support ctxsize, the model keeps its own context")
+    def _chunks():
+      # [1] - The native context holds the conversation of another actor. Starting over from the
+      # system prompt makes GPT4All reset the context.
+      with self.model.lock:
+        history = sau
+        if self.model.owner is not self: # [1]
+          self.logger.dbg("Model context belongs to another actor, resetting it")
+          history = [{'role':'system', 'content':self.opt.prompt or ''}]
+        self.model.owner = self
+        self.gpt4all._history = history
+        yield from self.gpt4all.generate(
+          prompt,
+          max_tokens=200,
+          temp=self.opt.temperature or self.temperature_def,
+          top_k=40,
+          top_p=0.9,
+          min_p=0.0,
+          repeat_penalty=1.1,
+          repeat_last_n=64,
+          n_batch=9,
+          streaming=True,
+          callback=_model_callback,
+        )
+    self.chunks = _chunks()
+    return Utterance.init(self.name, Intention.init(actor_next=UserName()), GPT4AllStream(self))
 
   def set_options(self, opt:ActorOptions)->None:
     self.opt = deepcopy(opt)
     if opt.num_threads is not None:
-      self.gpt4all.model.set_thread_count(opt.num_threads)
+      with self.model.lock:
+        self.gpt4all.model.set_thread_count(opt.num_threads)
 
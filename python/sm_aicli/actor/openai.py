@@ -1,5 +1,5 @@
-from typing import Any
-from openai import OpenAI, OpenAIError, DefaultHttpxClient
+from typing import Any, Iterable, Callable
+from openai import OpenAI, OpenAIError, NotFoundError
 from openai.types.image import Image as OpenAIImage
 from json import loads as json_loads, dumps as json_dumps
 from io import StringIO, BytesIO
@@ -9,36 +9,93 @@ from os.path import join, basename, exists
 # from requests import get, exceptions
 from pdb import set_trace as ST
 from collections import OrderedDict
+from functools import partial
+from time import time, perf_counter
 from os import stat
+from os.path import realpath
+from concurrent.futures import ThreadPoolExecutor, Future
+from threading import Lock
 
 from ..types import (Actor, ActorName, ActorState, PathStr, ActorOptions, Conversation, Intention,
                      ModelName, UserName, Utterance, ConversationException, SAU, Stream, Contents,
-                     File, LocalReference, RemoteReference, ContentItem, Recorder)
+                     File, Reference, LocalReference, RemoteReference, ContentItem, Recorder)
 
-from ..utils import (ConsoleLogger, IterableStream, find_last_message, err, uts_2sau, uts_lastfull,
-                     uts_lastref, add_transparent_rectangle, read_until_pattern, TextStream)
+from ..utils import (ConsoleLogger, IterableStream, find_last_message, err, warn, SAULog,
+                     sau_tokens, b64save,
+                     uts_lastfullref, add_transparent_rectangle, read_until_pattern, TextStream)
+
+from ..transport import http_client
+from ..broadcast import Broadcast
+from ..stats import StreamStats
+from ..respcache import response_cache, request_key, CACHE_ON, CACHE_REFRESH
+from ..uploads import Upload, upload_index, account_key, upload_file_parallel
 
 from .user import CMD_ANS
 
 OpenAIFileID = str
 
+# Time to wait for the sinks of a reply once it has been read, in seconds
+SINK_TIMEOUT_DEF = 5.0
+
 class TextChunkStream(TextStream):
-  def __init__(self, recorder:Recorder, chunks):
+  """ Text reply of a model, published through a `Broadcast`. The stream itself is the primary
+  subscription, read by the user actor that renders the reply and fills the output buffer. The
+  recorder and `on_complete` are sinks running in separate threads, so a slow recording file does
+  not delay the terminal. The sinks follow the primary subscription: the reply is only read as far
+  as the user actor reads it. `on_complete` receives the whole reply if it has been read to the end.
+  `started` is the time the request was sent, see `StreamStats`. """
+  def __init__(self, recorder:Recorder, texts:Iterable[str],
+               on_complete:Callable[[str],None]|None=None, started:float|None=None):
     def _gen():
       has_eol=False
-      for c in chunks:
-        data = c.choices[0].delta.content or ''
+      for data in texts:
         has_eol = data.endswith("\n")
-        recorder.record(data)
         yield data
       if not has_eol:
-        data = "\n"
-        yield data
-        recorder.record(data)
-      recorder.record(f"{CMD_ANS}\n")
-    super().__init__(_gen())
+        yield "\n"
+    self.broadcast = Broadcast(_gen())
+    super().__init__(self.broadcast.subscribe())
+    self.stats = StreamStats(started)
+    self.broadcast.sink(recorder.record, lambda: recorder.record(f"{CMD_ANS}\n"), follow=True)
+    if on_complete is not None:
+      acc = []
+      self.broadcast.sink(acc.append, lambda: on_complete(''.join(acc)), follow=True)
   def gen(self):
-    yield from super().gen()
+    try:
+      yield from super().gen()
+    finally:
+      self.close()
+  def close(self) -> None:
+    if self.broadcast is not None:
+      self.broadcast.close()
+      if not self.broadcast.join(SINK_TIMEOUT_DEF):
+        warn(f"The reply is still being recorded after {SINK_TIMEOUT_DEF}s, not waiting for it")
+      self.broadcast = None
+
+def openai_client(opt:ActorOptions) -> OpenAI:
+  """ Create an OpenAI client on top of the shared HTTP transport. """
+  try:
+    return OpenAI(api_key=opt.apikey,
+                  base_url=opt.base_url,
+                  http_client=http_client(opt.proxy, opt.pool_size, opt.timeout))
+  except OpenAIError as err:
+    raise ValueError(str(err)) from err
+
+def client_changed(opt1:ActorOptions, opt2:ActorOptions) -> bool:
+  return (opt1.apikey, opt1.base_url, opt1.proxy, opt1.pool_size, opt1.timeout) != \
+         (opt2.apikey, opt2.base_url, opt2.proxy, opt2.pool_size, opt2.timeout)
+
+
+# Maximum number of images per request, by model name
+IMAGE_N_MAX = {'dall-e-2': 10, 'dall-e-3': 1}
+IMAGE_N_MAX_DEF = 1
+# Maximum number of image requests sent at once
+IMAGE_WORKERS_DEF = 4
+
+def image_batches(model:str, n:int) -> list[int]:
+  """ Split a request for `n` images into requests of the sizes the model accepts. """
+  limit = next((v for k, v in IMAGE_N_MAX.items() if k in model), IMAGE_N_MAX_DEF)
+  return [min(limit, n - i) for i in range(0, n, limit)]
 
 class OpenAIImageActor(Actor):
   def __init__(self, name:ActorName, opt:ActorOptions, file:File):
@@ -47,31 +104,41 @@ class OpenAIImageActor(Actor):
     assert 'dall' in name.model, f"Unsupported model '{name.model}'"
     super().__init__(name, opt)
     self.logger = ConsoleLogger(self)
-    try:
-      self.client = OpenAI(api_key=opt.apikey, http_client=DefaultHttpxClient(proxy=opt.proxy))
-    except OpenAIError as err:
-      raise ValueError(str(err)) from err
+    self.client = openai_client(opt)
     self.reset()
 
   def reset(self):
     self.logger.dbg("Resetting session")
     self.cache = OrderedDict()
 
+  def set_options(self, opt:ActorOptions) -> None:
+    if client_changed(opt, self.opt):
+      self.client = openai_client(opt)
+    super().set_options(opt)
+
   def _cnv2cont(self, cnv:Conversation) -> Contents:
-    # [1] - id of the request; [2] - non-empty utterance by the same issuer.
-    uid = uts_lastref(cnv.utterances, self.name) # [1]
-    if uid is not None and cnv.utterances[uid].is_empty():
-      refname = cnv.utterances[uid].actor_name
-      uid = uts_lastfull(cnv.utterances[:uid], refname) # [2]
+    # [1] - id of the request or, if it is empty, of the preceding non-empty utterance by the same
+    # issuer.
+    uid = uts_lastfullref(cnv, self.name, before=True) # [1]
     if uid is None:
       raise ConversationException("No meaningful utterance were found")
     return cnv.utterances[uid].contents
 
+  def _response_format(self) -> str:
+    return "b64_json" if self.opt.image_inline else "url"
+
   def _read_image_response(self, response) -> list[ContentItem]:
+    # [1] - Inline images are saved right away, the user actor receives local references.
     acc = []
+    ext = getattr(response, 'output_format', None) or 'png'
     for datum in response.data:
       if not isinstance(datum, OpenAIImage):
         raise ConversationException(f"Wrong datum type ({type(datum)})")
+      if datum.b64_json is not None: # [1]
+        path = b64save(datum.b64_json, self.opt.image_dir, ext)
+        self.logger.dbg(f"Image has been saved to {path}")
+        acc.append(LocalReference(f'image/{ext}', path))
+        continue
       url = datum.url
       if url is None:
         raise ConversationException(f"Datum url is None")
@@ -79,53 +146,56 @@ class OpenAIImageActor(Actor):
       acc.append(RemoteReference('image',url))
     return acc
 
+  def _react_images(self, request:Callable[[int],Any]) -> Utterance:
+    """ Get `imgnum` images by calling `request(n)` concurrently for the batches of `n` images
+    the model accepts. Failed requests are reported, unless all of them fail. """
+    batches = image_batches(self.name.model, self.opt.imgnum or 1)
+    nworkers = min(len(batches), IMAGE_WORKERS_DEF, self.opt.pool_size or IMAGE_WORKERS_DEF)
+    with ThreadPoolExecutor(max_workers=nworkers, thread_name_prefix='image') as pool:
+      futures = [pool.submit(lambda n: self._read_image_response(request(n)), n)
+                 for n in batches]
+    content, errors = [], []
+    for future in futures:
+      try:
+        content.extend(future.result())
+      except (OpenAIError, ConversationException) as err:
+        errors.append(err)
+    if len(content) == 0:
+      raise ConversationException(str(errors[0])) from errors[0]
+    if errors:
+      self.logger.warn(f"{len(errors)} of {len(batches)} image requests failed: {errors[0]}")
+    return Utterance.init(
+      name=self.name,
+      intention=Intention.init(actor_next=UserName()),
+      contents=IterableStream(content)
+    )
+
   def _react_image_create(self, act:ActorState, prompt:str) -> Utterance:
     if self.opt.verbose > 0:
       self.logger.dbg(f"create image prompt: {prompt}")
     if self.opt.seed is not None:
       self.logger.warn(f"Image generation does not support seed")
-    try:
-      response = self.client.images.generate(
-        prompt=prompt,
-        model=self.name.model,
-        n=self.opt.imgnum or 1,
-        size=self.opt.imgsz or "256x256",
-        response_format="url",
-      )
-      content = self._read_image_response(response)
-      return Utterance.init(
-        name=self.name,
-        intention=Intention.init(actor_next=UserName()),
-        contents=IterableStream(content)
-      )
-    except OpenAIError as err:
-      raise ConversationException(str(err)) from err
-    except RequestException as err:
-      raise ConversationException(str(err)) from err
+    return self._react_images(lambda n: self.client.images.generate(
+      prompt=prompt,
+      model=self.name.model,
+      n=n,
+      size=self.opt.imgsz or "256x256",
+      response_format=self._response_format(),
+    ))
 
   def _react_image_modify(self, act:ActorState, prompt:str, image:BytesIO) -> Utterance:
     self.logger.dbg(f"Image editing prompt: {prompt}")
     if self.opt.seed is not None:
       self.logger.warn(f"Image editing does not support seed")
-    try:
-      response = self.client.images.edit(
-        image=image,
-        prompt=prompt,
-        model=self.name.model,
-        n=self.opt.imgnum or 1,
-        size=self.opt.imgsz or "256x256",
-        response_format="url"
-      )
-      content = self._read_image_response(response)
-      return Utterance.init(
-        name=self.name,
-        intention=Intention.init(actor_next=UserName()),
-        contents=IterableStream(content)
-      )
-    except OpenAIError as err:
-      raise ConversationException(str(err)) from err
-    except RequestException as err:
-      raise ConversationException(str(err)) from err
+    data = image.getvalue()
+    return self._react_images(lambda n: self.client.images.edit(
+      image=BytesIO(data), # Every request reads its own copy
+      prompt=prompt,
+      model=self.name.model,
+      n=n,
+      size=self.opt.imgsz or "256x256",
+      response_format=self._response_format(),
+    ))
 
   def react(self, act:ActorState, cnv:Conversation) -> Utterance:
     if len(cnv.utterances) == 0:
@@ -148,6 +218,9 @@ class OpenAIImageActor(Actor):
       return self._react_image_create(act, sbuf.getvalue())
 
 
+# Number of files uploaded at once
+UPLOAD_WORKERS_DEF = 4
+
 class OpenAITextActor(Actor):
   def __init__(self, name:ActorName, opt:ActorOptions, file:File, recorder:Recorder):
     assert isinstance(name, ModelName), name
@@ -157,34 +230,110 @@ class OpenAITextActor(Actor):
     super().__init__(name, opt)
     self.logger = ConsoleLogger(self)
     self.file = file
-    self.uploads:dict[LocalReference,OpenAIFileID] = {}
+    self.uploads:dict[tuple[str,str],OpenAIFileID] = {}  # (account, digest) -> file id
+    self.upload_index = upload_index()
+    self.upload_pool = ThreadPoolExecutor(max_workers=UPLOAD_WORKERS_DEF,
+                                          thread_name_prefix='upload')
+    self.upload_futures:dict[tuple,Future] = {}  # (account, path, size, mtime) -> file id
+    self.ref_uploads:dict[tuple,tuple[LocalReference,Future]] = {} # (account, id(ref)) -> (ref, id)
+    self.upload_lock = Lock()    # Guards `upload_futures` and `ref_uploads`
     self.recorder = recorder
-    try:
-      self.client = OpenAI(api_key=opt.apikey, http_client=DefaultHttpxClient(proxy=opt.proxy))
-    except OpenAIError as err:
-      raise ValueError(str(err)) from err
+    self.client = openai_client(opt)
+    self.saulog = SAULog(partial(sau_tokens, model=name.model))
     self.reset()
 
   def reset(self):
     self.logger.dbg("Resetting session")
-    self.cache = OrderedDict()
+    self.saulog.reset()
+
+  def set_options(self, opt:ActorOptions) -> None:
+    if client_changed(opt, self.opt):
+      self.client = openai_client(opt)
+    super().set_options(opt)
+
+  def _verify_upload(self, upload:Upload) -> bool:
+    """ Check that the uploaded file still exists. Other errors, e.g. network errors, keep the
+    upload, it is verified again next time. """
+    try:
+      f = self.client.files.retrieve(upload.file_id)
+      upload.verified = time()
+      upload.expires = getattr(f, 'expires_at', None)
+      return upload.expires is None or upload.expires > upload.verified
+    except NotFoundError:
+      return False
+    except OpenAIError as err:
+      self.logger.dbg(f"Could not verify uploaded file {upload.file_id}: {err}")
+      return True
 
   def upload_reference_cached(self, ref:LocalReference) -> OpenAIFileID:
+    """ Upload the file unless its contents has already been uploaded by this or a previous
+    session. """
+    # [1] - Known uploads are verified against the files API from time to time.
     assert isinstance(ref, LocalReference), f"Not a LocalReference: {ref}"
-    if file_id := self.uploads.get(ref):
+    account = account_key(self.opt.apikey, str(self.client.base_url))
+    key = (account, self.upload_index.digest(ref.path))
+    if file_id := self.uploads.get(key):
       return file_id
-    upload = self.client.uploads.upload_file_chunked(
-      file = ref.path,
-      mime_type = ref.mimetype,
-      purpose = "assistants",
-    )
-    self.logger.dbg(f"{ref} upload status: {upload.status} file_id {upload.file.id}")
-    assert upload.status == "completed"
-    self.uploads[ref] = upload.file.id
-    return self.uploads[ref]
+    upload = self.upload_index.get(*key)
+    if upload is not None and self.upload_index.needs_verification(upload): # [1]
+      if self._verify_upload(upload):
+        self.upload_index.put(*key, upload)
+      else:
+        self.logger.dbg(f"{ref}: uploaded file {upload.file_id} is not available")
+        self.upload_index.put(*key, None)
+        upload = None
+    if upload is None:
+      response = upload_file_parallel(
+        self.client.uploads,
+        ref.path,
+        mime_type = ref.mimetype,
+        purpose = "assistants",
+      )
+      self.logger.dbg(f"{ref} upload status: {response.status} file_id {response.file.id}")
+      assert response.status == "completed"
+      now = time()
+      upload = Upload(response.file.id, now, now, getattr(response.file, 'expires_at', None))
+      self.upload_index.put(*key, upload)
+    else:
+      self.logger.dbg(f"{ref}: reusing uploaded file {upload.file_id}")
+    self.uploads[key] = upload.file_id
+    return upload.file_id
+
+  def upload_reference_async(self, ref:LocalReference) -> Future:
+    """ Start uploading the file in the background, unless the upload of its current version has
+    already been started. Failed uploads are started again. """
+    # [1] - A reference seen before keeps its upload without looking at the file, which may have
+    #       been changed, moved or deleted since, e.g. when the history is converted again. The
+    #       reference is stored along with the upload, so that its id is not reused.
+    # [2] - Called from both the prefetching and the conversion threads, the check and the insertion
+    #       are done at once so that the same file is not uploaded twice.
+    account = account_key(self.opt.apikey, str(self.client.base_url))
+    ref_key = (account, id(ref))
+    with self.upload_lock: # [2]
+      if (seen := self.ref_uploads.get(ref_key)) is not None: # [1]
+        _, future = seen
+        if not (future.done() and future.exception() is not None):
+          return future
+      st = stat(ref.path)
+      key = (account, realpath(ref.path), st.st_size, st.st_mtime_ns)
+      future = self.upload_futures.get(key)
+      if future is None or (future.done() and future.exception() is not None):
+        future = self.upload_pool.submit(self.upload_reference_cached, ref)
+        self.upload_futures[key] = future
+      self.ref_uploads[ref_key] = (ref, future)
+      return future
+
+  def prefetch(self, ref:Reference) -> None:
+    if isinstance(ref, LocalReference):
+      try:
+        self.upload_reference_async(ref)
+      except OSError as e:
+        self.logger.dbg(f"{ref}: not prefetched: {e}")
 
   def _cnv2sau(self, cnv:Conversation) -> SAU:
     """ Convert conversation to the extended SAU format. """
+    # [1] - Start all the uploads of the message before waiting for any of them. Files referenced
+    # with /ref are already being uploaded, see `prefetch`.
     def _cont2str(c:Contents) -> list:
       acc = []
       def _append_text(text):
@@ -192,37 +341,34 @@ class OpenAITextActor(Actor):
           acc.append({'type':'text', 'text':''})
         if acc[-1]['type'] == 'text':
           acc[-1]['text'] += text
-      for tok in c.gen():
+      toks = list(c.gen())
+      futures = {id(tok):self.upload_reference_async(tok)
+                 for tok in toks if isinstance(tok, LocalReference)} # [1]
+      for tok in toks:
         match tok:
           case str():
             _append_text(tok)
           case bytes():
             _append_text(tok.decode('utf-8'))
           case LocalReference():
-            file_id = self.upload_reference_cached(tok)
+            file_id = futures[id(tok)].result()
             acc.append({'type':'file', 'file':{'file_id':file_id}})
           case _:
             raise ValueError(f"Unsupported content item: {tok}")
       return acc
 
-    sau = uts_2sau(
+    return self.saulog.update(
       cnv.utterances,
       names={UserName():'user'},
       default_name='assistant',
       system_prompt=self.opt.prompt,
-      cache=self.cache,
       cont2str_fn=_cont2str,
     )
-    if len(self.cache)>5:
-      self.cache.popitem(last=False)
-    return sau
 
   def _cnv2cont(self, cnv:Conversation) -> Contents:
-    # [1] - id of the request; [2] - non-empty utterance by the same issuer.
-    uid = uts_lastref(cnv.utterances, self.name) # [1]
-    if uid is not None and cnv.utterances[uid].is_empty():
-      refname = cnv.utterances[uid].actor_name
-      uid = uts_lastfull(cnv.utterances[:uid], refname) # [2]
+    # [1] - id of the request or, if it is empty, of the preceding non-empty utterance by the same
+    # issuer.
+    uid = uts_lastfullref(cnv, self.name, before=True) # [1]
     if uid is None:
       raise ConversationException("No meaningful utterance were found")
     return cnv.utterances[uid].contents
@@ -231,23 +377,35 @@ class OpenAITextActor(Actor):
     if len(cnv.utterances) == 0:
       raise ConversationException(f'No context')
     sau = self._cnv2sau(cnv)
+    total = self.saulog.total
+    sau, used = self.saulog.window(self.opt.ctx_size)
+    self.logger.info(f"Context: {total} tokens in {len(self.saulog.sau)} messages, "
+                     f"sending {used} tokens in {len(sau)} messages")
     self.logger.dbg(f"sau: {sau}")
     response = None
     if self.opt.replay:
       chunks = read_until_pattern(self.file, CMD_ANS, 'OpenAI>>> ')
       response = IterableStream(chunks)
     else:
-      try:
-        chunks = self.client.chat.completions.create(
-          model=self.name.model,
-          messages=sau,
-          stream=True,
-          temperature=self.opt.temperature,
-          seed=self.opt.seed,
-        )
-        response = TextChunkStream(self.recorder, chunks)
-      except OpenAIError as err:
-        raise ConversationException(str(err)) from err
+      # [1] - Refresh mode skips the lookup but saves the reply.
+      cache = response_cache() if self.opt.cache in [CACHE_ON, CACHE_REFRESH] else None
+      request = dict(model=self.name.model, messages=sau, temperature=self.opt.temperature,
+                     seed=self.opt.seed)
+      key = request_key(base_url=str(self.client.base_url), **request)
+      cached = cache.get(key) if cache is not None and self.opt.cache == CACHE_ON else None # [1]
+      if cached is not None:
+        self.logger.info(f"Using cached response {key[:10]}")
+        response = TextChunkStream(self.recorder, cached.splitlines(keepends=True))
+      else:
+        try:
+          started = perf_counter() # TTFT includes the request round-trip
+          chunks = self.client.chat.completions.create(stream=True, **request)
+          response = TextChunkStream(self.recorder,
+                                     (c.choices[0].delta.content or '' for c in chunks),
+                                     partial(cache.put, key) if cache is not None else None,
+                                     started=started)
+        except OpenAIError as err:
+          raise ConversationException(str(err)) from err
     assert response is not None
     return Utterance.init(self.name, Intention.init(actor_next=UserName()), response)
 
@@ -1,26 +1,37 @@
+import re
 from gnureadline import (parse_and_bind, clear_history, read_history_file,
                          write_history_file, set_completer, set_completer_delims)
-from lark import Lark, Token
-from lark.exceptions import LarkError
+from lark import Lark, Token, Tree
+from lark.tree import Meta
+from lark.exceptions import LarkError, UnexpectedCharacters, UnexpectedToken
 from lark.visitors import Interpreter
 from dataclasses import dataclass
-from typing import Any
+from typing import Any, Iterable
 from copy import copy
-from sys import stdout
+import sys
 from collections import defaultdict
 from os import system, chdir, environ, getcwd, listdir
 from os.path import expanduser, sep, abspath, join, isfile, isdir, split, dirname
 from io import StringIO
 from pdb import set_trace as ST
 from subprocess import run, PIPE
+from hashlib import sha256
+from queue import Queue
+from threading import Thread, Lock, Event
+from concurrent.futures import ThreadPoolExecutor, Future
+from json import dumps as json_dumps
 
 from ..types import (Stream, Logger, Actor, ActorDesc, ActorName, ActorOptions, Intention,
                      Utterance, Conversation, ActorState, ModelName, Modality, QuotedString,
                      UnquotedString, Parser, File, ContentItem, Reference, LocalReference,
-                     LocalContent, RemoteReference, ParsingResults, RecordingParams, Recorder)
+                     LocalContent, RemoteReference, ParsingResults, RecordingParams, Recorder,
+                     Recording, ConversationException)
 
-from ..utils import (IterableStream, ConsoleLogger, with_sigint, version, sys2exitcode, WLState,
-                     wraplong, onematch, expanddir, info, set_global_verbosity, traverse_stream)
+from ..utils import (IterableStream, BinStream, ConsoleLogger, with_sigint, version, sys2exitcode, WLState,
+                     wraplong, onematch, expanddir, info, set_global_verbosity, traverse_stream,
+                     cache_dir)
+from ..stats import Stats
+from ..respcache import CACHE_ON, CACHE_REFRESH
 
 CMD_APPEND = "/append"
 CMD_ASK  = "/ask"
@@ -31,6 +42,7 @@ CMD_CP = "/cp"
 CMD_DBG = "/dbg"
 CMD_ECHO = "/echo"
 CMD_EXIT = "/exit"
+CMD_FANOUT = "/fanout"
 CMD_HELP = "/help"
 CMD_MODEL = "/model"
 CMD_READ = "/read"
@@ -43,6 +55,10 @@ CMD_CD = "/cd"
 CMD_PASTE = "/paste"
 CMD_PWD = "/pwd"  # Added the command for printing the current directory
 CMD_REF = "/ref"
+CMD_STATS = "/stats"
+
+# Number of references downloaded at once
+DEREF_WORKERS_DEF = 4
 
 def _mkref(tail):
   return {
@@ -71,6 +87,7 @@ COMPLETION = {
   CMD_EXIT:    {},
   CMD_PASTE:   VBOOL,
   CMD_MODEL:   MODEL,
+  CMD_FANOUT:  MODEL,
   CMD_READ:    {},
   CMD_SET: {
     " model": {
@@ -83,12 +100,20 @@ COMPLETION = {
       " verbosity": {" NUMBER": {}, " default": {}},
       " seed":      {" NUMBER": {}, " default": {}},
       " imgnum":    {" NUMBER": {}, " default": {}},
+      " imginline": {" BOOL":   {}, " default": {}},
       " imgdir":    {" string": {}, " default": {}},
       " modeldir":  {" string": {}, " default": {}},
       " proxy":     {" string": {}, " default": {}},
+      " baseurl":   {" string": {}, " default": {}},
+      " poolsize":  {" NUMBER": {}, " default": {}},
+      " timeout":   {" FLOAT":  {}, " default": {}},
+      " ctxsize":   {" NUMBER": {}, " default": {}},
+      " cache":     {" on": {}, " off": {}, " refresh": {}, " default": {}},
     },
     " terminal": {
       " rawbin": VBOOL,
+      " chunksize": {" NUMBER": {}, " default": {}},
+      " fsync": VBOOL,
       " prompt": {" string": {}},
       " width": {" NUMBER": {}, " default": {}},
       " verbosity": {" NUMBER": {}, " default": {}},
@@ -103,7 +128,8 @@ COMPLETION = {
   CMD_PIPE:    REF_REF_REF,
   CMD_CD:      REF,
   CMD_PWD:     {},
-  CMD_REF:     {" string": {" string": {}}}
+  CMD_REF:     {" string": {" string": {}}},
+  CMD_STATS:   {" json": {}},
 }
 
 SCHEMAS = [str(k).strip().replace(':','') for k in REF.keys()]
@@ -119,6 +145,7 @@ CMDHELP = {
   CMD_DBG:     ("",              "Run the Python debugger"),
   CMD_ECHO:    ("",              "Echo the following line to STDOUT"),
   CMD_EXIT:    ("",              "Exit"),
+  CMD_FANOUT:  ("MODEL MODEL ..", "Ask several models at once, stream every reply into a buffer named after the model."),
   CMD_HELP:    ("",              "Print help"),
   CMD_MODEL:   ("PROVIDER:NAME", "Set the current model to `model_string`. Allocate the model on first use."),
   CMD_PASTE:   ("BOOL",          "Enable or disable paste mode."),
@@ -130,10 +157,16 @@ CMDHELP = {
   CMD_VERSION: ("",              "Print version"),
   CMD_PWD:     ("",              "Print the current working directory."),
   CMD_REF:     ("STR STR",       "Insert a reference to a remote object"),
+  CMD_STATS:   ("[json]",        "Print latency and throughput statistics of the model replies."),
 }
 
+# Text runs stop right before a command or a comment.
+RE_TEXT = r"([^#](?![\/]))*[^\/#]"
+# Maximum size of a command, in characters. Only quoted strings may make commands span several lines.
+COMMAND_SIZE_MAX = 1024*1024
+
 GRAMMAR = fr"""
-  start: (escape | command | comment | text)? (escape | command | comment | text)*
+  start: (escape | command | comment | text)*
   # Escape disable any special meaning of one next symbol.
   escape: ESCAPE
   # Comments start from `#` and last until the end of the line.
@@ -147,6 +180,7 @@ GRAMMAR = fr"""
              /\{CMD_HELP}/ | \
              /\{CMD_EXIT}/ | \
              /\{CMD_MODEL}/ / +/ model_ref | \
+             /\{CMD_FANOUT}/ (/ +/ model_ref)+ | \
              /\{CMD_READ}/ / +/ /model/ / +/ /prompt/ | \
              /\{CMD_SET}/ / +/ (/model/ / +/ (/apikey/ / +/ ref | \
                                               (/t/ | /temp/) / +/ (FLOAT | DEF) | \
@@ -159,8 +193,16 @@ GRAMMAR = fr"""
                                               /replay/ / +/ (BOOL | DEF) | \
                                               /modality/ / +/ (MODALITY | DEF) | \
                                               /proxy/ / +/ (string | DEF) | \
-                                              /imgnum/ / +/ (NUMBER | DEF)) | \
+                                              /baseurl/ / +/ (string | DEF) | \
+                                              /poolsize/ / +/ (NUMBER | DEF) | \
+                                              /timeout/ / +/ (FLOAT | NUMBER | DEF) | \
+                                              /ctxsize/ / +/ (NUMBER | DEF) | \
+                                              /cache/ / +/ (BOOL | /refresh/ | DEF) | \
+                                              /imgnum/ / +/ (NUMBER | DEF) | \
+                                              /imginline/ / +/ (BOOL | DEF)) | \
                                (/term/ | /terminal/) / +/ (/rawbin/ / +/ BOOL | \
+                                                           /chunksize/ / +/ (NUMBER | DEF) | \
+                                                           /fsync/ / +/ BOOL | \
                                                            /prompt/ / +/ string | \
                                                            /recording/ / +/ ref | \
                                                            /width/ / +/ (NUMBER | DEF) | \
@@ -174,6 +216,7 @@ GRAMMAR = fr"""
              /\{CMD_CD}/ / +/ ref | \
              /\{CMD_PASTE}/ / +/ BOOL | \
              /\{CMD_REF}/ / +/ string / +/ string | \
+             /\{CMD_STATS}/ (/ +/ /json/)? | \
              /\{CMD_PWD}/
   # Everything else is a regular text.
   text: TEXT
@@ -189,16 +232,17 @@ GRAMMAR = fr"""
   # (`bfile:path/to/file`), a named memory buffer (`buffer:name`) or a read-only string constant
   # (`verbatim:ABC`).
   ref: (SCHEMA ":")? string -> ref | \
-       (/file/ | /bfile/) (/\(/ | /\(/ / +/) ref (/\)/ | / +/ /\)/) -> ref_file
+       REF_FILE (/\(/ | /\(/ / +/) ref (/\)/ | / +/ /\)/) -> ref_file
 
   # Base token types
   ESCAPE.5: /\\./
-  SCHEMA.4: {'|'.join([f"/{s}/" for s in SCHEMAS])}
-  PROVIDER.4: {'|'.join([f"/{p}/" for p in PROVIDERS])}
+  SCHEMA.4: /({'|'.join(SCHEMAS)})(?=:[^ \n])/
+  PROVIDER.4: /({'|'.join(PROVIDERS)})(?=:)/
+  REF_FILE.4: /b?file(?=\()/
   STRING_QUOTED.3: /[^"]+/
   STRING_QUOTED2.3: /[^']+/
-  STRING_UNQUOTED.3: /[^"\(\)][^ \(\)\n]*/
-  TEXT.0: /([^#](?![\/]))*[^\/#]/
+  STRING_UNQUOTED.3: /(?!'[^']*'(?:[ \)\n]|$))[^"\(\) \n][^ \(\)\n]*/
+  TEXT.0: /{RE_TEXT}/
   ID: /[a-zA-Z_][a-zA-Z0-9_]*/
   NUMBER: /[0-9]+/
   FLOAT: /[0-9]+\.[0-9]*/
@@ -208,7 +252,128 @@ GRAMMAR = fr"""
   COMMENT: "#" /[^\n]*/
 """
 
-PARSER = Lark(GRAMMAR, start='start', propagate_positions=True)
+class StatementParser:
+  """ Incremental parser for the `GRAMMAR` language. The input is consumed one top-level statement
+  (an escape, a comment, a text run or a command) at a time, so the caller may stop at any command
+  without paying for the rest of the input. The top level of the grammar is regular and is scanned
+  directly in linear time. Command arguments are parsed by an LALR parser which only sees the
+  current line, the window grows only if a quoted string spans several lines. """
+
+  TEXT = re.compile(RE_TEXT)
+
+  def __init__(self, grammar:str):
+    self.grammar = grammar
+    self.digest = sha256(grammar.encode()).hexdigest()[:10]
+    self._lalr:Lark|None = None
+
+  @property
+  def lalr(self) -> Lark:
+    """ LALR parser of commands, built on first use. """
+    if self._lalr is None:
+      self._lalr = self._load()
+    return self._lalr
+
+  def tables_name(self) -> str:
+    """ Name of the compiled grammar file, keyed by the grammar hash. """
+    return f"grammar-{self.digest}.lark"
+
+  def _load(self) -> Lark:
+    # [1] - Pre-compiled tables might be shipped with the package, see `save`.
+    # [2] - Otherwise, compile the grammar once and keep the result in the user cache.
+    bundled = join(dirname(__file__), self.tables_name())
+    if isfile(bundled): # [1]
+      try:
+        with open(bundled, 'rb') as f:
+          return Lark.load(f)
+      except Exception as e:
+        info(f"Failed to load pre-compiled grammar '{bundled}': {e}")
+    cdir = cache_dir()
+    cache = join(cdir, self.tables_name()) if cdir is not None else False # [2]
+    return Lark(self.grammar, start='command', parser='lalr', propagate_positions=True,
+                cache=cache)
+
+  def save(self, dirpath:str) -> str:
+    """ Save the compiled grammar into `dirpath` so that it could be shipped with the package. """
+    path = join(dirpath, self.tables_name())
+    with open(path, 'wb') as f:
+      self.lalr.save(f)
+    return path
+
+  @staticmethod
+  def _tree(data:str, token:Token, start_pos:int, end_pos:int) -> Tree:
+    meta = Meta()
+    meta.empty = False
+    meta.start_pos, meta.end_pos = start_pos, end_pos
+    return Tree(data, [token], meta)
+
+  def _command(self, text:str, pos:int) -> Tree|None:
+    """ Parse the longest command starting at `pos`. Return None if there is no command. """
+    end = text.find('\n', pos)
+    end = len(text) if end < 0 else end
+    while True:
+      window = text[pos:end]
+      ip = self.lalr.parse_interactive(window)
+      best, best_end, at_end = None, 0, False
+      try:
+        for tok in ip.lexer_thread.lex(ip.parser_state):
+          ip.feed_token(tok)
+          if (tree := self._complete(ip, tok)) is not None:
+            best, best_end = tree, tok.end_pos
+        at_end = True
+      except (UnexpectedCharacters, UnexpectedToken):
+        pass
+      # [1] - Only quoted strings may span several lines. If the window is exhausted, or ends inside
+      # a quoted string, before a command is complete, retry with a window twice as large, up to
+      # `COMMAND_SIZE_MAX`, so that an unterminated quote does not make every following line
+      # re-scan the rest of the input.
+      unclosed = window.count('"') % 2 == 1 or window.count("'") % 2 == 1
+      if (at_end or unclosed) and end < len(text) and best_end < len(window) and \
+         end - pos < COMMAND_SIZE_MAX: # [1]
+        end = text.find('\n', min(pos + 2*(end - pos), pos + COMMAND_SIZE_MAX) + 1)
+        end = len(text) if end < 0 else end
+        continue
+      if best is not None:
+        best.meta.start_pos, best.meta.end_pos = pos, pos + best_end
+      return best
+
+  @staticmethod
+  def _complete(ip, last_tok:Token) -> Tree|None:
+    """ Return the command tree if the input seen by `ip` so far is a complete command. """
+    try:
+      return ip.copy().feed_eof(last_tok)
+    except UnexpectedToken:
+      return None
+
+  def statements(self, text:str) -> Iterable[Tree]:
+    """ Lazily yield top-level statements of `text`. Statement trees carry absolute positions in
+    their `meta`. """
+    pos = 0
+    while pos < len(text):
+      c = text[pos]
+      if c == '\\' and pos+1 < len(text) and text[pos+1] != '\n':
+        yield self._tree('escape', Token('ESCAPE', text[pos:pos+2]), pos, pos+2)
+        pos += 2
+        continue
+      if c == '#':
+        end = text.find('\n', pos)
+        end = len(text) if end < 0 else end
+        yield self._tree('comment', Token('COMMENT', text[pos:end]), pos, end)
+        pos = end
+        continue
+      if c == '/' and (tree := self._command(text, pos)) is not None:
+        yield tree
+        pos = tree.meta.end_pos
+        continue
+      if (m := self.TEXT.match(text, pos)) is None:
+        raise ValueError(f"Unexpected input at position {pos}: '{text[pos:pos+10]}'")
+      yield self._tree('text', Token('TEXT', m.group()), pos, m.end())
+      pos = m.end()
+
+  def parse(self, text:str) -> Tree:
+    """ Parse the whole `text` into the `start` tree. """
+    return Tree('start', list(self.statements(text)))
+
+PARSER = StatementParser(GRAMMAR)
 
 def is_default(val:Token)->bool:
   return str(val) in {"def","default"}
@@ -264,9 +429,9 @@ def ref_write(ref, val:list[str|bytes], buffers, append:bool=False):
       raise ValueError(str(err)) from err
   elif schema == 'buffer':
     if append:
-      buffers[name.lower()].extend(val)  # Changed from += to extend
+      buffers[name.lower()].extend(val)
     else:
-      buffers[name.lower()] = val
+      buffers[name.lower()] = Buffer(val)
   else:
     raise ValueError(f"Unsupported target schema '{schema}'")
 
@@ -287,6 +452,10 @@ def ref_read(ref, buffers)->list[str|bytes]:
   else:
     raise ValueError(f"Unsupported reference schema '{schema}'")
 
+def fanout_buffer(name:ModelName) -> str:
+  """ Name of the buffer receiving the fan-out reply of the model `name`. """
+  return (name.alias or name.model).lower()
+
 def ref_quote(ref:str, prefixes:list[str])->str:
   for p in [(p+':') for p in prefixes]:
     if ref.startswith(p) and (' ' in ref[len(p):]):
@@ -303,9 +472,43 @@ def ref2str(ref:Reference) -> str:
       raise ValueError(f"Unsupported reference: {ref}")
 
 
-def buffer2str(buffer:LocalContent) -> str:
+class Buffer(Recording):
+  """ A named REPL buffer. Appends are amortized O(1). The flattened text and binary views are
+  cached until the next write. `size` is the number of bytes stored, counting text in UTF-8. """
+  def __init__(self, items:Iterable[ContentItem]=()):
+    self.size = 0
+    self._str:str|None = None
+    self._bytes:bytes|None = None
+    super().__init__(items)
+
+  def append(self, item:ContentItem) -> None:
+    super().append(item)
+    if isinstance(item, bytes) or (isinstance(item, str) and item.isascii()):
+      self.size += len(item)
+    elif isinstance(item, str):
+      self.size += len(item.encode('utf-8'))
+    self._str = self._bytes = None
+
+  def extend(self, items:Iterable[ContentItem]) -> None:
+    for item in list(items):
+      self.append(item)
+
+  def as_str(self) -> str:
+    if self._str is None:
+      self._str = buffer2str(self.items())
+    return self._str
+
+  def as_bytes(self) -> bytes:
+    if self._bytes is None:
+      self._bytes = buffer2bytes(self.items())
+    return self._bytes
+
+
+def buffer2str(buffer:LocalContent|Buffer) -> str:
   """Convert a list of strings or bytes into a single string. Convert bytes to strings using
   utf-8."""
+  if isinstance(buffer, Buffer):
+    return buffer.as_str()
   acc = []
   for item in buffer:
     match item:
@@ -320,9 +523,11 @@ def buffer2str(buffer:LocalContent) -> str:
   return ''.join(acc)
 
 
-def buffer2bytes(buffer:LocalContent) -> bytes:
+def buffer2bytes(buffer:LocalContent|Buffer) -> bytes:
   """Convert a list of strings or bytes into a single bytes object. Convert strings to bytes using
   utf-8."""
+  if isinstance(buffer, Buffer):
+    return buffer.as_bytes()
   acc = []
   for item in buffer:
     match item:
@@ -335,19 +540,19 @@ def buffer2bytes(buffer:LocalContent) -> bytes:
   return b''.join(acc)
 
 
-def bufferadd(buffer:LocalContent, val:str|bytes) -> None:
-  if len(buffer)==0 or not isinstance(buffer[-1], type(val)):
-    buffer.append(type(val)())
-  buffer[-1] += val
+def bufferadd(buffer:Buffer, val:str|bytes) -> None:
+  buffer.append(val)
 
 
 class UserRecorder(Recorder):
   def __init__(self):
     self.recfile = None
+    self.lock = Lock() # Fan-out replies are recorded from several threads
   def record(self, chunk:str) -> None:
-    if self.recfile is not None:
-      self.recfile.write(chunk)
-      self.recfile.flush()
+    with self.lock:
+      if self.recfile is not None:
+        self.recfile.write(chunk)
+        self.recfile.flush()
   def update_params(self, recording:RecordingParams) ->None:
     if self.recfile is not None:
       self.recfile.write(f"{CMD_SET} model replay off\n")
@@ -372,10 +577,14 @@ OUT='out'
 class Repl(Interpreter):
   def __init__(self, owner:"UserActor", logger:Logger):
     self.owner = owner
-    self.buffers:dict[str,LocalContent] = defaultdict(list)  # Changed type to list[str]
+    self.buffers:dict[str,Buffer] = defaultdict(Buffer)
     self.opts: ActorDesc|None = None
     self.actor_next = None
     self.rawbin = False
+    self.stats = Stats()
+    self.chunk_size:int|None = None  # Chunk size of binary downloads
+    self.fsync = False               # Sync downloaded files to disk
+    self.prefetch:list[Reference] = [] # References to pass to the target actor, see `Actor.prefetch`
     self._reset()
     self.readline_prompt = owner.args.readline_prompt
     self.wlstate = WLState(None)
@@ -387,8 +596,8 @@ class Repl(Interpreter):
 
   def _reset(self):
     self.in_echo = 0
-    self.buffers[IN] = []
-    self.buffers[OUT] = []
+    self.buffers[IN] = Buffer()
+    self.buffers[OUT] = Buffer()
 
   def _print(self, s=None, flush=False, end='\n'):
     wraplong((s or '') + end, self.wlstate, lambda s: print(s, end='', flush=True), flush=flush)
@@ -473,7 +682,34 @@ class Repl(Interpreter):
           )
         )
       finally:
-        self.buffers[IN] = []
+        self.buffers[IN] = Buffer()
+    elif command == CMD_FANOUT:
+      try:
+        names = [v for v in self.visit_children(tree) if isinstance(v, ModelName)]
+        if len(set(names)) != len(names):
+          raise ValueError("Fan-out models should be distinct")
+        buffers = [fanout_buffer(n) for n in names]
+        for b in buffers:
+          if b in [IN, OUT]:
+            raise ValueError(f"Buffer '{b}' is reserved, give the model an alias")
+        if len(set(buffers)) != len(buffers):
+          raise ValueError("Fan-out models should have distinct names or aliases")
+        for name in names:
+          opts[name] = opts.get(name, ActorOptions.init())
+        self.logger.info(f"Asking {', '.join(n.repr() for n in names)}")
+        raise InterpreterPause(
+          unparsed=tree.meta.end_pos,
+          utterance=Utterance.init(
+            name=self.owner.name,
+            contents=IterableStream(self.buffers[IN]),
+            intention=Intention.init(
+              fanout=names,
+              actor_updates=self.opts,
+            )
+          )
+        )
+      finally:
+        self.buffers[IN] = Buffer()
     elif command == CMD_HELP:
       self._print(self.owner.args.help)
       self._print("Command-line grammar:")
@@ -531,6 +767,10 @@ class Repl(Interpreter):
         elif pname == 'imgnum':
           opts[self.actor_next].imgnum = as_int(pval)
           self.logger.info(f"Setting model image number to '{opts[self.actor_next].imgnum}'")
+        elif pname == 'imginline':
+          val = False if is_default(pval) else as_bool(pval)
+          opts[self.actor_next].image_inline = val
+          self.logger.info(f"Setting model inline images to '{val}'")
         elif pname == 'verbosity':
           val = as_int(pval)
           opts[self.actor_next].verbose = val
@@ -551,6 +791,29 @@ class Repl(Interpreter):
           val = as_str(pval)
           opts[self.actor_next].proxy = val
           self.logger.info(f"Setting model proxy to '{val}'")
+        elif pname == 'baseurl':
+          val = as_str(pval)
+          opts[self.actor_next].base_url = val
+          self.logger.info(f"Setting model base URL to '{val or 'default'}'")
+        elif pname == 'poolsize':
+          val = as_int(pval)
+          opts[self.actor_next].pool_size = val
+          self.logger.info(f"Setting model connection pool size to '{val or 'default'}'")
+        elif pname == 'timeout':
+          val = None if is_default(pval) else float(pval)
+          opts[self.actor_next].timeout = val
+          self.logger.info(f"Setting model timeout to '{val or 'default'}'")
+        elif pname == 'ctxsize':
+          val = as_int(pval)
+          opts[self.actor_next].ctx_size = val
+          self.logger.info(f"Setting model context size to '{val or 'unlimited'}' tokens (OpenAI only)")
+        elif pname == 'cache':
+          if str(pval) == CACHE_REFRESH:
+            val = CACHE_REFRESH
+          else:
+            val = CACHE_ON if not is_default(pval) and as_bool(pval) else None
+          opts[self.actor_next].cache = val
+          self.logger.info(f"Setting model response cache to '{val or 'off'}'")
         else:
           raise ValueError(f"Unknown actor parameter '{pname}'")
       elif section in ['term', 'terminal']:
@@ -558,6 +821,13 @@ class Repl(Interpreter):
           val = as_bool(pval)
           self.logger.info(f"Setting terminal raw binary mode to '{val}'")
           self.rawbin = val
+        elif pname == 'chunksize':
+          self.chunk_size = as_int(pval)
+          self.logger.info(f"Setting terminal download chunk size to "
+                           f"'{self.chunk_size or 'default'}'")
+        elif pname == 'fsync':
+          self.fsync = as_bool(pval)
+          self.logger.info(f"Setting terminal download fsync to '{self.fsync}'")
         elif pname == 'prompt':
           self.readline_prompt = pval
           self.logger.info(f"Setting terminal prompt to '{self.readline_prompt}'")
@@ -592,7 +862,7 @@ class Repl(Interpreter):
         self.logger.info(f"Setting actor prompt to '{pval[:10]}...'")
       else:
         raise ValueError(f"Unknown read parameter '{pname}'")
-      self.buffers[IN] = []
+      self.buffers[IN] = Buffer()
     elif command == CMD_CLEAR:
       args = self.visit_children(tree)
       (schema, name) = args[2]
@@ -625,7 +895,8 @@ class Repl(Interpreter):
       sref, dref = args[2], args[4]
       val = ref_read(sref, self.buffers)
       ref_write(dref, val, self.buffers, append=append)
-      self.logger.info(f"{'Appended' if append else 'Copied'} from {sref} to {dref}")
+      size = f" ({self.buffers[dref[1].lower()].size} bytes)" if dref[0] == 'buffer' else ""
+      self.logger.info(f"{'Appended' if append else 'Copied'} from {sref} to {dref}{size}")
     elif command == CMD_CAT:
       args = self.visit_children(tree)
       ref = args[2]
@@ -668,6 +939,12 @@ class Repl(Interpreter):
       self._print(getcwd(), flush=True)
     elif command == CMD_VERSION:
       self._print(version(), flush=True)
+    elif command == CMD_STATS:
+      args = self.visit_children(tree)
+      if len(args) > 2:
+        self._print(json_dumps(self.stats.dump(), indent=2), flush=True)
+      else:
+        self._print(self.stats.table(), flush=True)
     elif command == CMD_PASTE:
       args = self.visit_children(tree)
       val = as_bool(args[2])
@@ -690,6 +967,7 @@ class Repl(Interpreter):
         ref = LocalReference(mimetype, url)
       assert ref is not None
       self.buffers[IN].append(ref)
+      self.prefetch.append(ref)
     else:
       raise ValueError(f"Unknown command: {command}")
 
@@ -724,13 +1002,15 @@ class Repl(Interpreter):
   def comment(self, tree):
     pass
 
-  def visit(self, tree):
+  def run(self, statements:Iterable[Tree]) -> None:
+    """ Interpret top-level statements as they are being parsed. """
     self.in_echo = 0
     try:
-      res = super().visit(tree)
+      for tree in statements:
+        self.logger.dbg(tree)
+        self.visit(tree)
     finally:
       self._finish_echo()
-    return res
 
 
 class ReplParser(Parser):
@@ -738,9 +1018,7 @@ class ReplParser(Parser):
     self.repl = repl
   def parse(self, chunk:str) -> ParsingResults:
     try:
-      tree = PARSER.parse(chunk)
-      self.repl.logger.dbg(tree)
-      self.repl.visit(tree)
+      self.repl.run(PARSER.statements(chunk))
     except InterpreterPause as p:
       return ParsingResults(chunk[p.unparsed:], p.utterance, p.recording, p.paste_mode)
     except (RuntimeWarning,) as e:
@@ -756,6 +1034,7 @@ class PasteModeReplParser(Parser):
     pattern = f'{CMD_PASTE} off'
     if (off_index := (chunk.index(pattern) if (pattern in chunk) else None)) is not None:
       bufferadd(self.repl.buffers[IN], chunk[:off_index])
+      self.repl.logger.info(f"Pasted {self.repl.buffers[IN].size} bytes")
       return ParsingResults(chunk[off_index + len(pattern):], None, paste_mode=False)
     else:
       bufferadd(self.repl.buffers[IN], chunk)
@@ -830,6 +1109,8 @@ class UserActor(Actor):
 
     self.file = file
     self.repl = Repl(self, self.logger)
+    self.deref_pool = ThreadPoolExecutor(max_workers=DEREF_WORKERS_DEF,
+                                         thread_name_prefix='deref')
     self.reset()
 
   def _complete(self, text:str, state:int) -> str|None:
@@ -898,38 +1179,77 @@ class UserActor(Actor):
     assert self.cnv_top <= len(cnv.utterances)
     if self.repl.opts is None:
       self.repl.opts = ast.get_desc()
+    skip = 0
     for i in range(self.cnv_top, len(cnv.utterances)):
       u:Utterance = cnv.utterances[i]
-      if u.actor_name != self.name:
+      self.cnv_top = i + 1 # An utterance failed to print is not printed again
+      if skip > 0:
+        skip -= 1
+      elif u.actor_name == self.name and u.intention.fanout is not None:
+        # Replies to a fan-out request directly follow the request
+        replies = cnv.utterances[i+1:i+1+len(u.intention.fanout)]
+        self._sync_fanout(replies)
+        skip = len(replies)
+      elif u.actor_name != self.name:
         need_eol = False
         buffer_out = []
         streams = {}
+        downloads:dict[Reference,Future] = {} # -> (local reference, stream, saved)
+        cancelled = Event()
 
         def _sigint(*args, **kwargs):
-          for s in streams.values():
+          for s in list(streams.values()):
             s.interrupt()
 
+        def _download(ref:Reference, name:ActorName) -> tuple[Reference, Stream, bool]:
+          # Will dereference a remote reference into a local reference
+          if cancelled.is_set():
+            raise ConversationException(f"Download of {ref2str(ref)} has been cancelled")
+          lref, sn = ast.deref(ref, name)
+          streams[lref] = sn
+          if cancelled.is_set():
+            sn.close()
+            raise ConversationException(f"Download of {ref2str(ref)} has been cancelled")
+          if sn.binary and not self.repl.rawbin:
+            assert sn.suggested_fname is not None, \
+              f"Suggested file name for binary stream must be set"
+            if isinstance(sn, BinStream):
+              sn.chunk_size = self.repl.chunk_size
+            if isinstance(sn, IterableStream):
+              sn.save(sn.suggested_fname, lref.mimetype, fsync=self.repl.fsync)
+            else:
+              with open(sn.suggested_fname, 'wb') as f:
+                for token2 in sn.gen():
+                  f.write(token2)
+            return lref, sn, True
+          return lref, sn, False
+
+        def _readahead(token:ContentItem) -> None:
+          # Start downloading the references as soon as they are read
+          if isinstance(token, RemoteReference) and token not in downloads:
+            downloads[token] = self.deref_pool.submit(_download, token, u.actor_name)
+
         def _printer(s:Stream, token:ContentItem) -> Stream|None:
           nonlocal need_eol
           streams[s.reference] = s
           stream2 = None
           if isinstance(token, bytes):
             need_eol = True
-            stdout.buffer.write(token)
-            stdout.buffer.flush()
+            sys.stdout.buffer.write(token)
+            sys.stdout.buffer.flush()
           elif isinstance(token, str):
             need_eol = not token.rstrip(' ').endswith("\n")
             self.repl._print(token, end='')
+          elif isinstance(token, LocalReference):
+            # The file has already been saved by the actor
+            need_eol = True
+            buffer_out.append(token.path)
+            self.repl._print(token.path, flush=True)
           elif isinstance(token, Reference):
-            # Will dereference a remote reference into a local reference
-            token, sn = ast.deref(token)
-            if sn.binary and not self.repl.rawbin:
+            future = downloads.get(token)
+            token, sn, saved = future.result() if future else _download(token)
+            if saved:
               need_eol = True
-              assert sn.suggested_fname is not None, \
-                f"Suggested file name for binary stream must be set"
-              with open(sn.suggested_fname, 'wb') as f:
-                for token2 in sn.gen():
-                  f.write(token2)
               self.logger.info("Binary stream has been saved to file")
               buffer_out.append(sn.suggested_fname)
               self.repl._print(f"{sn.suggested_fname}", flush=True)
@@ -938,17 +1258,101 @@ class UserActor(Actor):
           buffer_out.append(token)
           return stream2
 
-        with with_sigint(_sigint):
-          traverse_stream(u.contents, _printer)
-        self.repl.buffers[OUT] = buffer_out
+        # [1] - Stop the downloads started in advance if the printing has been interrupted or has
+        #       failed. Downloads registering their streams later see the flag.
+        # [2] - Close the connections of the downloaded streams nobody is going to read.
+        try:
+          with with_sigint(_sigint):
+            traverse_stream(u.contents, _printer, readahead=_readahead)
+        finally:
+          cancelled.set() # [1]
+          for future in downloads.values():
+            future.cancel()
+          _sigint()
+          for future in downloads.values():
+            if future.done() and not future.cancelled() and future.exception() is None:
+              _, sn, saved = future.result()
+              if not saved and sn.recording is None: # [2]
+                sn.close()
+        if u.contents is not None:
+          self.repl.stats.add(u.actor_name.repr(), u.contents.stats)
+        self.repl.buffers[OUT] = Buffer(buffer_out)
         if need_eol:
           self.repl._print()
         self.repl._print(flush=True, end='')
-      self.cnv_top += 1
+
+  def _sync_fanout(self, replies:list[Utterance]) -> None:
+    """ Read the replies to a fan-out request concurrently. Every reply is saved into the buffer
+    named after the model alias or the model name. The terminal shows complete lines of all the
+    replies as they arrive, prefixed with the buffer names. """
+    replies = [u for u in replies if not u.is_empty()] # Failed actors have nothing to say
+    names = [fanout_buffer(u.actor_name) for u in replies]
+    events:Queue = Queue()
+
+    def _read(name:str, s:Stream):
+      try:
+        for token in s.gen():
+          events.put((name, token))
+      except Exception as e:
+        events.put((name, e))
+      finally:
+        events.put((name, None))
+
+    def _sigint(*args, **kwargs):
+      for u in replies:
+        u.contents.interrupt()
+
+    def _print(name:str, line:str):
+      line = f"[{name}] {line}\n"
+      buffer_out.append(line)
+      self.repl._print(line, end='', flush=True)
+
+    buffer_out = []
+    contents:dict[str,Buffer] = {n:Buffer() for n in names}
+    lines:dict[str,str] = {n:'' for n in names}
+    with with_sigint(_sigint):
+      for name, u in zip(names, replies):
+        Thread(target=_read, args=(name, u.contents), daemon=True).start()
+      active = len(replies)
+      while active > 0:
+        name, token = events.get()
+        if token is None:
+          active -= 1
+          if len(lines[name]) > 0:
+            _print(name, lines[name])
+            lines[name] = ''
+        elif isinstance(token, Exception):
+          self.logger.warn(f"{name}: {token}")
+        elif isinstance(token, str):
+          bufferadd(contents[name], token)
+          *complete, lines[name] = (lines[name] + token).split('\n')
+          for line in complete:
+            _print(name, line)
+        else:
+          contents[name].append(token)
+          _print(name, ref2str(token) if isinstance(token, Reference) else "<binary data>")
+    for name, u in zip(names, replies):
+      self.repl.buffers[name] = contents[name]
+      if u.contents is not None:
+        self.repl.stats.add(u.actor_name.repr(), u.contents.stats)
+    self.repl.buffers[OUT] = Buffer(buffer_out)
+    self.logger.info(f"Replies were saved to buffers {', '.join(names)}")
 
   def reset(self):
     self.cnv_top = 0
 
+  def _prefetch(self, av:ActorState) -> None:
+    """ Let the target actor start fetching the references added since the last call. """
+    refs, self.repl.prefetch = self.repl.prefetch, []
+    if self.repl.actor_next is not None:
+      for ref in refs:
+        av.prefetch(self.repl.actor_next, ref)
+
+  async def areact(self, av:ActorState, cnv:Conversation) -> Utterance:
+    """ The user actor reads the terminal and relies on Ctrl+C raising KeyboardInterrupt, so it
+    reacts in the loop thread. """
+    return self.react(av, cnv)
+
   def react(self, av:ActorState, cnv:Conversation) -> Utterance:
     # FIMXE: A minor problem here in the paste_mode [1]: interpreter eats the
     # input first, and handles the paste mode after that. It should raise
@@ -960,6 +1364,7 @@ class UserActor(Actor):
 
     while True:
       eof, pres = self.file.process(parser, prompt=self.repl.readline_prompt)
+      self._prefetch(av)
       if (paste_mode := pres.paste_mode) is not None:
         parser = paste_parser if paste_mode else normal_parser
       if eof:
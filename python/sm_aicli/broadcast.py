@@ -0,0 +1,152 @@
+""" Broadcasting of a token stream to several subscribers. Tokens are stored once, in a ring buffer
+shared by all the subscribers, and every subscriber reads it at its own pace. The subscriber that
+reaches the end of the buffer pulls the next token from the source, so there is no producer thread.
+Slow subscribers, like a file on a network mount, lag behind without stalling the others until the
+buffer holds `capacity` bytes, after which the source is not read until the slowest subscriber
+catches up. Following subscribers never read the source themselves, they only receive the tokens
+pulled by the leading ones and stop once the last leading subscriber is closed. """
+
+from collections import deque
+from threading import Condition, Thread
+from time import perf_counter
+from typing import Iterable, Iterator, Callable
+
+from .types import ContentItem
+
+CAPACITY_DEF = 1024*1024
+
+_END = object()
+
+def _size(token:ContentItem) -> int:
+  return len(token) if isinstance(token, (str, bytes)) else 1
+
+
+class Subscription:
+  """ An iterator over the tokens of a `Broadcast`. Should be closed if abandoned before the end,
+  otherwise it would hold the ring buffer. """
+  def __init__(self, broadcast:'Broadcast', pos:int, follow:bool=False):
+    self.broadcast = broadcast
+    self.pos = pos
+    self.follow = follow    # Never read the source, see `Broadcast`
+
+  def __iter__(self) -> Iterator[ContentItem]:
+    try:
+      while (token := self.broadcast._next(self)) is not _END:
+        yield token
+    finally:
+      self.close()
+
+  def close(self) -> None:
+    self.broadcast._unsubscribe(self)
+
+
+class Broadcast:
+  def __init__(self, source:Iterable[ContentItem], capacity:int=CAPACITY_DEF):
+    self.source = iter(source)
+    self.capacity = capacity
+    self.ring:deque[ContentItem] = deque()
+    self.base:int = 0                  # Position of the first token of the ring
+    self.nbytes:int = 0                # Size of the tokens in the ring
+    self.subs:list[Subscription] = []
+    self.pulling:bool = False          # A subscriber is reading the source
+    self.done:bool = False             # The source is exhausted or the broadcast is closed
+    self.completed:bool = False        # The source is exhausted
+    self.error:BaseException|None = None
+    self.sinks:list[Thread] = []
+    self.cond = Condition()
+
+  def subscribe(self, follow:bool=False) -> Subscription:
+    """ Subscribe to the tokens starting from the oldest one still in the buffer. """
+    with self.cond:
+      sub = Subscription(self, self.base, follow)
+      self.subs.append(sub)
+      return sub
+
+  def sink(self, fn:Callable[[ContentItem],None],
+           end_fn:Callable[[],None]|None=None, follow:bool=False) -> Thread:
+    """ Call `fn` for every token in a separate thread. Call `end_fn` after the last token if the
+    source has been read to its end. """
+    sub = self.subscribe(follow)
+    def _run():
+      try:
+        for token in sub:
+          fn(token)
+      except BaseException:
+        return # The error is reported to the other subscribers
+      if end_fn is not None and self.completed:
+        end_fn()
+    thread = Thread(target=_run, daemon=True)
+    self.sinks.append(thread)
+    thread.start()
+    return thread
+
+  def close(self) -> None:
+    """ Stop reading the source. Subscribers receive the tokens already buffered. """
+    with self.cond:
+      self.done = True
+      self.cond.notify_all()
+
+  def join(self, timeout:float|None=None) -> bool:
+    """ Wait for the sinks to process their tokens, at most `timeout` seconds in total. Return
+    False if some of the sinks are still running. """
+    deadline = None if timeout is None else perf_counter() + timeout
+    for thread in self.sinks:
+      thread.join(None if deadline is None else max(0, deadline - perf_counter()))
+    return not any(thread.is_alive() for thread in self.sinks)
+
+  def _tail(self) -> int:
+    return self.base + len(self.ring)
+
+  def _trim(self) -> None:
+    low = min((s.pos for s in self.subs), default=self._tail())
+    while self.base < low:
+      self.nbytes -= _size(self.ring.popleft())
+      self.base += 1
+
+  def _unsubscribe(self, sub:Subscription) -> None:
+    # [1] - Nobody is going to read the source for the followers.
+    with self.cond:
+      if sub in self.subs:
+        self.subs.remove(sub)
+        if not sub.follow and all(s.follow for s in self.subs):
+          self.done = True # [1]
+        self._trim()
+        self.cond.notify_all()
+
+  def _next(self, sub:Subscription) -> ContentItem|object:
+    # [1] - The buffer is full, wait for the lagging subscribers to move on.
+    # [2] - Read the source without holding the lock, so that other subscribers keep reading.
+    while True:
+      with self.cond:
+        while True:
+          if sub.pos < self._tail():
+            token = self.ring[sub.pos - self.base]
+            sub.pos += 1
+            if sub.pos - 1 == self.base:
+              self._trim()
+              self.cond.notify_all()
+            return token
+          if self.done:
+            if self.error is not None:
+              raise self.error
+            return _END
+          if not self.pulling and not sub.follow:
+            if self.nbytes < self.capacity or self.base == self._tail():
+              self.pulling = True
+              break
+          self.cond.wait() # [1]
+      error = None
+      try:
+        token = next(self.source, _END) # [2]
+      except BaseException as e:
+        token, error = _END, e
+      with self.cond:
+        self.pulling = False
+        if token is _END:
+          self.done = True
+          self.completed = error is None
+          self.error = error
+        elif not self.done:
+          self.ring.append(token)
+          self.nbytes += _size(token)
+        self.cond.notify_all()
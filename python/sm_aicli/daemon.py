@@ -0,0 +1,258 @@
+""" A daemon mode of aicli. The daemon keeps the interpreter, the parser and the loaded models warm
+and runs client sessions one after another in the same process. Clients forward their command
+line, working directory and the environment variables aicli uses, and then exchange frames with
+the daemon: the daemon sends stdout/stderr chunks and asks for input lines, the client reads its
+stdin on request. The environment may contain API keys, so both sides check that the other one
+runs as the same user, and the default socket lives in a directory only the user can access.
+
+A frame is a one-byte kind followed by a 4-byte big-endian payload length and the payload. """
+
+import sys
+from io import TextIOBase, RawIOBase
+from json import loads as json_loads, dumps as json_dumps
+from os import environ, getcwd, chdir, unlink, umask, mkdir, lstat, getuid
+from os.path import join, exists, dirname
+from socket import socket, AF_UNIX, SOCK_STREAM, SOL_SOCKET
+from stat import S_ISDIR, S_ISSOCK
+from struct import Struct, calcsize, unpack
+from tempfile import gettempdir
+from traceback import print_exc
+from typing import Callable, BinaryIO
+try:
+  from socket import SO_PEERCRED
+except ImportError: # Not Linux
+  SO_PEERCRED = None
+
+from .utils import info, err
+
+FRAME = Struct('!cI')
+ARGS = b'A'     # Client -> daemon: JSON with `argv`, `cwd` and `env`
+STDOUT = b'O'   # Daemon -> client: stdout chunk
+STDERR = b'E'   # Daemon -> client: stderr chunk
+READ = b'R'     # Daemon -> client: request for the next input line
+INPUT = b'I'    # Client -> daemon: input line, empty payload means EOF
+EXIT = b'X'     # Daemon -> client: exit code of the session
+
+# Environment variables forwarded to the daemon: the ones read by aicli, the provider SDKs, the
+# HTTP transport and the shell commands.
+ENV_NAMES = ['HOME', 'PATH', 'USER', 'SHELL', 'TERM', 'LANG', 'TMPDIR', 'EDITOR', 'SSL_CERT_FILE',
+             'SSL_CERT_DIR', 'HTTP_PROXY', 'HTTPS_PROXY', 'ALL_PROXY', 'NO_PROXY']
+ENV_PREFIXES = ['AICLI_', 'OPENAI_', 'XDG_', 'LC_']
+
+def client_env() -> dict[str,str]:
+  """ Return the part of the environment to forward to the daemon. """
+  return {k:v for k, v in environ.items()
+          if k.upper() in ENV_NAMES or any(k.startswith(p) for p in ENV_PREFIXES)}
+
+def default_socket() -> str:
+  """ Return the socket path set by `AICLI_SOCKET`, defaulting to `$XDG_RUNTIME_DIR/aicli.sock` or
+  to a private directory in the temporary directory. """
+  if path := environ.get('AICLI_SOCKET'):
+    return path
+  if rundir := environ.get('XDG_RUNTIME_DIR'):
+    return join(rundir, 'aicli.sock')
+  return join(_tmp_socket_dir(), 'aicli.sock')
+
+def _tmp_socket_dir() -> str:
+  return join(gettempdir(), f"aicli-{getuid()}")
+
+def private_dir(path:str) -> None:
+  """ Create the directory `path` accessible by the current user only, or check that the existing
+  one is such. """
+  try:
+    mkdir(path, 0o700)
+  except FileExistsError:
+    pass
+  st = lstat(path)
+  if not S_ISDIR(st.st_mode) or st.st_uid != getuid() or (st.st_mode & 0o077) != 0:
+    raise PermissionError(f"Directory {path} should be owned and accessible by the current user only")
+
+def peer_uid(sock:socket) -> int|None:
+  """ Return the user id of the process at the other end of the socket, or None if the platform
+  does not tell it. """
+  if SO_PEERCRED is None:
+    return None
+  try:
+    creds = sock.getsockopt(SOL_SOCKET, SO_PEERCRED, calcsize('3i'))
+  except OSError:
+    return None
+  return unpack('3i', creds)[1]
+
+def _check_peer(sock:socket) -> None:
+  uid = peer_uid(sock)
+  if uid is not None and uid != getuid():
+    raise PermissionError(f"The peer runs as user {uid}, not as the current user")
+
+def send_frame(sock:socket, kind:bytes, payload:bytes=b'') -> None:
+  sock.sendall(FRAME.pack(kind, len(payload)) + payload)
+
+def recv_frame(f:BinaryIO) -> tuple[bytes, bytes]:
+  header = f.read(FRAME.size)
+  if len(header) < FRAME.size:
+    raise ConnectionError("Connection closed")
+  kind, size = FRAME.unpack(header)
+  payload = f.read(size)
+  if len(payload) < size:
+    raise ConnectionError("Connection closed")
+  return kind, payload
+
+
+class _BinaryOut(RawIOBase):
+  def __init__(self, sock:socket, kind:bytes):
+    self.sock = sock
+    self.kind = kind
+  def writable(self):
+    return True
+  def write(self, b) -> int:
+    send_frame(self.sock, self.kind, bytes(b))
+    return len(b)
+
+
+class SocketOut(TextIOBase):
+  """ Text output stream forwarding the written text to the client """
+  def __init__(self, sock:socket, kind:bytes):
+    self.buffer = _BinaryOut(sock, kind)
+  @property
+  def encoding(self):
+    return 'utf-8'
+  def writable(self):
+    return True
+  def write(self, s:str) -> int:
+    if len(s) > 0:
+      self.buffer.write(s.encode('utf-8'))
+    return len(s)
+
+
+class SocketIn(TextIOBase):
+  """ Text input stream reading lines from the client on demand """
+  def __init__(self, sock:socket, f:BinaryIO):
+    self.sock = sock
+    self.f = f
+  @property
+  def encoding(self):
+    return 'utf-8'
+  def readable(self):
+    return True
+  def readline(self, size=-1) -> str:
+    send_frame(self.sock, READ)
+    kind, payload = recv_frame(self.f)
+    if kind != INPUT:
+      raise ConnectionError(f"Unexpected frame kind {kind!r}")
+    return payload.decode('utf-8')
+
+
+def _session(conn:socket, main_fn:Callable[[list[str]], int|None]) -> None:
+  """ Run one client session with the standard streams, the working directory and the environment
+  of the client. """
+  f = conn.makefile('rb')
+  kind, payload = recv_frame(f)
+  if kind != ARGS:
+    raise ConnectionError(f"Unexpected frame kind {kind!r}")
+  req = json_loads(payload)
+  saved = (sys.stdin, sys.stdout, sys.stderr, getcwd(), dict(environ))
+  ret:int|None = 1
+  try:
+    environ.clear()
+    environ.update(req['env'])
+    chdir(req['cwd'])
+    sys.stdin = SocketIn(conn, f)
+    sys.stdout = SocketOut(conn, STDOUT)
+    sys.stderr = SocketOut(conn, STDERR)
+    try:
+      ret = main_fn(req['argv'])
+    except SystemExit as e:
+      ret = e.code if isinstance(e.code, int) else 1
+    except ConnectionError:
+      raise
+    except Exception:
+      print_exc()
+  finally:
+    sys.stdin, sys.stdout, sys.stderr = saved[:3]
+    chdir(saved[3])
+    environ.clear()
+    environ.update(saved[4])
+  send_frame(conn, EXIT, str(ret or 0).encode())
+
+
+def serve(path:str, main_fn:Callable[[list[str]], int|None]) -> int:
+  """ Listen on the Unix socket `path` and run client sessions with `main_fn`. Refuse to start if
+  another daemon is listening on `path`. """
+  # [1] - A socket is left by a daemon which has not exited cleanly.
+  # [2] - The socket is created with the user-only permissions.
+  try:
+    if dirname(path) == _tmp_socket_dir():
+      private_dir(dirname(path))
+    if exists(path):
+      if not S_ISSOCK(lstat(path).st_mode):
+        raise PermissionError(f"{path} exists and is not a socket")
+      with socket(AF_UNIX, SOCK_STREAM) as probe:
+        try:
+          probe.connect(path)
+          err(f"Another daemon is listening on {path}")
+          return 1
+        except OSError:
+          unlink(path) # [1]
+  except PermissionError as e:
+    err(str(e))
+    return 1
+  sock = socket(AF_UNIX, SOCK_STREAM)
+  bound = False
+  try:
+    mask = umask(0o177) # [2]
+    try:
+      sock.bind(path)
+      bound = True
+    finally:
+      umask(mask)
+    sock.listen()
+    info(f"Listening on {path}")
+    while True:
+      conn, _ = sock.accept()
+      with conn:
+        try:
+          _check_peer(conn)
+          _session(conn, main_fn)
+        except (ConnectionError, PermissionError) as e:
+          err(f"Client session aborted: {e}")
+  except KeyboardInterrupt:
+    return 0
+  finally:
+    sock.close()
+    if bound and exists(path):
+      unlink(path)
+
+
+def connect(path:str, argv:list[str]) -> int|None:
+  """ Run a session with the `argv` command line in the daemon listening on `path`. Return the
+  session exit code or None if the daemon is not available. """
+  # [1] - The environment is only sent to a daemon of the current user.
+  sock = socket(AF_UNIX, SOCK_STREAM)
+  try:
+    if dirname(path) == _tmp_socket_dir():
+      private_dir(dirname(path))
+    st = lstat(path)
+    if not S_ISSOCK(st.st_mode) or st.st_uid != getuid(): # [1]
+      raise PermissionError(f"{path} is not a socket of the current user")
+    sock.connect(path)
+    _check_peer(sock) # [1]
+  except OSError as e:
+    sock.close()
+    info(f"Daemon is not available at {path} ({e})")
+    return None
+  with sock:
+    send_frame(sock, ARGS, json_dumps({'argv':argv, 'cwd':getcwd(), 'env':client_env()}).encode())
+    f = sock.makefile('rb')
+    while True:
+      kind, payload = recv_frame(f)
+      if kind == STDOUT:
+        sys.stdout.buffer.write(payload)
+        sys.stdout.buffer.flush()
+      elif kind == STDERR:
+        sys.stderr.buffer.write(payload)
+        sys.stderr.buffer.flush()
+      elif kind == READ:
+        send_frame(sock, INPUT, sys.stdin.readline().encode('utf-8'))
+      elif kind == EXIT:
+        return int(payload)
+      else:
+        raise ConnectionError(f"Unexpected frame kind {kind!r}")
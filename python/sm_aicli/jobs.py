@@ -0,0 +1,100 @@
+""" Parallel batch mode of aicli. Every script file runs as an isolated aicli session in a separate
+process, so sessions share neither buffers, nor recorders, nor the working directory. """
+
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from os import environ, makedirs
+from os.path import abspath, basename, dirname, join, splitext
+from subprocess import run, PIPE, DEVNULL
+from time import perf_counter
+from typing import Any
+
+# The directory containing the `sm_aicli` package
+PYDIR = dirname(dirname(abspath(__file__)))
+
+@dataclass
+class JobResult:
+  filename:str
+  returncode:int
+  elapsed:float
+  stdout:str
+  stderr:str
+  cwd:str|None = None
+
+
+def job_argv(args:Any) -> list[str]:
+  """ Command-line options of a job, derived from the options of the batch. Paths are made
+  absolute since jobs might run in their own directories. """
+  acc = ['--rc', args.rc]
+  for opt, val in [('--model', args.model),
+                   ('--model-apikey', args.model_apikey),
+                   ('--model-temperature', args.model_temperature),
+                   ('--model-dir', args.model_dir and abspath(args.model_dir)),
+                   ('--image-dir', args.image_dir and abspath(args.image_dir)),
+                   ('--num-threads', args.num_threads),
+                   ('--device', args.device),
+                   ('--readline-prompt', args.readline_prompt),
+                   ('--spill-threshold', args.spill_threshold),
+                   ('--verbose', args.verbose)]:
+    if val is not None:
+      acc.extend([opt, str(val)])
+  return acc
+
+
+def job_dirs(jobs_dir:str, filenames:list[str]) -> list[str]:
+  """ Allocate a working directory for every file, named after the file. """
+  acc, used = [], set()
+  for i, fn in enumerate(filenames):
+    name = splitext(basename(fn))[0]
+    name = name if name not in used else f"{name}-{i}"
+    used.add(name)
+    acc.append(join(jobs_dir, name))
+    makedirs(acc[-1], exist_ok=True)
+  return acc
+
+
+def run_job(argv:list[str], filename:str, cwd:str|None) -> JobResult:
+  env = dict(environ)
+  env.pop('AICLI_CWD', None)
+  env['PYTHONPATH'] = PYDIR + ((':' + env['PYTHONPATH']) if env.get('PYTHONPATH') else '')
+  t0 = perf_counter()
+  res = run([sys.executable, '-m', 'sm_aicli'] + argv + [abspath(filename)], cwd=cwd, env=env,
+            stdin=DEVNULL, stdout=PIPE, stderr=PIPE, text=True)
+  result = JobResult(filename, res.returncode, perf_counter() - t0, res.stdout, res.stderr, cwd)
+  if cwd is not None:
+    for name, text in [('stdout.txt', res.stdout), ('stderr.txt', res.stderr)]:
+      with open(join(cwd, name), 'w') as f:
+        f.write(text)
+  return result
+
+
+def run_jobs(args:Any, jobs:int, jobs_dir:str|None=None) -> int:
+  """ Run every file of `args.filenames` as a separate session using a pool of `jobs` workers.
+  Print the outputs as the sessions complete, followed by a summary. Return non-zero if any of
+  the sessions failed. """
+  argv = job_argv(args)
+  filenames = args.filenames
+  cwds = job_dirs(jobs_dir, filenames) if jobs_dir is not None else [None]*len(filenames)
+  results:list[JobResult|None] = [None]*len(filenames)
+  t0 = perf_counter()
+  with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+    futures = {pool.submit(run_job, argv, fn, cwd):i
+               for i, (fn, cwd) in enumerate(zip(filenames, cwds))}
+    for future in as_completed(futures):
+      r = results[futures[future]] = future.result()
+      print(f"==> {r.filename} <==", flush=True)
+      sys.stdout.write(r.stdout)
+      sys.stdout.flush()
+      sys.stderr.write(r.stderr)
+      sys.stderr.flush()
+  wall = perf_counter() - t0
+
+  width = max(len(r.filename) for r in results)
+  failed = [r for r in results if r.returncode != 0]
+  print(f"\n{'FILE':{width}s} {'EXIT':>5s} {'TIME,s':>8s}")
+  for r in results:
+    print(f"{r.filename:{width}s} {r.returncode:5d} {r.elapsed:8.2f}")
+  print(f"{len(results)} files, {len(failed)} failed, wall time {wall:.2f}s, "
+        f"total time {sum(r.elapsed for r in results):.2f}s", flush=True)
+  return 1 if failed else 0
@@ -4,27 +4,28 @@ from os.path import expanduser, abspath
 from os import chdir, environ, getcwd
 from contextlib import contextmanager
 from signal import signal, SIGINT
+import sys
 from sys import _getframe
 from pdb import Pdb
 from argparse import ArgumentParser
-from typing import Any
+from typing import Any, Callable
 from functools import partial
 from dataclasses import dataclass
+from asyncio import new_event_loop, gather, ensure_future, get_running_loop, CancelledError
 from copy import deepcopy
 from gnureadline import (parse_and_bind, clear_history, read_history_file,
                          write_history_file, set_completer, set_completer_delims)
-from requests import get as requests_get
-
-from lark.visitors import Interpreter
-from lark import Lark
 
 from sm_aicli import (Actor, Conversation, ActorState, ActorName, Utterance, UserName, Modality,
-                      UserActor, ActorOptions, onematch, expanddir, OpenAIImageActor,
-                      OpenAITextActor, GPT4AllActor, DummyActor, Reference, RemoteReference,
-                      LocalReference, Stream, info, err, with_sigint, args2script, File, Parser,
-                      read_configs, ParsingResults, RecordingParams, Recorder, UserRecorder)
+                      Intention, UserActor, ActorOptions, onematch, expanddir, Reference,
+                      RemoteReference, LocalReference, Stream, info, warn, err, with_sigint,
+                      args2script, File, Parser, read_configs, ParsingResults, RecordingParams,
+                      Recorder, UserRecorder)
 
-from .utils import version, REVISION, url2fname, BinStream
+from .utils import version, revision, url2fname, BinStream, SpillPolicy
+from .daemon import serve, connect, default_socket
+from .jobs import run_jobs
+from .transport import http_client
 
 ARG_PARSER = ArgumentParser(description="Command-line arguments")
 ARG_PARSER.add_argument(
@@ -119,8 +120,49 @@ ARG_PARSER.add_argument(
 ARG_PARSER.add_argument(
   '-C', '--cd',
   type=str,
-  help="Change to this directory before execution",
-  default=environ.get('AICLI_CWD'),
+  help="Change to this directory before execution (default: $AICLI_CWD)",
+  default=None,
+)
+ARG_PARSER.add_argument(
+  '--daemon',
+  action='store_true',
+  help="Serve aicli sessions over a Unix socket, keeping the loaded models warm",
+)
+ARG_PARSER.add_argument(
+  '--connect',
+  action='store_true',
+  help="Run the session in the aicli daemon, fall back to running it locally if the daemon is "
+       "not available",
+)
+ARG_PARSER.add_argument(
+  '--socket',
+  type=str,
+  metavar='FILE',
+  help="Unix socket of the aicli daemon (default: $AICLI_SOCKET, $XDG_RUNTIME_DIR/aicli.sock or "
+       "$TMPDIR/aicli-$UID/aicli.sock)",
+  default=None,
+)
+ARG_PARSER.add_argument(
+  '-j', '--jobs',
+  type=int,
+  metavar='N',
+  help="Run every file as a separate session, using N parallel workers",
+  default=None,
+)
+ARG_PARSER.add_argument(
+  '--jobs-dir',
+  type=str,
+  metavar='DIR',
+  help="Run every --jobs session in its own subdirectory of DIR, saving its output there",
+  default=None,
+)
+ARG_PARSER.add_argument(
+  '--spill-threshold',
+  type=float,
+  metavar='MB',
+  help="Move recordings of old utterances to a temporary file once they take more than MB "
+       "megabytes of memory, 0 disables (default: %(default)s)",
+  default=256,
 )
 ARG_PARSER.add_argument(
   'filenames',
@@ -212,11 +254,18 @@ class ActorStateImpl(ActorState):
   def get_desc(self) -> dict[ActorName, ActorOptions]:
     return {n:deepcopy(a.get_options()) for n,a in self.actors.items()}
 
-  def deref(self, ref:Reference) -> tuple[Reference, Stream]:
+  def prefetch(self, name:ActorName, ref:Reference) -> None:
+    if (actor := self.actors.get(name)) is not None:
+      actor.prefetch(ref)
+
+  def deref(self, ref:Reference, name:ActorName|None=None) -> tuple[Reference, Stream]:
+    # [1] - Remote images go to the same directory as the inline images of the actor.
     if isinstance(ref, RemoteReference):
-      url_response = requests_get(ref.url, stream=True)
+      client = http_client()
+      url_response = client.send(client.build_request('GET', ref.url), stream=True)
       url_response.raise_for_status()  # Check for HTTP errors
-      filename = url2fname(ref.url, self.actors[UserName()].opt.image_dir)
+      actor = self.actors.get(name) or self.actors[UserName()] # [1]
+      filename = url2fname(ref.url, actor.opt.image_dir)
       lref = LocalReference(ref.mimetype, filename)
       return lref, BinStream(url_response, suggested_fname=filename)
     else:
@@ -227,24 +276,169 @@ class ActorStateImpl(ActorState):
     return ActorStateImpl({})
 
 
+def _openai_actor(name:ActorName, opt:ActorOptions, file:File, recorder:Recorder) -> Actor:
+  from .actor.openai import OpenAIImageActor, OpenAITextActor
+  if 'dall' in name.model:
+    return OpenAIImageActor(name, opt, file=file)
+  else:
+    return OpenAITextActor(name, opt, file=file, recorder=recorder)
+
+def _gpt4all_actor(name:ActorName, opt:ActorOptions, file:File, recorder:Recorder) -> Actor:
+  from .actor.gpt4all import GPT4AllActor
+  return GPT4AllActor(name, opt)
+
+def _dummy_actor(name:ActorName, opt:ActorOptions, file:File, recorder:Recorder) -> Actor:
+  from .actor.dummy import DummyActor
+  return DummyActor(name, opt, file)
+
+# Provider name -> actor constructor. Constructors import their provider modules (and hence the
+# provider SDKs) on the first use only.
+ACTOR_PROVIDERS:dict[str, Callable[[ActorName, ActorOptions, File, Recorder], Actor]] = {
+  "openai": _openai_actor,
+  "gpt4all": _gpt4all_actor,
+  "dummy": _dummy_actor,
+}
+
 def actor_factory(name:ActorName, opt:ActorOptions, file:File, recorder:Recorder) -> Actor:
-  match name.provider:
-    case "openai":
-      if 'dall' in name.model:
-        return OpenAIImageActor(name, opt, file=file)
-      else:
-        return OpenAITextActor(name, opt, file=file, recorder=recorder)
-    case "gpt4all":
-      return GPT4AllActor(name, opt)
-    case "dummy":
-      return DummyActor(name, opt, file)
-    case _:
-      raise ValueError(f"Unsupported actor name \"{name}\"")
+  provider = ACTOR_PROVIDERS.get(name.provider)
+  if provider is None:
+    raise ValueError(f"Unsupported actor name \"{name}\"")
+  return provider(name, opt, file, recorder)
+
+
+async def interruptible(aw) -> Any:
+  """ Await `aw` so that Ctrl+C cancels it and raises KeyboardInterrupt in the awaiting coroutine.
+  Without this, a KeyboardInterrupt raised while the loop waits for a worker thread would escape
+  the loop. The threads themselves are not interrupted, their results are dropped. """
+  loop = get_running_loop()
+  task = ensure_future(aw)
+  interrupted = False
+  def _handler() -> None:
+    nonlocal interrupted
+    interrupted = True
+    task.cancel()
+  try:
+    loop.add_signal_handler(SIGINT, _handler)
+  except (ValueError, RuntimeError): # Not the main thread
+    return await task
+  try:
+    return await task
+  except CancelledError:
+    if interrupted:
+      raise KeyboardInterrupt() from None
+    raise
+  finally:
+    loop.remove_signal_handler(SIGINT)
+
+
+async def fanout(st:ActorStateImpl, cnv:Conversation, names:list[ActorName]) -> list[Utterance]:
+  """ Ask several actors to react to the last utterance at once. Actors implementing only the
+  synchronous protocol react in worker threads. Failed actors are reported and reply with empty
+  utterances, so that the replies still match the request. """
+  # [1] - Read the request once so that the actors could share its recording.
+  # [2] - Replaying actors read their replies from the shared input file, so they react in the
+  #       loop thread, one after another.
+  # [3] - Build the index before the threads start, so that their lookups only read it.
+  if (contents := cnv.utterances[-1].contents) is not None:
+    for _ in contents.gen(): # [1]
+      pass
+  cnv.index.sync() # [3]
+  async def _react(actor:Actor) -> Utterance:
+    if actor.get_options().replay and type(actor).areact is Actor.areact: # [2]
+      return actor.react(st, cnv)
+    return await actor.areact(st, cnv)
+  replies = []
+  for name, res in zip(names, await gather(*[_react(st.actors[n]) for n in names],
+                                           return_exceptions=True)):
+    if isinstance(res, Utterance):
+      replies.append(res)
+    elif isinstance(res, Exception):
+      warn(f"{name.repr()}: {res}", st.actors[UserName()])
+      replies.append(Utterance.init(name, Intention.init(actor_next=UserName())))
+    else:
+      raise res
+  return replies
+
+
+async def converse(st:ActorStateImpl, user:UserActor, file:StdinFile, recorder:Recorder,
+                   actor_factory_fn, spill:SpillPolicy|None=None) -> None:
+  """ Run the conversation loop: ask the current actor to react, apply its intention, repeat until
+  an actor requests the exit. """
+  # [1] - Other actors may react in worker threads, see `interruptible`.
+  cnv = Conversation.init()
+  current_actor = UserName()
+  current_modality = Modality.Text
+  while True:
+    try:
+      if spill is not None and (nbytes := spill.update(cnv)) > 0:
+        user.logger.dbg(f"Spilled {nbytes} bytes of old recordings to disk")
+      actor = st.actors[current_actor]
+      reaction = actor.areact(st, cnv)
+      utterance = await (reaction if actor is user else interruptible(reaction)) # [1]
+      assert utterance.actor_name == st.actors[current_actor].name, (
+        f"{current_actor}: {utterance.actor_name} != {st.actors[current_actor].name}"
+      )
+      cnv.utterances.append(utterance)
+      intention = utterance.intention
+      if intention.dbg_flag:
+        user.logger.info("Type `cont` to continue when done")
+        Pdb(nosigint=True).set_trace(_getframe())
+        file._reload_history()
+      if intention.actor_updates is not None:
+        for name, opt in intention.actor_updates.items():
+          actor = st.actors.get(name)
+          if actor is not None:
+            actor.set_options(opt)
+          else:
+            st.actors[name] = actor_factory_fn(name, opt, file=file, recorder=recorder)
+      if intention.fanout is not None:
+        cnv.utterances.extend(await interruptible(fanout(st, cnv, intention.fanout))) # [1]
+      if intention.actor_next is not None:
+        assert intention.actor_next in st.actors, (
+          f"{intention.actor_next} is not among {st.actors.keys()}"
+        )
+        current_actor = intention.actor_next
+      if intention.reset_flag:
+        cnv = Conversation.init()
+        for a in st.actors.values():
+          a.reset()
+      if intention.exit_flag:
+        break
+    except KeyboardInterrupt:
+      info("^C", user, prefix=False)
+      current_actor = UserName()
+      current_modality = Modality.Text
+    except NotImplementedError as e:
+      err("<Not implemented>", user)
+      current_actor = UserName()
+      current_modality = Modality.Text
+    except ValueError as e:
+      err(e, user)
+      current_actor = UserName()
+      current_modality = Modality.Text
+
+
+def run_async(coro) -> Any:
+  """ Run the coroutine in a new event loop. Unlike `asyncio.run`, no SIGINT handler is installed,
+  so Ctrl+C raises KeyboardInterrupt in the code being executed, as the conversation loop
+  expects. """
+  loop = new_event_loop()
+  try:
+    return loop.run_until_complete(coro)
+  finally:
+    loop.close()
 
 
 def main(cmdline=None, actor_factory_fn=None):
   args = ARG_PARSER.parse_args(cmdline)
   actor_factory_fn = actor_factory_fn or actor_factory
+  args.cd = args.cd or environ.get('AICLI_CWD')
+
+  if args.connect:
+    argv = [a for a in (sys.argv[1:] if cmdline is None else cmdline) if a != '--connect']
+    ret = connect(args.socket or default_socket(), argv)
+    if ret is not None:
+      return ret
 
   if args.cd:
     chdir(args.cd)
@@ -254,9 +448,15 @@ def main(cmdline=None, actor_factory_fn=None):
     if args.version:
       print(version())
     if args.revision:
-      print(REVISION)
+      print(revision())
     return 0
 
+  if args.daemon:
+    return serve(args.socket or default_socket(), partial(main, actor_factory_fn=actor_factory_fn))
+
+  if args.jobs is not None and len(args.filenames) > 0:
+    return run_jobs(args, args.jobs, args.jobs_dir)
+
   if args.readline_history is None:
     args.readline_history = environ.get("AICLI_HISTORY")
   if args.readline_history is not None:
@@ -274,54 +474,10 @@ def main(cmdline=None, actor_factory_fn=None):
     script = args2script(args, configs)
     file = StdinFile(args, script, recorder=recorder)
 
-    cnv = Conversation.init()
     st = ActorStateImpl.init()
-    current_actor = UserName()
-    current_modality = Modality.Text
     user = UserActor(UserName(), ActorOptions.init(), args, file)
-    st.actors[current_actor] = user
-
-    while True:
-      try:
-        utterance = st.actors[current_actor].react(st, cnv)
-        assert utterance.actor_name == st.actors[current_actor].name, (
-          f"{current_actor}: {utterance.actor_name} != {st.actors[current_actor].name}"
-        )
-        cnv.utterances.append(utterance)
-        intention = utterance.intention
-        if intention.dbg_flag:
-          user.logger.info("Type `cont` to continue when done")
-          Pdb(nosigint=True).set_trace(_getframe())
-          file._reload_history()
-        if intention.actor_updates is not None:
-          for name, opt in intention.actor_updates.items():
-            actor = st.actors.get(name)
-            if actor is not None:
-              actor.set_options(opt)
-            else:
-              st.actors[name] = actor_factory_fn(name, opt, file=file, recorder=recorder)
-        if intention.actor_next is not None:
-          assert intention.actor_next in st.actors, (
-            f"{intention.actor_next} is not among {st.actors.keys()}"
-          )
-          current_actor = intention.actor_next
-        if intention.reset_flag:
-          cnv = Conversation.init()
-          for a in st.actors.values():
-            a.reset()
-        if intention.exit_flag:
-          break
-      except KeyboardInterrupt:
-        info("^C", user, prefix=False)
-        current_actor = UserName()
-        current_modality = Modality.Text
-      except NotImplementedError as e:
-        err("<Not implemented>", user)
-        current_actor = UserName()
-        current_modality = Modality.Text
-      except ValueError as e:
-        err(e, user)
-        current_actor = UserName()
-        current_modality = Modality.Text
+    st.actors[UserName()] = user
+    spill = SpillPolicy(int(args.spill_threshold*1024*1024)) if args.spill_threshold > 0 else None
+    run_async(converse(st, user, file, recorder, actor_factory_fn, spill))
   finally:
     recorder.update_params(RecordingParams())
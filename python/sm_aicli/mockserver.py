@@ -0,0 +1,337 @@
+""" Local stand-in for the OpenAI API, for testing and benchmarking aicli without network access. The
+server speaks the streaming and non-streaming chat completions, image generation and editing, file
+uploads and file retrieval endpoints, and serves the generated images. Replies are made of the
+words of the last user message (or of a fixed text), sent at a configurable rate, in chunks of a
+configurable size, after a configurable first-token delay. Requests fail with a configurable
+probability. Point the OpenAI actors at the server with `/set model baseurl "http://host:port/v1"`
+or with the `OPENAI_BASE_URL` variable. Run it with `python -m sm_aicli.mockserver`. """
+
+from argparse import ArgumentParser
+from base64 import b64encode
+from dataclasses import dataclass
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from itertools import count
+from json import loads as json_loads, dumps as json_dumps
+from random import Random
+from re import compile as re_compile
+from struct import pack
+from threading import Thread, Lock
+from time import time, sleep
+from typing import Any, Iterator
+from zlib import crc32, compress
+
+TEXT_DEF = "Lorem ipsum dolor sit amet, consectetur adipiscing elit."
+
+@dataclass
+class MockOptions:
+  rate:float = 100.0              # Tokens per second, 0 means no delay
+  chunk_size:int = 1              # Tokens per stream chunk
+  ttft:float = 0.0                # First token delay, seconds
+  jitter:float = 0.0              # Relative random deviation of the delays, 0..1
+  error_rate:float = 0.0          # Probability of a request to fail
+  error_status:int = 500          # HTTP status of the failed requests
+  ntokens:int = 64                # Tokens per reply
+  text:str|None = None            # Reply text, the last user message by default
+  image_size:int = 64             # Size of the generated images, pixels
+  seed:int|None = None            # Random seed of the delays and the errors
+
+
+def png(size:int, color:tuple[int,int,int]) -> bytes:
+  """ Encode a single-color square PNG image. """
+  def _chunk(kind:bytes, data:bytes) -> bytes:
+    return pack('>I', len(data)) + kind + data + pack('>I', crc32(kind + data))
+  row = b'\x00' + bytes(color) * size
+  return (b'\x89PNG\r\n\x1a\n' +
+          _chunk(b'IHDR', pack('>IIBBBBB', size, size, 8, 2, 0, 0, 0)) +
+          _chunk(b'IDAT', compress(row * size)) +
+          _chunk(b'IEND', b''))
+
+
+def reply_tokens(text:str, ntokens:int) -> list[str]:
+  """ Split the reply text into word tokens, repeating it up to `ntokens` tokens. """
+  words = [' ' + w for w in (text.split() or TEXT_DEF.split())]
+  acc = [words[i % len(words)] for i in range(ntokens)]
+  if acc:
+    acc[0] = acc[0].lstrip()
+  return acc
+
+
+class MockError(Exception):
+  def __init__(self, status:int, message:str):
+    super().__init__(message)
+    self.status = status
+
+
+class MockState:
+  """ Uploads, files and images of the server. """
+  def __init__(self, opt:MockOptions):
+    self.opt = opt
+    self.random = Random(opt.seed)
+    self.ids = count(1)
+    self.uploads:dict[str,dict] = {}
+    self.files:dict[str,dict] = {}
+    self.images:dict[str,bytes] = {}
+    self.lock = Lock()
+
+  def newid(self, prefix:str) -> str:
+    with self.lock:
+      return f"{prefix}-mock{next(self.ids)}"
+
+  def jittered(self, t:float) -> float:
+    with self.lock:
+      return max(0.0, t * (1.0 + self.random.uniform(-self.opt.jitter, self.opt.jitter)))
+
+  def delay(self, tokens:float) -> float:
+    """ Time to generate `tokens` tokens, seconds. """
+    return self.jittered(tokens / self.opt.rate) if self.opt.rate > 0 else 0.0
+
+  def fails(self) -> bool:
+    with self.lock:
+      return self.random.random() < self.opt.error_rate
+
+
+class MockHandler(BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+  server:"MockServer"
+
+  def log_message(self, format, *args):
+    pass
+
+  @property
+  def state(self) -> MockState:
+    return self.server.state
+
+  def _body(self) -> bytes:
+    return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+  def _json(self, body:bytes) -> dict:
+    try:
+      return json_loads(body) if body else {}
+    except ValueError as err:
+      raise MockError(400, f"Invalid JSON: {err}") from err
+
+  def _form(self, body:bytes) -> dict[str,str]:
+    """ Text fields of a multipart form. """
+    acc = {}
+    for part in body.split(b'\r\n--'):
+      head, _, value = part.partition(b'\r\n\r\n')
+      if (m := re_compile(rb'name="([^"]*)"').search(head)) and b'filename=' not in head:
+        acc[m.group(1).decode()] = value.rstrip(b'\r\n').decode(errors='replace')
+    return acc
+
+  def _send(self, status:int, data:bytes, content_type:str) -> None:
+    self.send_response(status)
+    self.send_header('Content-Type', content_type)
+    self.send_header('Content-Length', str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+  def _send_json(self, obj:Any, status:int=200) -> None:
+    self._send(status, json_dumps(obj).encode(), 'application/json')
+
+  def _send_error(self, status:int, message:str) -> None:
+    self._send_json({'error': {'message': message, 'type': 'mock_error', 'param': None,
+                               'code': None}}, status)
+
+  def do_GET(self):
+    self._dispatch('GET')
+
+  def do_POST(self):
+    self._dispatch('POST')
+
+  def _dispatch(self, method:str) -> None:
+    # [1] - Images are served without the error injection, like the CDN of the provider.
+    path = self.path.split('?')[0]
+    body = self._body() if method == 'POST' else b''
+    try:
+      if method == 'GET' and path.startswith('/images/'): # [1]
+        data = self.state.images.get(path[len('/images/'):].removesuffix('.png'))
+        if data is None:
+          raise MockError(404, f"No such image: {path}")
+        return self._send(200, data, 'image/png')
+      if self.state.fails():
+        raise MockError(self.state.opt.error_status, "Injected error")
+      parts = path.removeprefix('/v1').strip('/').split('/')
+      match (method, parts):
+        case ('POST', ['chat', 'completions']):
+          self._chat(self._json(body))
+        case ('POST', ['images', 'generations']):
+          self._images(self._json(body))
+        case ('POST', ['images', 'edits']):
+          self._images(self._form(body))
+        case ('POST', ['uploads']):
+          self._upload_create(self._json(body))
+        case ('POST', ['uploads', upload_id, 'parts']):
+          self._upload_part(upload_id, body)
+        case ('POST', ['uploads', upload_id, 'complete']):
+          self._upload_complete(upload_id, self._json(body))
+        case ('GET', ['files', file_id]):
+          if (f := self.state.files.get(file_id)) is None:
+            raise MockError(404, f"No such file: {file_id}")
+          self._send_json(f)
+        case _:
+          raise MockError(404, f"Unknown endpoint: {method} {path}")
+    except MockError as err:
+      self._send_error(err.status, str(err))
+    except (BrokenPipeError, ConnectionResetError):
+      self.close_connection = True
+
+  def _tokens(self, request:dict) -> list[str]:
+    opt = self.state.opt
+    text = opt.text
+    if text is None:
+      users = [m for m in request.get('messages', []) if m.get('role') == 'user']
+      content = users[-1].get('content', '') if users else ''
+      if isinstance(content, list):
+        content = ' '.join(c.get('text', '') for c in content if c.get('type') == 'text')
+      text = content
+    return reply_tokens(text, request.get('max_tokens') or opt.ntokens)
+
+  def _chat(self, request:dict) -> None:
+    state, opt = self.state, self.state.opt
+    tokens = self._tokens(request)
+    head = {'id': state.newid('chatcmpl'), 'created': int(time()),
+            'model': request.get('model', 'mock')}
+    sleep(state.jittered(opt.ttft))
+    if not request.get('stream'):
+      sleep(state.delay(len(tokens)))
+      return self._send_json({**head, 'object': 'chat.completion', 'choices': [{
+        'index': 0, 'finish_reason': 'stop',
+        'message': {'role': 'assistant', 'content': ''.join(tokens)}}],
+        'usage': {'prompt_tokens': 0, 'completion_tokens': len(tokens),
+                  'total_tokens': len(tokens)}})
+    def _chunk(delta:dict, finish_reason:str|None=None) -> bytes:
+      obj = {**head, 'object': 'chat.completion.chunk',
+             'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}]}
+      return f"data: {json_dumps(obj)}\n\n".encode()
+    def _events() -> Iterator[bytes]:
+      yield _chunk({'role': 'assistant', 'content': ''})
+      step = max(1, opt.chunk_size)
+      for i in range(0, len(tokens), step):
+        if i > 0:
+          sleep(state.delay(step))
+        yield _chunk({'content': ''.join(tokens[i:i+step])})
+      yield _chunk({}, 'stop')
+      yield b"data: [DONE]\n\n"
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/event-stream')
+    self.send_header('Transfer-Encoding', 'chunked')
+    self.end_headers()
+    for event in _events():
+      self.wfile.write(f"{len(event):x}\r\n".encode() + event + b"\r\n")
+      self.wfile.flush()
+    self.wfile.write(b"0\r\n\r\n")
+
+  def _images(self, request:dict) -> None:
+    state, opt = self.state, self.state.opt
+    n = int(request.get('n') or 1)
+    sleep(state.jittered(opt.ttft) + state.delay(opt.ntokens))
+    data = []
+    for _ in range(n):
+      image_id = state.newid('img')
+      image = png(opt.image_size, tuple(state.random.randrange(256) for _ in range(3)))
+      if request.get('response_format') == 'b64_json':
+        data.append({'b64_json': b64encode(image).decode()})
+      else:
+        state.images[image_id] = image
+        data.append({'url': f"{self.server.url}/images/{image_id}.png?rsct=image/png"})
+    self._send_json({'created': int(time()), 'data': data, 'output_format': 'png'})
+
+  def _upload_create(self, request:dict) -> None:
+    now = int(time())
+    upload = {'id': self.state.newid('upload'), 'object': 'upload', 'status': 'pending',
+              'bytes': request.get('bytes', 0), 'filename': request.get('filename', ''),
+              'purpose': request.get('purpose', ''), 'created_at': now,
+              'expires_at': now + 3600, 'file': None}
+    self.state.uploads[upload['id']] = upload
+    self._send_json(upload)
+
+  def _upload_part(self, upload_id:str, body:bytes) -> None:
+    if upload_id not in self.state.uploads:
+      raise MockError(404, f"No such upload: {upload_id}")
+    sleep(self.state.delay(len(body) / 1024 / 1024))  # One token per MiB
+    self._send_json({'id': self.state.newid('part'), 'object': 'upload.part',
+                     'upload_id': upload_id, 'created_at': int(time())})
+
+  def _upload_complete(self, upload_id:str, request:dict) -> None:
+    upload = self.state.uploads.get(upload_id)
+    if upload is None:
+      raise MockError(404, f"No such upload: {upload_id}")
+    f = {'id': self.state.newid('file'), 'object': 'file', 'bytes': upload['bytes'],
+         'created_at': int(time()), 'filename': upload['filename'],
+         'purpose': upload['purpose'], 'status': 'processed'}
+    self.state.files[f['id']] = f
+    upload.update(status='completed', file=f)
+    self._send_json(upload)
+
+
+class MockServer(ThreadingHTTPServer):
+  daemon_threads = True
+
+  def __init__(self, opt:MockOptions|None=None, host:str='127.0.0.1', port:int=0):
+    super().__init__((host, port), MockHandler)
+    self.state = MockState(opt or MockOptions())
+    self.thread:Thread|None = None
+
+  @property
+  def url(self) -> str:
+    host, port = self.server_address[:2]
+    return f"http://{host}:{port}"
+
+  @property
+  def base_url(self) -> str:
+    """ The base URL for the OpenAI clients. """
+    return f"{self.url}/v1"
+
+  def start(self) -> "MockServer":
+    """ Serve in a background thread. """
+    self.thread = Thread(target=self.serve_forever, daemon=True)
+    self.thread.start()
+    return self
+
+  def stop(self) -> None:
+    self.shutdown()
+    self.server_close()
+    if self.thread is not None:
+      self.thread.join()
+
+
+ARG_PARSER = ArgumentParser(description="OpenAI-compatible mock server for testing aicli offline")
+ARG_PARSER.add_argument('--host', type=str, default='127.0.0.1')
+ARG_PARSER.add_argument('--port', type=int, default=8080)
+ARG_PARSER.add_argument('--rate', type=float, default=MockOptions.rate, metavar='TOK/S',
+                        help="Tokens per second, 0 disables the delays")
+ARG_PARSER.add_argument('--chunk-size', type=int, default=MockOptions.chunk_size, metavar='N',
+                        help="Tokens per stream chunk")
+ARG_PARSER.add_argument('--ttft', type=float, default=MockOptions.ttft, metavar='SEC',
+                        help="Delay of the first token")
+ARG_PARSER.add_argument('--jitter', type=float, default=MockOptions.jitter, metavar='FRAC',
+                        help="Relative random deviation of the delays")
+ARG_PARSER.add_argument('--error-rate', type=float, default=MockOptions.error_rate,
+                        metavar='PROB', help="Probability of a request to fail")
+ARG_PARSER.add_argument('--error-status', type=int, default=MockOptions.error_status,
+                        metavar='CODE', help="HTTP status of the failed requests")
+ARG_PARSER.add_argument('--ntokens', type=int, default=MockOptions.ntokens, metavar='N',
+                        help="Tokens per reply")
+ARG_PARSER.add_argument('--text', type=str, default=None,
+                        help="Reply text, the last user message by default")
+ARG_PARSER.add_argument('--seed', type=int, default=None)
+
+def main(cmdline=None) -> int:
+  args = ARG_PARSER.parse_args(cmdline)
+  opt = MockOptions(rate=args.rate, chunk_size=args.chunk_size, ttft=args.ttft,
+                    jitter=args.jitter, error_rate=args.error_rate,
+                    error_status=args.error_status, ntokens=args.ntokens, text=args.text,
+                    seed=args.seed)
+  server = MockServer(opt, args.host, args.port)
+  print(f"Serving the mock OpenAI API at {server.base_url}", flush=True)
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+  return 0
+
+if __name__ == '__main__':
+  exit(main())
@@ -0,0 +1,94 @@
+""" On-disk cache of model responses. Responses are stored as files named after the hash of the
+request: the endpoint, the model, the messages and the sampling parameters. Files are written
+atomically, so several aicli processes could share the cache. The least recently used responses are
+evicted once the cache exceeds its size limit. """
+
+from hashlib import sha256
+from json import dumps as json_dumps
+from os import listdir, replace, stat, unlink, utime, makedirs
+from os.path import join
+from tempfile import NamedTemporaryFile
+from typing import Any
+
+from .utils import cache_dir
+
+CACHE_SIZE_DEF = 100*1024*1024
+CACHE_EVICT_RATIO = 0.75 # Eviction frees the cache down to this fraction of its size
+
+# Response cache modes, see `ActorOptions.cache`
+CACHE_ON = 'on'
+CACHE_REFRESH = 'refresh'
+
+def request_key(**request:Any) -> str:
+  """ Hash of a request. Keys are sorted and the separators are fixed, so equal requests have
+  equal hashes. """
+  data = json_dumps(request, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+  return sha256(data.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+  def __init__(self, path:str, size:int=CACHE_SIZE_DEF):
+    self.path = path
+    self.size = size
+    self.used:int|None = None # Estimated size of the cache, None until the directory is scanned
+    makedirs(path, exist_ok=True)
+
+  def get(self, key:str) -> str|None:
+    fname = join(self.path, key)
+    try:
+      with open(fname, encoding='utf-8') as f:
+        text = f.read()
+      utime(fname) # Mark as recently used
+      return text
+    except FileNotFoundError:
+      return None
+
+  def put(self, key:str, text:str) -> None:
+    # [1] - The estimate only counts the responses of this process, the directory is scanned once
+    #       it exceeds the limit.
+    data = text.encode('utf-8')
+    f = NamedTemporaryFile('wb', dir=self.path, prefix='.', delete=False)
+    try:
+      with f:
+        f.write(data)
+      replace(f.name, join(self.path, key))
+    except BaseException:
+      try:
+        unlink(f.name)
+      except FileNotFoundError:
+        pass
+      raise
+    if self.used is None or self.used + len(data) > self.size: # [1]
+      self.used = self.evict()
+    else:
+      self.used += len(data)
+
+  def evict(self) -> int:
+    """ Remove the least recently used responses until the cache fits into a fraction of its size,
+    so that the following responses could be added without scanning the directory. Return the
+    resulting size of the cache. """
+    entries = []
+    for name in listdir(self.path):
+      if name.startswith('.'):
+        continue
+      try:
+        st = stat(join(self.path, name))
+        entries.append((st.st_mtime, st.st_size, name))
+      except FileNotFoundError:
+        pass
+    total = sum(e[1] for e in entries)
+    for _, size, name in sorted(entries):
+      if total <= self.size*CACHE_EVICT_RATIO:
+        break
+      try:
+        unlink(join(self.path, name))
+      except FileNotFoundError:
+        pass
+      total -= size
+    return total
+
+
+def response_cache() -> ResponseCache|None:
+  """ Return the response cache in the aicli cache directory, if it is available. """
+  path = cache_dir()
+  return ResponseCache(join(path, 'responses')) if path is not None else None
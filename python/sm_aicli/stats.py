@@ -0,0 +1,159 @@
+""" Latency and throughput statistics of streams. Every `IterableStream` keeps the timestamps of its
+first and last tokens, the token and byte counts and the histogram of inter-token latencies. The
+user actor aggregates the statistics of the streams it reads per actor. """
+
+from dataclasses import dataclass, field
+from math import log2, floor, ceil
+from time import perf_counter
+from typing import Any
+
+# Number of histogram buckets per doubling of the value
+BUCKETS_PER_OCTAVE = 4
+
+
+@dataclass
+class Histogram:
+  """ Sparse histogram with logarithmic buckets. Quantiles are estimated within a bucket, that is
+  within ~20% of the actual value. """
+  counts:dict[int,int] = field(default_factory=dict)
+  count:int = 0
+  total:float = 0.0
+  min:float|None = None
+  max:float|None = None
+
+  @staticmethod
+  def _bucket(value:float) -> int:
+    return floor(log2(value) * BUCKETS_PER_OCTAVE) if value > 0 else -1000
+
+  def add(self, value:float) -> None:
+    b = self._bucket(value)
+    self.counts[b] = self.counts.get(b, 0) + 1
+    self.count += 1
+    self.total += value
+    self.min = value if self.min is None else min(self.min, value)
+    self.max = value if self.max is None else max(self.max, value)
+
+  def merge(self, other:"Histogram") -> None:
+    for b, n in other.counts.items():
+      self.counts[b] = self.counts.get(b, 0) + n
+    self.count += other.count
+    self.total += other.total
+    for v in [other.min, other.max]:
+      if v is not None:
+        self.min = v if self.min is None else min(self.min, v)
+        self.max = v if self.max is None else max(self.max, v)
+
+  def quantile(self, q:float) -> float|None:
+    if self.count == 0:
+      return None
+    if q <= 0 or q >= 1:
+      return self.min if q <= 0 else self.max
+    rank, acc = max(1, ceil(q * self.count)), 0 # Nearest rank
+    for b in sorted(self.counts):
+      acc += self.counts[b]
+      if acc >= rank:
+        mid = 2 ** ((b + 0.5) / BUCKETS_PER_OCTAVE) if b > -1000 else 0.0
+        return min(max(mid, self.min), self.max)
+    return self.max
+
+  def mean(self) -> float|None:
+    return self.total / self.count if self.count > 0 else None
+
+  def summary(self) -> dict[str, Any]:
+    return {'count': self.count, 'mean': self.mean(), 'min': self.min, 'max': self.max,
+            'p50': self.quantile(0.5), 'p90': self.quantile(0.9), 'p99': self.quantile(0.99)}
+
+
+class StreamStats:
+  """ Timings of a single stream, see `token`. Times are `perf_counter` seconds. `started` is the
+  time the request was sent, the time of creation by default. """
+  def __init__(self, started:float|None=None):
+    self.started:float = started if started is not None else perf_counter()
+    self.first:float|None = None
+    self.last:float|None = None
+    self.ntokens:int = 0
+    self.nbytes:int = 0
+    self.itl = Histogram()    # Inter-token latencies, ms
+
+  def token(self, token:Any) -> None:
+    """ Account the next token of the stream. """
+    now = perf_counter()
+    if self.last is not None:
+      self.itl.add((now - self.last) * 1000)
+    else:
+      self.first = now
+    self.last = now
+    self.ntokens += 1
+    if isinstance(token, str):
+      self.nbytes += len(token.encode('utf-8'))
+    elif isinstance(token, bytes):
+      self.nbytes += len(token)
+
+  def ttft(self) -> float|None:
+    """ Time to the first token, seconds. """
+    return self.first - self.started if self.first is not None else None
+
+  def duration(self) -> float:
+    """ Time between the first and the last tokens, seconds. """
+    return self.last - self.first if self.first is not None else 0.0
+
+  def tps(self) -> float|None:
+    """ Tokens per second after the first token. """
+    d = self.duration()
+    return (self.ntokens - 1) / d if d > 0 else None
+
+
+@dataclass
+class ActorStats:
+  """ Statistics of the streams of an actor. """
+  nstreams:int = 0
+  ntokens:int = 0
+  nbytes:int = 0
+  duration:float = 0.0
+  ttft:Histogram = field(default_factory=Histogram)  # ms
+  itl:Histogram = field(default_factory=Histogram)   # ms
+  tps:Histogram = field(default_factory=Histogram)
+
+  def add(self, s:StreamStats) -> None:
+    self.nstreams += 1
+    self.ntokens += s.ntokens
+    self.nbytes += s.nbytes
+    self.duration += s.duration()
+    if (ttft := s.ttft()) is not None:
+      self.ttft.add(ttft * 1000)
+    if (tps := s.tps()) is not None:
+      self.tps.add(tps)
+    self.itl.merge(s.itl)
+
+  def dump(self) -> dict[str, Any]:
+    return {'streams': self.nstreams, 'tokens': self.ntokens, 'bytes': self.nbytes,
+            'duration_s': self.duration, 'ttft_ms': self.ttft.summary(),
+            'itl_ms': self.itl.summary(), 'tokens_per_s': self.tps.summary()}
+
+
+class Stats:
+  """ Stream statistics by actor name. """
+  def __init__(self):
+    self.actors:dict[str, ActorStats] = {}
+
+  def add(self, name:str, s:StreamStats|None) -> None:
+    if s is not None and s.ntokens > 0:
+      self.actors.setdefault(name, ActorStats()).add(s)
+
+  def dump(self) -> dict[str, Any]:
+    """ Machine-readable statistics. """
+    return {name: a.dump() for name, a in self.actors.items()}
+
+  def table(self) -> str:
+    """ Human-readable statistics. """
+    def _f(v:float|None) -> str:
+      return f"{v:.1f}" if v is not None else "-"
+    width = max([len('ACTOR')] + [len(n) for n in self.actors])
+    acc = [f"{'ACTOR':{width}s} {'STREAMS':>7s} {'TOKENS':>8s} {'BYTES':>9s} "
+           f"{'TTFT p50/p90,ms':>17s} {'ITL p50/p90,ms':>16s} {'TOK/S p50':>9s}"]
+    for name, a in self.actors.items():
+      ttft = f"{_f(a.ttft.quantile(0.5))}/{_f(a.ttft.quantile(0.9))}"
+      itl = f"{_f(a.itl.quantile(0.5))}/{_f(a.itl.quantile(0.9))}"
+      acc.append(f"{name:{width}s} {a.nstreams:7d} {a.ntokens:8d} {a.nbytes:9d} "
+                 f"{ttft:>17s} {itl:>16s} {_f(a.tps.quantile(0.5)):>9s}")
+    return '\n'.join(acc)
@@ -0,0 +1,42 @@
+""" Process-wide HTTP transport. HTTP clients are pooled by their configuration, so the provider
+actors and the dereferencer share keep-alive connections instead of doing a new TCP and TLS
+handshake for every request. HTTP/2 is used if the `h2` package is installed (`pip install
+httpx[http2]`). """
+
+from functools import cache
+from threading import Lock
+from typing import Any
+
+# Defaults match the ones of the OpenAI SDK
+TIMEOUT_DEF = 600.0
+CONNECT_TIMEOUT_DEF = 5.0
+POOL_SIZE_DEF = 100
+
+_lock = Lock()
+
+@cache
+def http2_available() -> bool:
+  try:
+    import h2
+    return True
+  except ImportError:
+    return False
+
+@cache
+def _http_client(proxy:str|None, pool_size:int|None, timeout:float|None) -> Any:
+  from httpx import Client, Limits, Timeout
+  pool_size = pool_size or POOL_SIZE_DEF
+  return Client(
+    proxy=proxy,
+    limits=Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+    timeout=Timeout(timeout or TIMEOUT_DEF, connect=min(timeout or CONNECT_TIMEOUT_DEF,
+                                                        CONNECT_TIMEOUT_DEF)),
+    http2=http2_available(),
+    follow_redirects=True,
+  )
+
+def http_client(proxy:str|None=None, pool_size:int|None=None, timeout:float|None=None) -> Any:
+  """ Return the shared `httpx.Client` for the given proxy, connection pool size and timeout
+  (seconds). None selects the defaults. """
+  with _lock:
+    return _http_client(proxy, pool_size, timeout)
@@ -1,10 +1,16 @@
-from typing import Any, Iterable, Callable
+from typing import Any, Iterable, Callable, AsyncIterator
+from asyncio import to_thread, get_running_loop, Event as AsyncEvent
 from dataclasses import dataclass
 from copy import deepcopy
 from enum import Enum
 from contextlib import contextmanager
 from traceback import print_exc
 from abc import ABC, abstractmethod
+from mmap import mmap, ACCESS_READ
+from tempfile import TemporaryFile
+from threading import Lock, Thread, Event
+
+from .stats import StreamStats
 
 class ConversationException(ValueError):
   pass
@@ -87,6 +93,7 @@ class ActorOptions:
   prompt:str|None = None
   imgsz:str|None = None
   imgnum:int|None = None
+  image_inline:bool=False      # Receive images inline rather than as URLs to download
   modality:Modality|None=None
   image_dir:str|None=None
   model_dir:str|None=None
@@ -94,6 +101,12 @@ class ActorOptions:
   replay:bool=False            # Read replies from a file instead of from models
   proxy:str|None=None          # Proxy string to use,
                                # For OpenAI see https://www.python-httpx.org/advanced/proxies/
+  base_url:str|None=None       # API endpoint, e.g. of a compatible server or of a mock server
+  pool_size:int|None=None      # Maximum number of pooled HTTP connections
+  timeout:float|None=None      # HTTP timeout, seconds
+  ctx_size:int|None=None       # Maximum number of tokens of the conversation history to send,
+                               # OpenAI only
+  cache:str|None=None          # Response cache mode: 'on', 'refresh' or None (off)
 
   @staticmethod
   def init():
@@ -113,11 +126,20 @@ class Intention:
   exit_flag:bool                  # Exit the application
   reset_flag:bool                 # Reset the conversation
   dbg_flag:bool                   # Run the Python debugger
+  fanout:list[ActorName]|None     # Ask several actors at once
 
   @staticmethod
   def init(actor_next=None, actor_updates=None, exit_flag=False, reset_flag=False,
-           dbg_flag=False):
-    return Intention(actor_next, actor_updates, exit_flag, reset_flag, dbg_flag)
+           dbg_flag=False, fanout=None):
+    return Intention(actor_next, actor_updates, exit_flag, reset_flag, dbg_flag, fanout)
+
+  def addresses(self, name:ActorName) -> bool:
+    """ Check if the utterance is directed to the actor `name`. """
+    return self.actor_next == name or (self.fanout is not None and name in self.fanout)
+
+  def targets(self) -> list[ActorName]:
+    """ Return the names of actors the utterance is directed to. """
+    return ([self.actor_next] if self.actor_next is not None else []) + (self.fanout or [])
 
 
 @dataclass(frozen=True)
@@ -142,14 +164,139 @@ type ContentItem = str | bytes | Reference
 
 type LocalContent = list[ContentItem]
 
+class Segment:
+  """ Append-only on-disk storage for the recordings moved out of memory. The data is written to
+  the end of an anonymous temporary file and is read back through a memory map. """
+  def __init__(self, dirpath:str|None=None):
+    self.file = TemporaryFile(dir=dirpath)
+    self.size:int = 0
+    self.map:mmap|None = None
+    self.lock = Lock()
+
+  def write(self, data:bytes) -> int:
+    """ Append `data`, return its offset. """
+    with self.lock:
+      offset = self.size
+      self.file.write(data)
+      self.file.flush()
+      self.size += len(data)
+      return offset
+
+  def read(self, offset:int, size:int) -> bytes:
+    with self.lock:
+      if self.map is None or len(self.map) < offset + size:
+        self.map = mmap(self.file.fileno(), 0, access=ACCESS_READ)
+      return self.map[offset:offset+size]
+
+
+@dataclass(frozen=True)
+class SpilledRun:
+  """ A run of recording tokens stored in a `Segment`. """
+  segment:Segment
+  offset:int
+  size:int
+  binary:bool
+
+  def load(self) -> str|bytes:
+    data = self.segment.read(self.offset, self.size)
+    return data if self.binary else data.decode('utf-8')
+
+
+class Recording:
+  """ Append-only storage of stream tokens. Adjacent text tokens are kept as a list of chunks,
+  adjacent binary tokens are accumulated in a `bytearray`, so appending is amortized O(1). Reading
+  yields every run of tokens joined into a single item. Joined runs replace the chunks, and the
+  list of items is cached until the next append. Binary tokens appended after reading start a new
+  run, which the next reading joins with the preceding one. Runs might be moved to disk with
+  `spill`. """
+  def __init__(self, items:Iterable[ContentItem]=()):
+    self.runs:list[list[str]|bytearray|bytes|Reference|SpilledRun] = []
+    self._items:list[ContentItem]|None = None
+    for item in items:
+      self.append(item)
+
+  def append(self, item:ContentItem) -> None:
+    runs = self.runs
+    last = runs[-1] if runs else None
+    if isinstance(item, str):
+      if last.__class__ is list:
+        last.append(item)
+      else:
+        runs.append([item])
+    elif isinstance(item, bytes):
+      if last.__class__ is bytearray:
+        last.extend(item)
+      else:
+        runs.append(bytearray(item))
+    else:
+      runs.append(item)
+    self._items = None
+
+  def items(self) -> list[ContentItem]:
+    """ Return the joined runs. Items of the spilled runs are loaded on every call and are not
+    cached. """
+    if self._items is None:
+      acc, runs, spilled = [], [], False
+      for run in self.runs:
+        if isinstance(run, list):
+          if len(run) > 1:
+            run[:] = [''.join(run)]
+          acc.append(run[0])
+        elif isinstance(run, (bytes, bytearray)):
+          if runs and isinstance(runs[-1], bytes):
+            acc.pop()
+            run = runs.pop() + run
+          acc.append(bytes(run))
+          run = acc[-1]
+        elif isinstance(run, SpilledRun):
+          acc.append(run.load())
+          spilled = True
+        else:
+          acc.append(run)
+        runs.append(run)
+      self.runs = runs
+      if spilled:
+        return acc
+      self._items = acc
+    return self._items
+
+  def nbytes(self) -> int:
+    """ Return the approximate size of the runs held in memory. """
+    acc = 0
+    for run in self.runs:
+      if isinstance(run, list):
+        acc += sum(len(chunk) for chunk in run)
+      elif isinstance(run, (bytes, bytearray)):
+        acc += len(run)
+    return acc
+
+  def spill(self, segment:Segment) -> int:
+    """ Move the text and binary runs to the `segment`. Return the number of bytes freed. """
+    freed = 0
+    for i, run in enumerate(self.runs):
+      if isinstance(run, list):
+        data, binary = ''.join(run).encode('utf-8'), False
+      elif isinstance(run, (bytes, bytearray)):
+        data, binary = bytes(run), True
+      else:
+        continue
+      self.runs[i] = SpilledRun(segment, segment.write(data), len(data), binary)
+      freed += len(data)
+    self._items = None
+    return freed
+
+  def __iter__(self):
+    return iter(self.items())
+
 class Stream(ABC):
   """ Stream represents a promise to fetch the content from a remote source of some kind. The
   convention is to call gen() only once for every stream. The returned tokens are also stored in the
-  `recording` array. All tokens must be of a same type (str or bytes). """
+  `recording`. All tokens must be of a same type (str or bytes). """
   def __init__(self, reference:Reference=Reference()):
     self.binary: bool|None = None           # Binary flag, None means Unknown
     self.stop:bool = False                  # Interrupt flag
-    self.recording:LocalContent|None = None # Stream recording
+    self.recording:Recording|None = None    # Stream recording
+    self.stats:StreamStats|None = None      # Stream timings
     self.reference:Reference = reference
 
   @abstractmethod
@@ -157,10 +304,66 @@ class Stream(ABC):
     """ Yield next ContentItem. """
     ...
 
+  async def agen(self) -> AsyncIterator[ContentItem]:
+    """ Asynchronously yield next ContentItem. The default implementation runs `gen` in a reader
+    thread and hands the tokens over to the event loop in batches. """
+    # [1] - Wake the loop up only when the batch becomes non-empty rather than once per token.
+    loop = get_running_loop()
+    lock = Lock()
+    ready = AsyncEvent()
+    abandoned = Event()
+    batch:list[ContentItem] = []
+    state:dict[str,Any] = {'done':False, 'exc':None}
+
+    def _wake():
+      try:
+        loop.call_soon_threadsafe(ready.set)
+      except RuntimeError:
+        pass  # The loop is closed
+
+    def _read():
+      try:
+        for token in self.gen():
+          if abandoned.is_set():
+            break
+          with lock:
+            batch.append(token)
+            wake = len(batch) == 1 # [1]
+          if wake:
+            _wake()
+      except BaseException as err:
+        state['exc'] = err
+      finally:
+        with lock:
+          state['done'] = True
+        _wake()
+
+    Thread(target=_read, daemon=True).start()
+    try:
+      while True:
+        await ready.wait()
+        with lock:
+          ready.clear()
+          tokens = batch.copy()
+          batch.clear()
+          done = state['done']
+        for token in tokens:
+          yield token
+        if done:
+          break
+      if state['exc'] is not None:
+        raise state['exc']
+    finally:
+      abandoned.set()
+
   def interrupt(self) -> None:
     """ Makes `gen` exit. """
     self.stop = True
 
+  def close(self) -> None:
+    """ Release the resources of a stream which is not going to be read, e.g. a connection. """
+    pass
+
 
 # Utterance content is a list of items, where an item is either a string, an array of bytes (for
 # pictures), or a stream of thereof. The stream represents a promise to fetch the data from a remote
@@ -188,6 +391,56 @@ Utterances = list[Utterance]
 UtteranceId = int
 UID = UtteranceId
 
+class UtteranceIndex:
+  """ Lookup indexes over a list of utterances: the last utterance directed to every actor and the
+  last non-empty utterance of every owner. The indexes are brought up to date with the appended
+  utterances before every lookup. Lookups may come from the actors reacting in worker threads. """
+  def __init__(self, uts:Utterances):
+    self.uts = uts
+    self.lock = Lock()
+    self._reset()
+
+  def _reset(self) -> None:
+    self.nuts:int = 0
+    self.lastrefs:dict[ActorName,UID] = {}
+    self.lastfulls:dict[ActorName,UID] = {}
+    self.prevfulls:list[UID|None] = []  # Previous non-empty utterance of the same owner
+
+  def sync(self) -> None:
+    with self.lock:
+      self._sync()
+
+  def _sync(self) -> None:
+    if len(self.uts) < self.nuts:
+      self._reset()
+    for i in range(self.nuts, len(self.uts)):
+      ut = self.uts[i]
+      for name in ut.intention.targets():
+        self.lastrefs[name] = i
+      self.prevfulls.append(self.lastfulls.get(ut.actor_name))
+      if not ut.is_empty():
+        self.lastfulls[ut.actor_name] = i
+    self.nuts = len(self.uts)
+
+  def lastref(self, referree:ActorName) -> UID|None:
+    """ Return id of the last utterance directed to the `referree` actor. """
+    with self.lock:
+      self._sync()
+      return self.lastrefs.get(referree)
+
+  def lastfull(self, owner:ActorName, before:UID|None=None) -> UID|None:
+    """ Return id of the last non-empty utterance issued by `owner`, optionally looking only at the
+    utterances preceding `before`. """
+    with self.lock:
+      self._sync()
+      if before is not None and before < self.nuts and self.uts[before].actor_name == owner:
+        return self.prevfulls[before]
+      uid = self.lastfulls.get(owner)
+      while uid is not None and before is not None and uid >= before:
+        uid = self.prevfulls[uid]
+      return uid
+
+
 @dataclass
 class Conversation:
   """ A conversation of actors, a chain of utterances. The convention is to
@@ -195,6 +448,14 @@ class Conversation:
   the initial (empty) state. """
   utterances:Utterances
 
+  @property
+  def index(self) -> UtteranceIndex:
+    """ The lookup index of the utterances, see `UtteranceIndex`. """
+    index = self.__dict__.get('_index')
+    if index is None or index.uts is not self.utterances:
+      index = self._index = UtteranceIndex(self.utterances)
+    return index
+
   def reset(self):
     """ TODO: redundant? """
     self.utterances = []
@@ -211,9 +472,10 @@ SAU = list[dict[str, str]]
 
 class Dereferencer(ABC):
   @abstractmethod
-  def deref(self, Reference) -> tuple[Reference, Stream]:
+  def deref(self, ref:Reference, name:ActorName|None=None) -> tuple[Reference, Stream]:
     """ Make reference locally-reproducible, that is, dereference a remote reference into a local
-    reference and return a stream to save locally """
+    reference and return a stream to save locally. `name` is the actor which has produced the
+    reference, its options (e.g. the image directory) apply. """
     raise NotImplementedError()
 
 class ActorViewer(ABC):
@@ -222,7 +484,9 @@ class ActorViewer(ABC):
     raise NotImplementedError()
 
 class ActorState(ActorViewer, Dereferencer):
-  pass
+  def prefetch(self, name:ActorName, ref:Reference) -> None:
+    """ Pass `ref` to the actor `name`, if it exists, see `Actor.prefetch`. """
+    pass
 
 class Actor:
   """ A conversation participant, known by name. The descendants track actor resources such as
@@ -237,6 +501,18 @@ class Actor:
     """
     raise NotImplementedError()
 
+  async def areact(self, act:ActorState, cnv:Conversation) -> Utterance:
+    """ Asynchronous version of `react`, called by the conversation loop. The default
+    implementation calls the synchronous `react` in a worker thread, so that the loop is not blocked
+    while the actor sends its request. Actors reading the terminal override this method to react in
+    the loop thread, native asynchronous actors override it with their own implementation. """
+    return await to_thread(self.react, act, cnv)
+
+  def prefetch(self, ref:Reference) -> None:
+    """ Start fetching the resources of a reference that is likely to appear in the next request,
+    e.g. start uploading a local file. Called before the request is complete. """
+    pass
+
   def reset(self):
     """ Clear cached conversation data. """
     raise NotImplementedError()
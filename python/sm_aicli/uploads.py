@@ -0,0 +1,142 @@
+""" Persistent index of the files uploaded to model providers. Uploads are keyed by the content hash
+of a file, so unchanged files are uploaded once across sessions, while edited files are uploaded
+again even if their paths stay the same. Content hashes are cached by path, size and mtime to avoid
+re-reading unchanged files. The index is a JSON file replaced atomically on every update. Large files
+are uploaded in parts, several parts at a time. """
+
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, asdict
+from hashlib import sha256
+from json import load as json_load, dump as json_dump
+from os import stat, replace
+from os.path import join, realpath, dirname, basename
+from tempfile import NamedTemporaryFile
+from threading import Lock
+from time import time
+from typing import Any
+
+from .utils import cache_dir
+
+# Uploads are checked against the provider once they are older than that, seconds
+VERIFY_AFTER_DEF = 24*60*60
+# Uploads are forgotten once they are older than that, seconds
+MAX_AGE_DEF = 30*24*60*60
+# Part size of the multipart uploads, the OpenAI SDK default
+PART_SIZE_DEF = 64*1024*1024
+# Number of parts uploaded at once
+PART_WORKERS_DEF = 4
+
+@dataclass
+class Upload:
+  file_id:str
+  uploaded:float                # Upload time
+  verified:float                # Last time the file was known to exist
+  expires:float|None = None     # Expiration time reported by the provider
+
+
+def file_digest(path:str) -> str:
+  h = sha256()
+  with open(path, 'rb') as f:
+    while chunk := f.read(1024*1024):
+      h.update(chunk)
+  return h.hexdigest()
+
+
+def upload_file_parallel(uploads:Any, path:str, mime_type:str, purpose:str,
+                         part_size:int=PART_SIZE_DEF, nworkers:int=PART_WORKERS_DEF) -> Any:
+  """ Upload a file using the multipart uploads API of OpenAI (`uploads.create`,
+  `uploads.parts.create`, `uploads.complete`). Unlike `uploads.upload_file_chunked`, up to
+  `nworkers` parts are sent concurrently. Return the completed upload. """
+  size = stat(path).st_size
+  upload = uploads.create(bytes=size, filename=basename(path), mime_type=mime_type,
+                          purpose=purpose)
+  def _part(offset:int) -> str:
+    with open(path, 'rb') as f:
+      f.seek(offset)
+      return uploads.parts.create(upload_id=upload.id, data=f.read(part_size)).id
+  offsets = range(0, size, part_size)
+  if len(offsets) > 1:
+    with ThreadPoolExecutor(max_workers=min(nworkers, len(offsets))) as pool:
+      part_ids = list(pool.map(_part, offsets))
+  else:
+    part_ids = [_part(o) for o in offsets]
+  return uploads.complete(upload_id=upload.id, part_ids=part_ids)
+
+
+def account_key(*args:str|None) -> str:
+  """ A key of the provider account, e.g. of the API key and the base URL. The uploads of one
+  account are not visible to the others. """
+  return sha256('\0'.join(a or '' for a in args).encode()).hexdigest()[:16]
+
+
+class UploadIndex:
+  def __init__(self, path:str|None, verify_after:float=VERIFY_AFTER_DEF,
+               max_age:float=MAX_AGE_DEF):
+    self.path = path                  # Index file, None keeps the index in memory
+    self.verify_after = verify_after
+    self.max_age = max_age
+    self.digests:dict[str,tuple[int,int,str]] = {}  # Path -> (size, mtime, digest)
+    self.data:dict[str,dict] = {}     # The index, if it is kept in memory
+    self.lock = Lock()
+
+  def _load(self) -> dict[str,dict]:
+    if self.path is None:
+      return self.data
+    try:
+      with open(self.path) as f:
+        return json_load(f)
+    except (FileNotFoundError, ValueError):
+      return {}
+
+  def _save(self, data:dict[str,dict]) -> None:
+    if self.path is None:
+      self.data = data
+      return
+    with NamedTemporaryFile('w', dir=dirname(self.path), prefix='.uploads', delete=False) as f:
+      json_dump(data, f)
+    replace(f.name, self.path)
+
+  def digest(self, path:str) -> str:
+    """ Return the content hash of the file `path`. """
+    path = realpath(path)
+    st = stat(path)
+    cached = self.digests.get(path)
+    if cached is not None and cached[:2] == (st.st_size, st.st_mtime_ns):
+      return cached[2]
+    digest = file_digest(path)
+    self.digests[path] = (st.st_size, st.st_mtime_ns, digest)
+    return digest
+
+  def get(self, account:str, digest:str) -> Upload|None:
+    with self.lock:
+      entry = self._load().get(f"{account}:{digest}")
+    if entry is None:
+      return None
+    upload = Upload(**entry)
+    now = time()
+    if now - upload.uploaded > self.max_age or (upload.expires is not None and upload.expires < now):
+      return None
+    return upload
+
+  def needs_verification(self, upload:Upload) -> bool:
+    return time() - upload.verified > self.verify_after
+
+  def put(self, account:str, digest:str, upload:Upload|None) -> None:
+    """ Add, update or (if `upload` is None) remove an upload. Expired uploads are dropped. """
+    with self.lock:
+      data = self._load()
+      now = time()
+      data = {k:v for k, v in data.items()
+              if now - v['uploaded'] <= self.max_age and (v.get('expires') or now) >= now}
+      if upload is not None:
+        data[f"{account}:{digest}"] = asdict(upload)
+      else:
+        data.pop(f"{account}:{digest}", None)
+      self._save(data)
+
+
+def upload_index() -> UploadIndex:
+  """ Return the upload index in the aicli cache directory, or an in-memory one if the cache is
+  disabled. """
+  path = cache_dir()
+  return UploadIndex(join(path, 'uploads.json') if path is not None else None)
@@ -1,54 +1,77 @@
-from PIL import Image, ImageDraw
-from collections import OrderedDict
+from base64 import b64decode
+from collections import deque
 from contextlib import contextmanager
 from dataclasses import dataclass
+from functools import cache
 from glob import glob
 from hashlib import sha256
 from io import BytesIO
-from os import environ, makedirs, system
+from os import environ, makedirs, system, replace, unlink, fsync as os_fsync
 from os.path import join, isfile, realpath, expanduser, abspath, sep
 from pdb import set_trace as ST
+from queue import Queue
+from re import compile as re_compile
 from signal import signal, SIGINT, SIGALRM, setitimer, ITIMER_REAL
 from subprocess import check_output, DEVNULL
-from sys import stderr, platform, maxsize
+from tempfile import NamedTemporaryFile
+import sys
+from sys import platform, maxsize
 from textwrap import dedent
-from typing import Iterable, Callable, Any
+from threading import Thread, Event
+from typing import Iterable, Iterator, Callable, Any
 from traceback import print_exc
 from copy import copy, deepcopy
 from urllib.parse import urlparse, parse_qs
-from requests.exceptions import RequestException
 
+from .stats import StreamStats
 from .types import (Actor, Conversation, UID, Utterance, Utterances, SAU, ActorName, Contents,
                     Stream, Logger, Parser, File, ContentItem, Dereferencer, ParsingResults,
-                    RecordingParams)
+                    RecordingParams, ConversationException, Recording, UtteranceIndex,
+                    Segment, LocalReference)
+
+@cache
+def revision() -> str|None:
+  """ Return the Git revision of aicli. The revision is taken from the `AICLI_REVISION` variable,
+  from the Git repository at `AICLI_ROOT` or from the `revision.py` file generated by `setup.py`
+  at the packaging time. The result is computed on the first call. """
+  if (rev := environ.get('AICLI_REVISION')) is not None:
+    return rev
+  try:
+    return check_output(['git', 'rev-parse', 'HEAD'],
+                        cwd=environ['AICLI_ROOT'],
+                        stderr=DEVNULL).decode().strip()
+  except Exception:
+    pass
+  try:
+    from .revision import REVISION
+    return REVISION
+  except ImportError:
+    return None
+
 
-REVISION:str|None
-try:
-  REVISION=environ["AICLI_REVISION"]
-except Exception:
+@cache
+def semver() -> str|None:
+  """ Return the semantic version of aicli as defined in `semver.txt` of the source tree at
+  `AICLI_ROOT` or in the `revision.py` file generated at the packaging time. """
   try:
-    REVISION=check_output(['git', 'rev-parse', 'HEAD'],
-                          cwd=environ['AICLI_ROOT'],
-                          stderr=DEVNULL).decode().strip()
+    with open(join(environ['AICLI_ROOT'], 'semver.txt')) as f:
+      return f.read().strip()
   except Exception:
-    try:
-      from .revision import REVISION as __rv__
-      REVISION = __rv__
-    except ImportError:
-      REVISION = None
-
-VERSION:str|None
-try:
-  from subprocess import check_output, DEVNULL
-  VERSION=check_output(['python3', 'setup.py', '--version'],
-                       cwd=environ['AICLI_ROOT'],
-                       stderr=DEVNULL).decode().strip()
-except Exception:
+    pass
   try:
-    from .revision import VERSION as __ver__
-    VERSION = __ver__
+    from .revision import VERSION
+    return VERSION
   except ImportError:
-    VERSION = None
+    return None
+
+
+def __getattr__(name):
+  """ `REVISION` and `VERSION` constants, computed on the first access """
+  if name == 'REVISION':
+    return revision()
+  if name == 'VERSION':
+    return semver()
+  raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
 
 
 @contextmanager
@@ -79,6 +102,7 @@ class IterableStream(Stream):
     self.generator = generator    # Descendant-specific token generator
     self.binary = binary          # Type of content (False => str; True => bytes)
     self.suggested_fname = suggested_fname # Suggested filename with extension
+    self.stats = StreamStats()
 
   def __deepcopy__(self, memo):
     assert self.generator is None, "Cannot call deepcopy on an unread stream"
@@ -101,7 +125,7 @@ class IterableStream(Stream):
     self.stop = False
     try:
       with _handle_exceptions():
-        self.recording = []
+        self.recording = Recording()
         for ch in self.generator:
           match ch:
             case str():
@@ -113,12 +137,35 @@ class IterableStream(Stream):
             case _:
               pass
           self.recording.append(ch)
+          self.stats.token(ch)
           yield ch
           if self.stop:
             break
     finally:
       self.generator = None
 
+  def save(self, path:str, mimetype:str, fsync:bool=False) -> LocalReference:
+    """ Write the tokens to the file `path` as they arrive, without keeping them in memory. The
+    recording of the stream then holds a reference to the file. A stream interrupted in advance
+    stops after the first token. """
+    assert self.recording is None, "Stream has already been read"
+    ref = LocalReference(mimetype, path)
+    try:
+      with _handle_exceptions():
+        with open(path, 'wb') as f:
+          for ch in self.generator:
+            f.write(ch.encode('utf-8') if isinstance(ch, str) else ch)
+            self.stats.token(ch)
+            if self.stop:
+              break
+          f.flush()
+          if fsync:
+            os_fsync(f.fileno())
+    finally:
+      self.generator = None
+      self.recording = Recording([ref])
+    return ref
+
 
 def onematch(gen:Iterable[str])->str:
   res = list(gen)
@@ -148,35 +195,29 @@ def find_last_message(messages:list[dict[str,str]], role:str) -> tuple[str|None,
   return last_message, last_message_id
 
 
-def uts_lastref(uts:Utterances, referree:ActorName) -> UID|None:
+def uts_index(uts:Utterances|Conversation) -> UtteranceIndex:
+  """ Return the index of a conversation or a throwaway index of a list of utterances. """
+  return uts.index if isinstance(uts, Conversation) else UtteranceIndex(uts)
+
+def uts_lastref(uts:Utterances|Conversation, referree:ActorName) -> UID|None:
   """ Return id of the last utterance directed to the `referree` actor. """
-  ul = len(uts)
-  if ul == 0:
-    return None
-  uid:UID|None = None
-  for i in reversed(range(0, ul)):
-    ut = uts[i]
-    if ut.intention.actor_next == referree:
-      uid = i
-      break
-  return uid
+  return uts_index(uts).lastref(referree)
 
-def uts_lastfull(uts:Utterances, owner:ActorName) -> UID|None:
-  """ Return id of the last non-empty utterance issued by `owner`. """
-  uid = None
-  for i in reversed(range(0, len(uts))):
-    ut = uts[i]
-    if ut.actor_name == owner and not ut.is_empty():
-      uid = i
-      break
-  return uid
+def uts_lastfull(uts:Utterances|Conversation, owner:ActorName,
+                 before:UID|None=None) -> UID|None:
+  """ Return id of the last non-empty utterance issued by `owner` (before `before`). """
+  return uts_index(uts).lastfull(owner, before)
 
-def uts_lastfullref(uts:Utterances, referree:ActorName) -> UID|None:
+def uts_lastfullref(uts:Utterances|Conversation, referree:ActorName,
+                    before:bool=False) -> UID|None:
+  """ Return id of the last utterance directed to `referree`. If it is empty, return the last
+  non-empty utterance of the same issuer instead, optionally preceding the empty one. """
   # [1]: If utterance is empty, look for the last non-empty utterance from the
   # same issuer.
-  uid = uts_lastref(uts, referree)
-  if uid is not None and uts[uid].is_empty(): # [1]
-    uid = uts_lastfull(uts, uts[uid].actor_name)
+  index = uts_index(uts)
+  uid = index.lastref(referree)
+  if uid is not None and index.uts[uid].is_empty(): # [1]
+    uid = index.lastfull(index.uts[uid].actor_name, uid if before else None)
   return uid
 
 FileId = str
@@ -208,59 +249,208 @@ def cont2strm(c:str|bytes|Stream, allow_bytes=True) -> Stream:
 
 
 def cont2str(cs:Contents, allow_bytes=True)->str|bytes:
-  acc:str|bytes|None = None
-  for token in cont2strm(cs, allow_bytes=allow_bytes).gen():
-    acc = token if acc is None else (acc + token)
-  return acc or ''
+  s = cont2strm(cs, allow_bytes=allow_bytes)
+  tokens = list(s.gen())
+  items = (s.recording if s.recording is not None else Recording(tokens)).items()
+  if len(items) == 0:
+    return ''
+  elif len(items) > 1:
+    raise ValueError(f"Can not convert mixed contents to a string: {[type(i) for i in items]}")
+  return items[0]
+
+# Approximate number of tokens a chat message adds on top of its contents
+MESSAGE_TOKENS = 4
+WORD_RE = re_compile(r"\w+|[^\w\s]")
+
+@cache
+def tokenizer(model:str|None) -> Callable[[str],int]|None:
+  """ Return a function counting tokens of a text for the `model` if `tiktoken` is installed. """
+  try:
+    import tiktoken
+    try:
+      enc = tiktoken.encoding_for_model(model or '')
+    except KeyError:
+      enc = tiktoken.get_encoding('cl100k_base')
+    return lambda text: len(enc.encode(text, disallowed_special=()))
+  except Exception:
+    return None
+
+def count_tokens(text:str, model:str|None=None) -> int:
+  """ Count tokens of `text`. Without a tokenizer, count words and punctuation marks, which is
+  close to the number of BPE tokens for English text. """
+  fn = tokenizer(model)
+  return fn(text) if fn is not None else len(WORD_RE.findall(text))
+
+def sau_tokens(message:dict, model:str|None=None) -> int:
+  """ Count tokens of a SAU message. Text parts of the extended (list) contents are counted. """
+  content = message['content']
+  if not isinstance(content, str):
+    content = ''.join(part.get('text', '') for part in content)
+  return count_tokens(content, model) + MESSAGE_TOKENS
+
+
+class SpillPolicy:
+  """ Keeps the memory used by a conversation bounded. Once the recordings of the utterances held
+  in memory exceed `threshold` bytes, the recordings of the oldest utterances are moved to an
+  on-disk `Segment`, see `Recording.spill`. The `keep` latest utterances are never moved. """
+  def __init__(self, threshold:int, keep:int=2, dirpath:str|None=None):
+    self.threshold = threshold
+    self.keep = keep
+    self.dirpath = dirpath
+    self.segment:Segment|None = None
+    self.uts:Utterances|None = None
+    self.nuts:int = 0                          # Number of utterances accounted
+    self.resident:deque[tuple[Recording,int]] = deque()
+    self.nbytes:int = 0                        # Size of the resident recordings
+    self.spilled:int = 0                       # Size of the spilled recordings
+
+  def update(self, cnv:Conversation) -> int:
+    """ Account the new utterances of `cnv` and spill the old ones if needed. Return the number of
+    bytes spilled. """
+    if cnv.utterances is not self.uts:
+      self.uts, self.nuts, self.nbytes = cnv.utterances, 0, 0
+      self.resident.clear()
+    # [1] - Streams not read yet, e.g. the fan-out replies, are accounted once they are read.
+    for i in range(self.nuts, max(self.nuts, len(self.uts) - self.keep)):
+      contents = self.uts[i].contents
+      if contents is not None and contents.recording is None: # [1]
+        break
+      if contents is not None:
+        size = contents.recording.nbytes()
+        self.resident.append((contents.recording, size))
+        self.nbytes += size
+      self.nuts = i + 1
+    spilled = 0
+    while self.nbytes > self.threshold and self.resident:
+      recording, size = self.resident.popleft()
+      if self.segment is None:
+        self.segment = Segment(self.dirpath)
+      spilled += recording.spill(self.segment)
+      self.nbytes -= size
+    self.spilled += spilled
+    return spilled
+
+
+class SAULog:
+  """ An append-only SAU view of a conversation, owned by an actor. Every update converts only the
+  utterances added since the previous update. The view is rebuilt from scratch if the system prompt
+  or the names change, or if the utterances do not continue the ones seen before (e.g. after a
+  reset). Token counts of the messages are cached alongside, see `window`. """
+  def __init__(self, count_fn:Callable[[dict],int]=sau_tokens):
+    self.count_fn = count_fn
+    self.reset()
+
+  def reset(self) -> None:
+    self.sau:SAU = []
+    self.ntokens:list[int] = []       # Token counts of the messages
+    self.total:int = 0                # Token count of the whole view
+    self.key:tuple|None = None
+    self.nuts:int = 0                 # Number of utterances converted
+    self.last:Utterance|None = None   # The last utterance converted
+
+  def _append(self, message:dict) -> None:
+    self.sau.append(message)
+    self.ntokens.append(self.count_fn(message))
+    self.total += self.ntokens[-1]
+
+  def update(self,
+             uts:Utterances,
+             names:dict[ActorName, str],
+             default_name:str|None = None,
+             system_prompt:str|None = None,
+             cont2str_fn:Callable[[Contents],Any] = cont2str,
+             end:int|None = None) -> SAU:
+    """ Bring the view up to date with the first `end` utterances of `uts` and return it. The
+    returned list is owned by the log and should not be modified. """
+    # In [1] we assume that Utterances do not contain streams.
+    end = len(uts) if end is None else end
+    key = (system_prompt, default_name, tuple(names.items()))
+    if key != self.key or end < self.nuts or \
+       (self.nuts > 0 and uts[self.nuts-1] is not self.last):
+      self.reset()
+      self.key = key
+      self._append({'role':'system', 'content':system_prompt or ''})
+    for i in range(self.nuts, end):
+      ut:Utterance = uts[i]
+      name = names.get(ut.actor_name, default_name)
+      self._append({'role':name, 'content':cont2str_fn(ut.contents)}) # [1]
+    if end > self.nuts:
+      self.nuts, self.last = end, uts[end-1]
+    return self.sau
+
+  def window(self, budget:int|None) -> tuple[SAU, int]:
+    """ Return the messages of the view fitting into `budget` tokens and their token count. The
+    system message and the last message are pinned, the oldest messages are dropped first. None
+    means no limit. """
+    if budget is None or self.total <= budget or len(self.sau) <= 2:
+      return self.sau, self.total
+    start, used = len(self.sau)-1, self.ntokens[0] + self.ntokens[-1]
+    while start > 1 and used + self.ntokens[start-1] <= budget:
+      start -= 1
+      used += self.ntokens[start]
+    return [self.sau[0]] + self.sau[start:], used
+
 
 def uts_2sau(
   uts:Utterances,
   names:dict[ActorName, str],
   default_name:str|None = None,
   system_prompt:str|None = None,
-  cache:dict[hash,SAU]|None = None,
+  log:SAULog|None = None,
   cont2str_fn:Callable[[Contents],Any] = cont2str,
 ) -> SAU:
-  """ Converts a list of Utterances into the System-Assistant-User JSON-like structure.
-
-  Parameters:
-  * ... - TODO
-  """
-  # In [1] we assume that Utterances do not contain streams.
-  def _cachekey(i):
-    return tuple([i, system_prompt, *tuple(names.items())])
-  racc:SAU = []
-  for i in reversed(range(0, len(uts))):
-    if cache is not None:
-      cache_key = _cachekey(i)
-      cached = cache.get(cache_key)
-      if cached is not None:
-        return cached + list(reversed(racc))
-    ut:Utterance = uts[i]
-    name = names.get(ut.actor_name, default_name)
-    # assert name in ['user','assistant'], f"Unknown SAU name {name}"
-    racc.append({'role':name, 'content':cont2str_fn(ut.contents)}) # [1]
-  racc.append({'role':'system', 'content':system_prompt or ''})
-  acc = list(reversed(racc))
-  if cache is not None:
-    cache[_cachekey(len(uts)-1)] = acc
-  return acc
-
+  """ Converts a list of Utterances into the System-Assistant-User JSON-like structure. If `log` is
+  given, it is updated incrementally and its view is returned, see `SAULog`. """
+  log = log if log is not None else SAULog()
+  return log.update(uts, names, default_name, system_prompt, cont2str_fn)
+
+
+def read_ahead(s:Stream, fn:Callable[[ContentItem],None]) -> Iterator[ContentItem]:
+  """ Read the stream `s` in a separate thread, calling `fn` for every item as soon as it is read,
+  and yield the items in their order. The reading stops once the caller stops iterating. """
+  items:Queue = Queue()
+  stop = Event()
+  end = object()
+  def _read():
+    try:
+      for item in s.gen():
+        fn(item)
+        items.put((item, None))
+        if stop.is_set():
+          break
+      items.put((end, None))
+    except BaseException as e:
+      items.put((end, e))
+  Thread(target=_read, daemon=True).start()
+  try:
+    while (x := items.get())[0] is not end:
+      yield x[0]
+    if x[1] is not None:
+      raise x[1]
+  finally:
+    stop.set()
 
 def traverse_stream(s:Stream,
-                    handler:Callable[[Stream, ContentItem], Stream|None]
+                    handler:Callable[[Stream, ContentItem], Stream|None],
+                    readahead:Callable[[ContentItem],None]|None=None
                     ) -> None:
   """ Read stream `s` of `ContentItem` items, call `handler` for every item and optionally dive into
-  the expanded stream in case the item is a reference. """
+  the expanded stream in case the item is a reference. If `readahead` is set, `s` is read in advance
+  and `readahead` is called for every item before the handler, e.g. to start downloading the
+  references while the handler is busy with the preceding items. """
   try:
-    def _traverse(s):
-      for item in s.gen():
+    def _traverse(s, items):
+      for item in items:
         s2 = handler(s,item)
         if s2 is not None:
-          _traverse(s2)
-    _traverse(s)
-  except RequestException as err:
-    raise ConversationException(str(err)) from err
+          _traverse(s2, s2.gen())
+    _traverse(s, s.gen() if readahead is None else read_ahead(s, readahead))
+  except Exception as err:
+    # Only dereferencing might raise `httpx` errors, so import it lazily.
+    from httpx import HTTPError
+    if isinstance(err, HTTPError):
+      raise ConversationException(str(err)) from err
+    raise
 
 def firstfile(paths) -> str|None:
   for p in paths:
@@ -268,6 +458,22 @@ def firstfile(paths) -> str|None:
       return p
   return None
 
+def cache_dir() -> str|None:
+  """ Return the directory for persistent caches, creating it if needed. The location is read from
+  the `AICLI_CACHE` environment variable (empty or 'none' disables caching) and defaults to
+  `$XDG_CACHE_HOME/aicli`. """
+  path = environ.get('AICLI_CACHE')
+  if path is None:
+    path = join(environ.get('XDG_CACHE_HOME') or expanduser(join('~', '.cache')), 'aicli')
+  if len(path) == 0 or path.lower() == 'none':
+    return None
+  try:
+    makedirs(path, exist_ok=True)
+  except OSError as e:
+    warn(f"Cache directory '{path}' is not available: {e}")
+    return None
+  return path
+
 def sys2exitcode(ret):
   if platform.startswith("win"):
     return ret
@@ -276,8 +482,9 @@ def sys2exitcode(ret):
     return WEXITSTATUS(ret)
 
 def version():
-  ver = VERSION
-  rev = f"+g{REVISION[:7]}" if REVISION else ""
+  ver = semver()
+  rev = revision()
+  rev = f"+g{rev[:7]}" if rev else ""
   return f"{ver}{rev}"
 
 @dataclass
@@ -357,6 +564,7 @@ def wraplong(text:str, state:WLState, printer:Callable, flush:bool=False):
 
 
 def add_transparent_rectangle(input_image:bytes|BytesIO, ratio:float=0.15):
+  from PIL import Image, ImageDraw
   # Open the input image from bytes
   input_image_bytesio = BytesIO(input_image) if isinstance(input_image, bytes) else input_image
   with Image.open(input_image_bytesio) as img:
@@ -403,21 +611,21 @@ def effective_verbosity(actor:Actor|None)->int:
 
 def err(s:str, actor:Actor|None=None)->None:
   if effective_verbosity(actor) > 0:
-    print(f"ERROR: {s}", file=stderr)
+    print(f"ERROR: {s}", file=sys.stderr)
     print_exc()
 
 def warn(s:str, actor:Actor|None=None)->None:
   if effective_verbosity(actor) > 1:
-    print(f"WARNING: {s}", file=stderr)
+    print(f"WARNING: {s}", file=sys.stderr)
 
 def info(s:str, actor:Actor|None=None, prefix=True)->None:
   if effective_verbosity(actor) > 2:
     prefix = "INFO: " if prefix else ""
-    print(f"{prefix}{s}", file=stderr)
+    print(f"{prefix}{s}", file=sys.stderr)
 
 def dbg(s:str, actor:Actor|None=None)->None:
   if effective_verbosity(actor) > 3:
-    print(f"DEBUG: {s}", file=stderr)
+    print(f"DEBUG: {s}", file=sys.stderr)
 
 class ConsoleLogger(Logger):
   def err(self, s:str):
@@ -453,6 +661,9 @@ def read_until_pattern(file:File, pattern:str, prompt:str) -> list[str]:
   return []
 
 
+# Default chunk size of binary downloads
+CHUNK_SIZE_DEF = 1024*1024
+
 def url2ext(url)->str|None:
   parsed_url = urlparse(url)
   query_params = parse_qs(parsed_url.query)
@@ -462,6 +673,28 @@ def url2ext(url)->str|None:
   else:
     return None
 
+# Chunk size of base64 decoding, characters
+B64_CHUNK_SIZE = 4*256*1024
+
+def b64save(data:str, image_dir:str|None, ext:str) -> str:
+  """ Decode base64 `data` into a file in `image_dir` chunk by chunk. The file is named after the
+  hash of its contents. Return the path of the file. The partial file is removed on errors. """
+  fdir = image_dir or "."
+  h = sha256()
+  f = NamedTemporaryFile('wb', dir=fdir, prefix='.', delete=False)
+  try:
+    with f:
+      for i in range(0, len(data), B64_CHUNK_SIZE):
+        chunk = b64decode(data[i:i+B64_CHUNK_SIZE])
+        h.update(chunk)
+        f.write(chunk)
+    path = join(fdir, f"{h.hexdigest()[:10]}.{ext}")
+    replace(f.name, path)
+  except BaseException:
+    unlink(f.name)
+    raise
+  return path
+
 def url2fname(url, image_dir:str|None)->str|None:
   ext = url2ext(url)
   base_name = sha256(url.encode()).hexdigest()[:10]
@@ -484,8 +717,19 @@ class TextStream(IterableStream):
       yield "\n"
 
 class BinStream(IterableStream):
-  def __init__(self, chunks, **kwargs):
-    super().__init__(chunks.iter_content(4*1024), binary=True, **kwargs)
+  """ Binary stream reading a streamed `httpx.Response` in chunks of `chunk_size` bytes. The chunk
+  size might be changed until the stream is read. """
+  def __init__(self, response, chunk_size:int|None=None, **kwargs):
+    self.chunk_size = chunk_size
+    self.response = response
+    def _gen():
+      try:
+        yield from response.iter_bytes(self.chunk_size or CHUNK_SIZE_DEF)
+      finally:
+        response.close()
+    super().__init__(_gen(), binary=True, **kwargs)
   def gen(self):
     yield from super().gen()
+  def close(self) -> None:
+    self.response.close()
 
@@ -54,9 +54,10 @@ setup(
   version=VERSION,
   package_dir={'': 'python'},
   packages=find_packages(where='python'),
+  package_data={'sm_aicli.actor': ['grammar-*.lark']},
   long_description=long_description,
   long_description_content_type="text/markdown",
-  install_requires=[gpt4all, 'openai', 'gnureadline', 'lark', 'pillow'],
+  install_requires=[gpt4all, 'openai', 'httpx', 'gnureadline', 'lark', 'pillow'],
   scripts=[
     join('.', 'python', 'aicli'),
     join('.', 'python', 'litrepl-aicli.py'),
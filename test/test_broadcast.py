@@ -0,0 +1,124 @@
+from threading import Event
+from time import sleep, perf_counter
+
+from sm_aicli.broadcast import Broadcast
+
+
+def test_broadcast_subscribers():
+  """ Every subscriber receives every token published after it has subscribed """
+  b = Broadcast(iter(f"t{i}" for i in range(1000)), capacity=64)
+  acc = []
+  sub = b.subscribe()
+  b.sink(acc.append)
+  assert list(sub) == [f"t{i}" for i in range(1000)]
+  b.join()
+  assert acc == [f"t{i}" for i in range(1000)]
+  assert b.nbytes == 0 and len(b.ring) == 0
+
+
+def test_broadcast_slow_sink():
+  """ A slow sink does not delay the fast subscriber while its lag fits into the buffer, and the
+  buffer never grows beyond its capacity """
+  release = Event()
+  acc, sizes = [], []
+  b = Broadcast(iter(["x"*10]*100), capacity=1000)
+  def _slow(token):
+    release.wait()
+    sizes.append(b.nbytes)
+    acc.append(token)
+  sub = b.subscribe()
+  b.sink(_slow)
+  t0 = perf_counter()
+  assert len(list(sub)) == 100
+  assert perf_counter() - t0 < 1
+  release.set()
+  b.join()
+  assert len(acc) == 100 and max(sizes) <= 1000
+
+  # The buffer is too small to hold the lag, the fast subscriber has to wait
+  b = Broadcast(iter(["x"*10]*10), capacity=20)
+  sub = b.subscribe()
+  b.sink(lambda _: sleep(0.05))
+  t0 = perf_counter()
+  assert len(list(sub)) == 10
+  assert perf_counter() - t0 > 0.2
+  b.join()
+
+
+def test_broadcast_close():
+  """ Closing the broadcast stops reading the source, the end callback is not called """
+  pulled = []
+  def _source():
+    for i in range(1000):
+      pulled.append(i)
+      yield "t"
+  ended = []
+  b = Broadcast(_source(), capacity=100)
+  sub = iter(b.subscribe())
+  b.sink(lambda _: None, lambda: ended.append(True))
+  for _ in range(10):
+    next(sub)
+  b.close()
+  b.join()
+  assert len(pulled) < 1000 and ended == []
+  b = Broadcast(iter(["a"]))
+  b.sink(lambda _: None, lambda: ended.append(True))
+  b.join()
+  assert ended == [True]
+
+
+def test_broadcast_follow():
+  """ Following sinks do not read the source on their own and stop once the leading subscriber is
+  closed """
+  pulled = []
+  def _source():
+    for i in range(100):
+      pulled.append(i)
+      yield "t"
+  release = Event()
+  acc = []
+  b = Broadcast(_source())
+  sub = iter(b.subscribe())
+  b.sink(lambda t: (release.wait(), acc.append(t)), follow=True)
+  assert not b.join(0.1) and pulled == []
+  next(sub), next(sub)
+  sub.close()
+  release.set()
+  assert b.join(1)
+  assert acc == ["t", "t"] and pulled == [0, 1]
+
+
+def test_chunk_stream_slow_sink(monkeypatch):
+  """ The reader of a reply waits for a stuck recorder for a limited time only and warns """
+  from types import SimpleNamespace
+  import sm_aicli.actor.openai as oa
+  warnings = []
+  monkeypatch.setattr(oa, 'SINK_TIMEOUT_DEF', 0.1)
+  monkeypatch.setattr(oa, 'warn', warnings.append)
+  release = Event()
+  recorded = []
+  recorder = SimpleNamespace(record=lambda t: (release.wait(), recorded.append(t)))
+  s = oa.TextChunkStream(recorder, iter(["a\n", "b\n"]))
+  b = s.broadcast
+  assert list(s.gen()) == ["a\n", "b\n"]
+  assert len(warnings) == 1 and s.broadcast is None
+  release.set()
+  assert b.join(1)
+  assert recorded == ["a\n", "b\n", f"{oa.CMD_ANS}\n"]
+
+
+def test_broadcast_error():
+  def _source():
+    yield "a"
+    raise ValueError("source failed")
+  b = Broadcast(_source())
+  acc = []
+  sub = b.subscribe()
+  b.sink(acc.append)
+  try:
+    list(sub)
+    assert False, "Expected an error"
+  except ValueError as e:
+    assert "source failed" in str(e)
+  b.join()
+  assert acc == ["a"]
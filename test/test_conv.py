@@ -1,5 +1,9 @@
 import re
 from textwrap import dedent
+from time import sleep
+from os import kill, getpid
+from signal import SIGINT
+from threading import Event, Barrier, current_thread, main_thread
 
 from sm_aicli import *
 
@@ -28,6 +32,79 @@ def test_uts_2sau():
   assert _map(sau) == \
     [[('role','system'), ('content','s')]]
 
+def test_saulog():
+  A = actor('A')
+  B = actor('B')
+  calls = []
+  def _cont2str(c):
+    calls.append(c)
+    return cont2str(c)
+  log = SAULog()
+  uts = [ut(A, 'a1', B), ut(B, 'b1', A)]
+  sau = log.update(uts, {A:'user'}, 'assistant', 's', _cont2str)
+  assert [d['content'] for d in sau] == ['s', 'a1', 'b1']
+  uts.append(ut(A, 'a2', B))
+  sau2 = log.update(uts, {A:'user'}, 'assistant', 's', _cont2str)
+  assert sau2 is sau and len(calls) == 3
+  assert [d['content'] for d in sau2] == ['s', 'a1', 'b1', 'a2']
+  # Prompt and names changes rebuild the view
+  sau = log.update(uts, {A:'user'}, 'assistant', 'p', _cont2str)
+  assert sau[0]['content'] == 'p' and len(calls) == 6
+  sau = log.update(uts, {A:'user', B:'b'}, 'assistant', 'p', _cont2str)
+  assert [d['role'] for d in sau] == ['system', 'user', 'b', 'user']
+  # A new conversation is not mixed with the old one
+  sau = log.update([ut(B, 'b2', A)], {A:'user'}, 'assistant', 'p', _cont2str)
+  assert [d['content'] for d in sau] == ['p', 'b2']
+  log.reset()
+  assert log.update([], {}, None, 's') == [{'role':'system', 'content':'s'}]
+
+def test_saulog_window():
+  A = actor('A')
+  B = actor('B')
+  log = SAULog(lambda m: len(m['content']))
+  uts = [ut(A, 'a'*10, B), ut(B, 'b'*20, A), ut(A, 'c'*30, B), ut(B, 'd'*5, A)]
+  sau = log.update(uts, {A:'user'}, 'assistant', 'sys')
+  assert log.total == 68
+  assert log.window(None) == (sau, 68)
+  assert log.window(100) == (sau, 68)
+  sau2, used = log.window(40)
+  assert [m['content'][0] for m in sau2] == ['s', 'c', 'd'] and used == 38
+  sau2, used = log.window(1)
+  assert [m['content'][0] for m in sau2] == ['s', 'd'] and used == 8
+  assert len(log.sau) == 5
+  assert sau_tokens({'role':'user', 'content':[{'type':'text', 'text':'Hello, world'}]}) > 0
+
+def test_spill_policy():
+  A = actor('A')
+  B = actor('B')
+  cnv = Conversation.init()
+  spill = SpillPolicy(threshold=25, keep=1)
+  for i in range(5):
+    cnv.utterances.append(ut(A if i%2 else B, f"{i}"*10, B if i%2 else A))
+    for _ in cnv.utterances[-1].contents.gen():
+      pass
+    spill.update(cnv)
+  assert spill.nbytes <= 25 and spill.spilled == 20
+  assert spill.segment is not None and spill.segment.size == 20
+  assert [cont2str(u.contents) for u in cnv.utterances] == [f"{i}"*10 for i in range(5)]
+  sau = uts_2sau(cnv.utterances, {A:'a'}, 'b', 's')
+  assert sau[1]['content'] == "0"*10
+
+def test_spill_unread():
+  """ Utterances are accounted once their streams are read """
+  A = actor('A')
+  B = actor('B')
+  cnv = Conversation.init()
+  spill = SpillPolicy(threshold=15, keep=0)
+  cnv.utterances.extend([ut(A, "a"*10, B), ut(B, "b"*10, A)])
+  spill.update(cnv)
+  assert spill.nuts == 0 and spill.nbytes == 0
+  for u in cnv.utterances:
+    for _ in u.contents.gen():
+      pass
+  assert spill.update(cnv) == 10
+  assert spill.nuts == 2 and spill.nbytes == 10
+
 def test_uts_lastref():
   A = actor('A')
   B = actor('B')
@@ -50,3 +127,201 @@ def test_uts_lastfull():
   assert ref is None
 
 
+def test_conversation_index():
+  A = actor('A')
+  B = actor('B')
+  cnv = Conversation.init()
+  cnv.utterances.extend([ut(B, 'b1', A), ut(A, 'a1', B), ut(B, 'b2', A), ut(B, None, A)])
+  assert uts_lastref(cnv, A) == 3
+  assert uts_lastfull(cnv, B) == 2
+  assert uts_lastfull(cnv, B, before=2) == 0
+  assert uts_lastfullref(cnv, A, before=True) == 2
+  cnv.utterances.append(ut(B, 'b3', B))
+  assert uts_lastfullref(cnv, A) == 4
+  assert uts_lastfullref(cnv, A, before=True) == 2
+  assert uts_lastref(cnv, B) == 4
+  fan = Utterance.init(B, Intention.init(fanout=[A, B]), IterableStream(['?']))
+  cnv.utterances.append(fan)
+  assert uts_lastref(cnv, A) == uts_lastref(cnv, B) == 5
+  cnv.reset()
+  assert uts_lastref(cnv, A) is None
+  cnv.utterances.append(ut(A, 'a2', B))
+  assert uts_lastref(cnv, B) == 0
+
+
+def test_conversation_index_threads():
+  """ Threads looking up a fresh index all see it fully built """
+  from threading import Thread, Barrier
+  A = actor('A')
+  B = actor('B')
+  cnv = Conversation.init()
+  cnv.utterances.extend([ut(B, 'b', A) if i % 2 else ut(A, 'a', B) for i in range(5000)])
+  barrier = Barrier(8)
+  results = []
+  def _lookup():
+    barrier.wait()
+    results.append((uts_lastref(cnv, A), uts_lastfull(cnv, A, before=4000)))
+  threads = [Thread(target=_lookup) for _ in range(8)]
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  assert results == [(4999, 3998)]*8
+
+
+class AsyncActor(Actor):
+  """ An actor implementing the asynchronous protocol only """
+  def reset(self):
+    pass
+  async def areact(self, act:ActorState, cnv:Conversation) -> Utterance:
+    prompt = ''.join([t async for t in cnv.utterances[-1].contents.agen()])
+    return Utterance.init(self.name, Intention.init(actor_next=UserName()),
+                          TextStream(iter([f"async: {prompt.strip()}"]), ensure_eol=True))
+
+def test_async_actor(tmp_path, capsys):
+  from sm_aicli.main import main
+  script = tmp_path / 'script.aicli'
+  script.write_text("/model dummy:async\nHello\n/ask\n")
+  main(['--rc', 'none', str(script)],
+       actor_factory_fn=lambda name, opt, file, recorder: AsyncActor(name, opt))
+  assert "async: Hello" in capsys.readouterr().out
+
+
+class StuckActor(Actor):
+  """ An actor getting stuck in its first reaction until the user presses Ctrl+C """
+  def __init__(self, name, opt):
+    super().__init__(name, opt)
+    self.threads = []
+    self.release = Event()
+  def reset(self):
+    pass
+  def react(self, act:ActorState, cnv:Conversation) -> Utterance:
+    self.threads.append(current_thread())
+    if len(self.threads) == 1:
+      sleep(0.1) # Let the loop start waiting for the thread
+      kill(getpid(), SIGINT)
+      self.release.wait(10)
+    return Utterance.init(self.name, Intention.init(actor_next=UserName()),
+                          TextStream(iter([f"reply {len(self.threads)}"]), ensure_eol=True))
+
+def test_interrupt_threaded_actor(tmp_path, capsys):
+  """ Synchronous actors react in worker threads, Ctrl+C returns control to the user """
+  from sm_aicli.main import main
+  script = tmp_path / 'script.aicli'
+  script.write_text("/model dummy:stuck\nHello\n/ask\nAgain\n/ask\n")
+  actors = []
+  def _factory(name, opt, file, recorder):
+    actors.append(StuckActor(name, opt))
+    return actors[-1]
+  try:
+    main(['--rc', 'none', str(script)], actor_factory_fn=_factory)
+  finally:
+    actors[0].release.set()
+  out = capsys.readouterr().out
+  assert "reply 1" not in out and "reply 2" in out
+  assert main_thread() not in actors[0].threads
+
+
+class FanoutActor(Actor):
+  """ An actor replying with its name. Replies wait for each other at the barrier, if any, so they
+  only complete if they are read concurrently. Actor `bad` fails. """
+  barrier = None
+  def reset(self):
+    pass
+  def react(self, act:ActorState, cnv:Conversation) -> Utterance:
+    if self.name.model == 'bad':
+      raise ConversationException("Bad actor")
+    def _gen():
+      yield f"{self.name.model}\n"
+      if self.barrier is not None:
+        self.barrier.wait(5)
+      yield "done\n"
+    return Utterance.init(self.name, Intention.init(actor_next=UserName()), TextStream(_gen()))
+
+def test_fanout(tmp_path, capsys, monkeypatch):
+  """ Fan-out replies are read concurrently into separate buffers """
+  from sm_aicli.main import main
+  monkeypatch.setattr(FanoutActor, 'barrier', Barrier(3))
+  script = tmp_path / 'script.aicli'
+  script.write_text("Hi\n/fanout dummy:a dummy:b dummy:c(x)\n/cat buffer:x\n/cat buffer:a\n")
+  main(['--rc', 'none', str(script)],
+       actor_factory_fn=lambda name, opt, file, recorder: FanoutActor(name, opt))
+  out = capsys.readouterr().out
+  for name, model in [('a','a'), ('b','b'), ('x','c')]:
+    assert f"[{name}] {model}\n" in out
+    assert f"[{name}] done\n" in out
+  assert "c\ndone\n\na\ndone\n" in out
+
+def test_fanout_failure(tmp_path, capsys):
+  """ Replies of the other actors are kept if one of the actors fails """
+  from sm_aicli.main import main
+  script = tmp_path / 'script.aicli'
+  script.write_text("Hi\n/fanout dummy:a dummy:bad\n/cat buffer:a\n")
+  main(['--rc', 'none', str(script)],
+       actor_factory_fn=lambda name, opt, file, recorder: FanoutActor(name, opt))
+  out, err = capsys.readouterr()
+  assert "[a] done\n" in out and "a\ndone\n" in out
+  assert "Bad actor" in err
+
+def test_fanout_reserved(tmp_path, capsys):
+  """ Fan-out replies never overwrite the input and output buffers """
+  from sm_aicli.main import main
+  script = tmp_path / 'script.aicli'
+  script.write_text("Hi\n/fanout dummy:a dummy:out\n")
+  main(['--rc', 'none', str(script)],
+       actor_factory_fn=lambda name, opt, file, recorder: FanoutActor(name, opt))
+  out, err = capsys.readouterr()
+  assert "Buffer 'out' is reserved" in err
+  assert "[a]" not in out
+
+
+class RefActor(Actor):
+  """ An actor replying with references to two remote images """
+  def reset(self):
+    pass
+  def react(self, act:ActorState, cnv:Conversation) -> Utterance:
+    refs = [RemoteReference('image/png', f"http://x/{i}.png") for i in [1, 2]]
+    return Utterance.init(self.name, Intention.init(actor_next=UserName()), IterableStream(refs))
+
+def test_download_cancel(tmp_path, capsys, monkeypatch):
+  """ Downloads started in advance are stopped once the printing fails """
+  from sm_aicli.main import main, ActorStateImpl
+  started, release, closed = Event(), Event(), Event()
+  class _Stream(IterableStream):
+    def close(self):
+      closed.set()
+  def _deref(self, ref, name=None):
+    if ref.url.endswith('1.png'):
+      started.wait(5)
+      raise ConversationException("Image 1 is not available")
+    started.set()
+    release.wait(5) # The printing has failed by now
+    return LocalReference(ref.mimetype, str(tmp_path / '2.png')), _Stream(iter([b"x"]), binary=True)
+  monkeypatch.setattr(ActorStateImpl, 'deref', _deref)
+  script = tmp_path / 'script.aicli'
+  script.write_text("/model dummy:refs\nHello\n/ask\n")
+  try:
+    main(['--rc', 'none', str(script)],
+         actor_factory_fn=lambda name, opt, file, recorder: RefActor(name, opt))
+  finally:
+    release.set()
+  assert "Image 1 is not available" in capsys.readouterr().err
+  assert closed.wait(5)
+  assert not (tmp_path / '2.png').exists()
+
+def test_deref_image_dir(tmp_path, monkeypatch):
+  """ Remote images are saved to the image directory of the actor which has produced them """
+  from sys import modules
+  from types import SimpleNamespace
+  m = modules['sm_aicli.main']
+  client = SimpleNamespace(build_request=lambda method, url: url,
+                           send=lambda req, stream: SimpleNamespace(raise_for_status=lambda: None))
+  monkeypatch.setattr(m, 'http_client', lambda: client)
+  model = ModelName('test', 'img')
+  ast = ActorStateImpl({UserName(): SimpleNamespace(opt=ActorOptions(image_dir=None)),
+                        model: SimpleNamespace(opt=ActorOptions(image_dir=str(tmp_path)))})
+  ref = RemoteReference('image/png', 'https://example.com/a?rsct=image/png')
+  lref, _ = ast.deref(ref, model)
+  assert lref.path.startswith(str(tmp_path))
+  lref, _ = ast.deref(ref)
+  assert not lref.path.startswith(str(tmp_path))
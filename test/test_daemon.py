@@ -0,0 +1,65 @@
+import sys
+from os import environ
+from os.path import join, dirname, abspath, exists
+from subprocess import run, Popen, PIPE, DEVNULL
+from time import sleep
+
+AICLI = join(dirname(dirname(abspath(__file__))), 'python', 'aicli')
+PYDIR = dirname(AICLI)
+
+SCRIPT = "/model dummy:dummy\n/set model apikey verbatim:KEY\nHello daemon\n/ask\n/echo done\n"
+
+def _aicli(args, env, input=None):
+  return run([sys.executable, AICLI] + args, input=input, stdout=PIPE, stderr=PIPE, text=True,
+             env=env, check=True)
+
+def test_daemon_session(tmp_path):
+  """ Sessions run in the daemon produce the same output as local sessions """
+  sock = str(tmp_path / 'aicli.sock')
+  env = dict(environ, PYTHONPATH=PYDIR, AICLI_RC='none', AICLI_SOCKET=sock)
+  (tmp_path / 'script.aicli').write_text(SCRIPT)
+  local = _aicli(['script.aicli'], dict(env, AICLI_CWD=str(tmp_path)))
+
+  daemon = Popen([sys.executable, AICLI, '--daemon'], stdin=DEVNULL, stdout=DEVNULL,
+                 stderr=DEVNULL, env=env)
+  try:
+    for _ in range(100):
+      if exists(sock):
+        break
+      sleep(0.05)
+    for _ in range(2):
+      remote = _aicli(['--connect', '-C', str(tmp_path), 'script.aicli'], env)
+      assert remote.stdout == local.stdout
+      assert 'I am a dummy actor' in remote.stdout
+    piped = _aicli(['--connect', '-m', 'dummy:dummy'], env, input="Hi\n/ask\n")
+    assert "You said:\n```\nHi\n```" in piped.stdout
+    # A second daemon does not take the socket over
+    second = run([sys.executable, AICLI, '--daemon'], stdin=DEVNULL, stdout=PIPE, stderr=PIPE,
+                 text=True, env=env, timeout=30)
+    assert second.returncode == 1 and 'Another daemon' in second.stderr + second.stdout
+    assert 'dummy actor' in _aicli(['--connect', '-m', 'dummy:dummy'], env, input="/ask\n").stdout
+  finally:
+    daemon.terminate()
+    daemon.wait()
+
+def test_connect_fallback(tmp_path):
+  """ The client runs the session locally if the daemon is not available """
+  env = dict(environ, PYTHONPATH=PYDIR, AICLI_RC='none', AICLI_SOCKET=str(tmp_path / 'no.sock'))
+  res = _aicli(['--connect', '-m', 'dummy:dummy'], env, input="Hi\n/ask\n")
+  assert "I am a dummy actor" in res.stdout
+
+def test_daemon_privacy(tmp_path, monkeypatch):
+  """ Only the variables aicli uses are forwarded, the socket directory must be private """
+  from pytest import raises
+  from sm_aicli.daemon import client_env, private_dir
+  monkeypatch.setenv('OPENAI_API_KEY', 'sk-test')
+  monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'secret')
+  env = client_env()
+  assert env['OPENAI_API_KEY'] == 'sk-test' and 'AWS_SECRET_ACCESS_KEY' not in env
+  assert env['PATH'] == environ['PATH']
+  private_dir(str(tmp_path / 'private'))
+  assert (tmp_path / 'private').stat().st_mode & 0o777 == 0o700
+  (tmp_path / 'shared').mkdir(mode=0o755)
+  (tmp_path / 'shared').chmod(0o755)
+  with raises(PermissionError):
+    private_dir(str(tmp_path / 'shared'))
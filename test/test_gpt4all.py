@@ -0,0 +1,58 @@
+from contextlib import contextmanager
+from threading import Thread, Lock
+from time import sleep
+from types import SimpleNamespace
+from pytest import importorskip
+
+from sm_aicli import (ModelName, ActorOptions, UserName, Utterance, Intention, Conversation,
+                      IterableStream)
+
+
+class _FakeGPT4All:
+  """ Records the overlapping generations of the native model """
+  def __init__(self, path):
+    self.model = SimpleNamespace(active=0, overlaps=0, set_thread_count=lambda n: None)
+    self._history = None
+
+  @contextmanager
+  def chat_session(self):
+    self._history = [{'role':'system', 'content':''}]
+    try:
+      yield self
+    finally:
+      self._history = None
+
+  def generate(self, prompt, streaming, callback, **kwargs):
+    self._history.append({'role':'user', 'content':prompt})
+    self._history.append({'role':'assistant', 'content':''})
+    def _gen():
+      self.model.active += 1
+      self.model.overlaps += int(self.model.active > 1)
+      for token in ["a", "b"]:
+        sleep(0.05)
+        yield token
+      self.model.active -= 1
+    return _gen()
+
+
+def test_gpt4all_shared_model(monkeypatch):
+  """ Aliases of a model share the weights but not the chat sessions, and never generate at once """
+  g = importorskip('sm_aicli.actor.gpt4all')
+  monkeypatch.setattr(g, 'GPT4All', _FakeGPT4All)
+  monkeypatch.setattr(g, 'MODELS', {})
+  names = [ModelName('gpt4all', 'model.gguf', alias) for alias in ['a', 'b']]
+  actors = [g.GPT4AllActor(n, ActorOptions()) for n in names]
+  assert actors[0].gpt4all.model is actors[1].gpt4all.model
+  assert actors[0].gpt4all is not actors[1].gpt4all
+  replies = {}
+  def _ask(actor):
+    cnv = Conversation([Utterance.init(UserName(), Intention.init(fanout=names),
+                                       IterableStream(["Hi"]))])
+    replies[actor.name] = list(actor.react(None, cnv).contents.gen())
+  threads = [Thread(target=_ask, args=(a,)) for a in actors]
+  for t in threads:
+    t.start()
+  for t in threads:
+    t.join()
+  assert all(r == ["a", "b"] for r in replies.values()) and len(replies) == 2
+  assert actors[0].gpt4all.model.overlaps == 0
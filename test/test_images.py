@@ -0,0 +1,55 @@
+from pytest import importorskip, raises
+from threading import Barrier, Lock, current_thread
+from types import SimpleNamespace
+
+from sm_aicli import ModelName, ActorOptions, ConversationException, RemoteReference
+
+
+def test_image_batches():
+  from sm_aicli.actor.openai import image_batches
+  assert image_batches('dall-e-3', 3) == [1, 1, 1]
+  assert image_batches('dall-e-2', 23) == [10, 10, 3]
+  assert image_batches('dall-e-2', 1) == [1]
+
+
+def _actor(model:str, imgnum:int, fail:set[int], parties:int|None=None):
+  """ Image actor with a fake client, failing the requests with the numbers from `fail`. The
+  requests wait for each other in groups of `parties`, all of them by default. """
+  importorskip('httpx')
+  from openai import OpenAIError
+  from openai.types.image import Image
+  from sm_aicli.actor.openai import OpenAIImageActor
+  actor = OpenAIImageActor(ModelName('openai', model), ActorOptions(apikey='sk-test', imgnum=imgnum),
+                           file=None)
+  barrier = Barrier(parties or imgnum, timeout=5) # Breaks unless the requests run at once
+  lock, calls, actor.threads = Lock(), [], set()
+  def _generate(prompt, model, n, size, response_format):
+    with lock:
+      i = len(calls)
+      calls.append(n)
+      actor.threads.add(current_thread())
+    barrier.wait()
+    if i in fail:
+      raise OpenAIError(f"request {i} failed")
+    return SimpleNamespace(data=[Image(url=f"http://x/{i}-{j}.png") for j in range(n)])
+  actor.client = SimpleNamespace(images=SimpleNamespace(generate=_generate))
+  return actor, calls
+
+
+def test_image_requests_concurrent():
+  actor, calls = _actor('dall-e-3', 3, fail={1})
+  u = actor._react_image_create(None, "a cat")
+  assert calls == [1, 1, 1]
+  refs = list(u.contents.gen())
+  assert len(refs) == 2 and all(isinstance(r, RemoteReference) for r in refs)
+  actor, _ = _actor('dall-e-3', 2, fail={0, 1})
+  with raises(ConversationException):
+    actor._react_image_create(None, "a cat")
+
+
+def test_image_requests_limit():
+  from sm_aicli.actor.openai import IMAGE_WORKERS_DEF
+  actor, calls = _actor('dall-e-3', 2*IMAGE_WORKERS_DEF, fail=set(), parties=IMAGE_WORKERS_DEF)
+  u = actor._react_image_create(None, "a cat")
+  assert len(list(u.contents.gen())) == len(calls) == 2*IMAGE_WORKERS_DEF
+  assert len(actor.threads) == IMAGE_WORKERS_DEF
@@ -0,0 +1,61 @@
+import sys
+from os import environ
+from os.path import join, dirname, abspath
+from subprocess import run, PIPE
+
+PYDIR = join(dirname(dirname(abspath(__file__))), 'python')
+
+def _loaded(code:str, modules:list[str]) -> list[str]:
+  probe = f"{code}\nimport sys\nprint(' '.join(m for m in {modules!r} if m in sys.modules))"
+  env = dict(environ, PYTHONPATH=PYDIR, AICLI_RC='none')
+  res = run([sys.executable, '-c', probe], stdout=PIPE, env=env, text=True, check=True)
+  return res.stdout.strip().splitlines()[-1].split() if res.stdout.strip() else []
+
+def test_lazy_providers():
+  """ Provider SDKs are not imported until a provider is requested """
+  heavy = ['openai', 'gpt4all', 'httpx', 'PIL', 'requests']
+  assert _loaded("import sm_aicli.main", heavy) == []
+  assert _loaded("from sm_aicli.main import ACTOR_PROVIDERS", heavy) == []
+  assert _loaded("from sm_aicli import OpenAITextActor", ['openai']) == ['openai']
+
+def _fakebin(tmp_path, names:list[str]):
+  """ Put executables which record their invocations into `tmp_path/bin` """
+  bindir = tmp_path / 'bin'
+  bindir.mkdir()
+  for name in names:
+    exe = bindir / name
+    exe.write_text(f"#!/bin/sh\necho {name} >>{tmp_path / 'calls.log'}\necho 0123456789abcdef\n")
+    exe.chmod(0o755)
+  return bindir
+
+def test_no_subprocess_on_import(tmp_path):
+  """ Version metadata is not computed by running git or setup.py at import time """
+  bindir = _fakebin(tmp_path, ['git', 'python3'])
+  env = dict(environ, PYTHONPATH=PYDIR, AICLI_RC='none', AICLI_ROOT=str(tmp_path),
+             PATH=f"{bindir}:{environ.get('PATH','')}")
+  env.pop('AICLI_REVISION', None)
+  (tmp_path / 'semver.txt').write_text("1.2.3\n")
+  run([sys.executable, '-c', "import sm_aicli.main"], env=env, check=True)
+  assert not (tmp_path / 'calls.log').exists()
+  res = run([sys.executable, '-c', "from sm_aicli.main import main; main(['--version'])"],
+            stdout=PIPE, env=env, text=True, check=True)
+  assert res.stdout.strip() == "1.2.3+g0123456"
+  assert (tmp_path / 'calls.log').read_text().split() == ['git']
+
+def test_version_constants(tmp_path, monkeypatch):
+  """ `REVISION` and `VERSION` constants are still available """
+  import sm_aicli
+  from sm_aicli import utils
+  monkeypatch.setenv('AICLI_REVISION', '0123456789abcdef')
+  monkeypatch.setenv('AICLI_ROOT', str(tmp_path))
+  (tmp_path / 'semver.txt').write_text("1.2.3\n")
+  utils.revision.cache_clear()
+  utils.semver.cache_clear()
+  try:
+    assert utils.REVISION == sm_aicli.REVISION == '0123456789abcdef'
+    assert utils.VERSION == sm_aicli.VERSION == '1.2.3'
+    from sm_aicli.utils import REVISION
+    assert REVISION == '0123456789abcdef'
+  finally:
+    utils.revision.cache_clear()
+    utils.semver.cache_clear()
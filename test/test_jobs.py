@@ -0,0 +1,36 @@
+import sys
+from os import environ
+from os.path import join, dirname, abspath
+from subprocess import run, PIPE
+
+AICLI = join(dirname(dirname(abspath(__file__))), 'python', 'aicli')
+
+def _aicli(args, cwd):
+  env = dict(environ, PYTHONPATH=dirname(AICLI), AICLI_RC='none')
+  env.pop('AICLI_CWD', None)
+  return run([sys.executable, AICLI] + args, stdout=PIPE, stderr=PIPE, text=True, env=env,
+             cwd=cwd)
+
+def test_jobs(tmp_path):
+  """ Every file runs in its own session, results are reported per file """
+  (tmp_path / 'a.aicli').write_text("/model dummy:a\nOne\n/cp verbatim:A buffer:x\n/ask\n/cat x\n")
+  (tmp_path / 'b.aicli').write_text("/model dummy:b\nTwo\n/cat x\n/ask\n")
+  res = _aicli(['-j', '2', 'a.aicli', 'b.aicli'], tmp_path)
+  assert res.returncode == 0
+  a = res.stdout.split("==> a.aicli <==\n")[1].split("==>")[0]
+  b = res.stdout.split("==> b.aicli <==\n")[1].split("==>")[0]
+  assert "I am a dummy actor 'dummy:a'" in a and "One" in a and "\nA\n" in a
+  assert "I am a dummy actor 'dummy:b'" in b and "Two" in b and "\nA\n" not in b
+  summary = res.stdout.split("FILE")[-1].splitlines()
+  assert [l.split()[:2] for l in summary[1:3]] == [['a.aicli', '0'], ['b.aicli', '0']]
+  assert summary[3].startswith("2 files, 0 failed")
+
+def test_jobs_dir(tmp_path):
+  """ Sessions run in separate working directories """
+  (tmp_path / 'a.aicli').write_text("/pwd\n/cp verbatim:A file:out.txt\n")
+  res = _aicli(['-j', '2', '--jobs-dir', 'jobs', 'a.aicli', 'a.aicli'], tmp_path)
+  assert res.returncode == 0
+  for name in ['a', 'a-1']:
+    jobdir = tmp_path / 'jobs' / name
+    assert (jobdir / 'out.txt').read_text() == "A"
+    assert (jobdir / 'stdout.txt').read_text().startswith(str(jobdir) + "\n")
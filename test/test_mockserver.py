@@ -0,0 +1,71 @@
+from http.client import HTTPConnection
+from json import loads as json_loads, dumps as json_dumps
+from pytest import importorskip
+
+from sm_aicli import ActorOptions
+from sm_aicli.mockserver import MockServer, MockOptions, reply_tokens
+
+
+def _serve(**kwargs) -> MockServer:
+  return MockServer(MockOptions(rate=0, **kwargs)).start()
+
+def _post(server:MockServer, path:str, obj:dict) -> tuple[int, bytes]:
+  conn = HTTPConnection(*server.server_address[:2])
+  conn.request('POST', path, json_dumps(obj), {'Content-Type': 'application/json'})
+  resp = conn.getresponse()
+  return resp.status, resp.read()
+
+
+def test_reply_tokens():
+  assert reply_tokens("a b", 3) == ["a", " b", " a"]
+  assert ''.join(reply_tokens("", 2)) == "Lorem ipsum"
+
+
+def test_mock_chat_stream():
+  server = _serve(chunk_size=2, ntokens=5)
+  try:
+    request = {'model': 'gpt-4o', 'stream': True,
+               'messages': [{'role': 'user', 'content': 'one two three'}]}
+    status, body = _post(server, '/v1/chat/completions', request)
+    assert status == 200
+    events = [e[len('data: '):] for e in body.decode().split('\n\n') if e]
+    assert events[-1] == '[DONE]'
+    deltas = [json_loads(e)['choices'][0]['delta'].get('content') for e in events[:-1]]
+    assert deltas == ['', 'one two', ' three one', ' two', None]
+  finally:
+    server.stop()
+
+
+def test_mock_errors():
+  server = _serve(error_rate=1.0, error_status=429)
+  try:
+    status, body = _post(server, '/v1/chat/completions', {'messages': []})
+    assert status == 429 and 'error' in json_loads(body)
+  finally:
+    server.stop()
+
+
+def test_mock_openai_client(tmp_path):
+  """ The OpenAI SDK streams, uploads and generates images through the mock server """
+  importorskip('httpx')
+  from sm_aicli.actor.openai import openai_client
+  from sm_aicli.uploads import upload_file_parallel
+  server = _serve(text="Hello world", ntokens=2)
+  try:
+    client = openai_client(ActorOptions(apikey='sk-test', base_url=server.base_url))
+    chunks = client.chat.completions.create(
+      model='gpt-4o', messages=[{'role': 'user', 'content': 'hi'}], stream=True)
+    assert ''.join(c.choices[0].delta.content or '' for c in chunks) == "Hello world"
+    f = tmp_path / 'doc.pdf'
+    f.write_bytes(b'x' * 2500)
+    upload = upload_file_parallel(client.uploads, str(f), 'application/pdf', 'assistants',
+                                  part_size=1000)
+    assert upload.status == 'completed'
+    assert client.files.retrieve(upload.file.id).bytes == 2500
+    images = client.images.generate(prompt='a cat', model='dall-e-2', n=2,
+                                    response_format='url')
+    assert len(images.data) == 2
+    r = client._client.get(images.data[0].url)
+    assert r.content.startswith(b'\x89PNG')
+  finally:
+    server.stop()
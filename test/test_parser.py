@@ -1,6 +1,7 @@
 import re
 from textwrap import dedent
 from pytest import raises
+from lark import Lark
 from lark.exceptions import LarkError
 
 from sm_aicli import *
@@ -142,6 +143,59 @@ def test_apikey():
           string       keydata
   ''')
 
+def test_transport_options():
+  _assert('/set model poolsize 4', r'''
+    start
+      command
+        /set
+
+        model
+
+        poolsize
+
+        4
+  ''')
+  for val in ['30', '2.5', 'default']:
+    _assert(f'/set model timeout {val}', f'''
+      start
+        command
+          /set
+
+          model
+
+          timeout
+
+          {val}
+    ''')
+
+def test_ctxsize():
+  for val in ['4096', 'default']:
+    _assert(f'/set model ctxsize {val}', f'''
+      start
+        command
+          /set
+
+          model
+
+          ctxsize
+
+          {val}
+    ''')
+
+def test_imginline():
+  for val in ['on', 'default']:
+    _assert(f'/set model imginline {val}', f'''
+      start
+        command
+          /set
+
+          model
+
+          imginline
+
+          {val}
+    ''')
+
 def test_model_1():
   _assert('/model "aaa"', r'''
     start
@@ -247,6 +301,35 @@ def test_ref_5():
       text
   ''')
 
+def test_ref_spaces():
+  """ Spaces inside the file reference parentheses are not a part of the inner reference """
+  _assert('/cat file( buffer:x )', r'''
+    start
+      command
+        /cat
+
+        ref_file
+          file
+          (
+
+          ref
+            buffer
+            string       x
+
+          )
+  ''')
+
+def test_ref_empty_schema():
+  """ A schema without a value is parsed as a file name """
+  _assert('/cat verbatim:', r'''
+    start
+      command
+        /cat
+
+        ref
+          string       verbatim:
+  ''')
+
 def test_ref_6():
   """ Here the `aaa/cat` is parsed as a file name and the `verbatim:bbb` is parsed as text """
   _assert('/cat file:aaa/cat text', r'''
@@ -347,3 +430,142 @@ def test_empty_string():
 
         string
   ''')
+
+def test_model_alias():
+  _assert('/model openai:gpt-4o(A) xxx', r'''
+    start
+      command
+        /model
+
+        model_ref
+          openai
+          string       gpt-4o
+          A
+      text        xxx
+  ''')
+
+def test_fanout():
+  _assert('/fanout openai:gpt-4o gpt4all:x.gguf(local)', r'''
+    start
+      command
+        /fanout
+
+        model_ref
+          openai
+          string       gpt-4o
+
+        model_ref
+          gpt4all
+          string       x.gguf
+          local
+  ''')
+
+def test_multiline_string():
+  _assert('/cp verbatim:"a\nb" buffer:x text', r'''
+    start
+      command
+        /cp
+
+        ref
+          verbatim
+          string       a
+    b
+
+        ref
+          buffer
+          string       x
+      text        text
+  ''')
+
+def test_statements():
+  """ Statements are produced one at a time and carry absolute positions """
+  text = '/echo a\n/ask\nb//'
+  it = PARSER.statements(text)
+  t = next(it)
+  assert (t.data, t.meta.end_pos) == ('command', 5)
+  t = next(it)
+  assert (t.data, t.meta.end_pos) == ('text', 8)
+  t = next(it)
+  assert (t.data, t.meta.start_pos, t.meta.end_pos) == ('command', 8, 12)
+  assert text[t.meta.end_pos:] == '\nb//'
+  t = next(it)
+  assert (t.data, str(t.children[0])) == ('text', '\nb')
+  with raises(ValueError):
+    next(it)
+
+def test_grammar_cache(tmp_path, monkeypatch):
+  """ The compiled grammar is saved to the cache directory and re-used """
+  monkeypatch.setenv('AICLI_CACHE', str(tmp_path))
+  p1 = StatementParser(GRAMMAR)
+  assert p1._lalr is None
+  t1 = p1.parse('/cat file:a').pretty()
+  assert (tmp_path / p1.tables_name()).exists()
+  p2 = StatementParser(GRAMMAR)
+  assert p2.parse('/cat file:a').pretty() == t1
+
+def test_grammar_save(tmp_path):
+  path = PARSER.save(str(tmp_path))
+  with open(path, 'rb') as f:
+    lalr = Lark.load(f)
+  assert lalr.parse('/cat file:a') == PARSER.lalr.parse('/cat file:a')
+
+def test_download_options():
+  _assert('/set term chunksize 65536', r'''
+    start
+      command
+        /set
+
+        term
+
+        chunksize
+
+        65536
+  ''')
+  _assert('/set terminal fsync on', r'''
+    start
+      command
+        /set
+
+        terminal
+
+        fsync
+
+        on
+  ''')
+
+def test_adjacent_quotes():
+  """ Adjacent quoted strings make an unquoted string, quoted strings are still recognized """
+  _assert("/cp verbatim:'it''s' buffer:x", r'''
+    start
+      command
+        /cp
+
+        ref
+          verbatim
+          string       'it''s'
+
+        ref
+          buffer
+          string       x
+  ''')
+  _assert("/cat file('a b')", r'''
+    start
+      command
+        /cat
+
+        ref_file
+          file
+          (
+          ref
+            string       a b
+          )
+  ''')
+
+def test_unterminated_quote(monkeypatch):
+  """ Commands with unterminated quotes are not looked for beyond the maximum command size """
+  import sm_aicli.actor.user as user
+  monkeypatch.setattr(user, 'COMMAND_SIZE_MAX', 100)
+  text = "/cp verbatim:'a\n" + "b\n"*100 + "' buffer:x"
+  assert next(PARSER.statements(text)).data == 'text'
+  monkeypatch.setattr(user, 'COMMAND_SIZE_MAX', 1000)
+  assert next(PARSER.statements(text)).data == 'command'
@@ -0,0 +1,81 @@
+import sys
+from os import utime, environ, listdir
+from os.path import join, dirname, abspath
+from subprocess import Popen
+from time import time
+
+from sm_aicli.respcache import ResponseCache, request_key
+
+PYDIR = join(dirname(dirname(abspath(__file__))), 'python')
+
+
+def test_request_key():
+  sau = [{'role':'system', 'content':''}, {'role':'user', 'content':'Hi'}]
+  k1 = request_key(model='gpt-4o', messages=sau, temperature=None, seed=1)
+  k2 = request_key(seed=1, temperature=None, messages=[dict(reversed(m.items())) for m in sau],
+                   model='gpt-4o')
+  assert k1 == k2
+  assert k1 != request_key(model='gpt-4o', messages=sau, temperature=0.5, seed=1)
+
+
+def test_response_cache(tmp_path):
+  cache = ResponseCache(str(tmp_path), size=28)
+  assert cache.get('a') is None
+  cache.put('a', 'x'*10)
+  cache.put('b', 'y'*10)
+  assert cache.get('a') == 'x'*10
+  # `a` was used recently, so `b` is evicted
+  utime(join(str(tmp_path), 'b'), (time()-100, time()-100))
+  cache.put('c', 'z'*10)
+  assert cache.get('b') is None
+  assert cache.get('a') == 'x'*10 and cache.get('c') == 'z'*10
+
+
+def test_response_cache_scans(tmp_path, monkeypatch):
+  """ The directory is scanned only once the estimated size exceeds the limit """
+  import sm_aicli.respcache as rc
+  scans = []
+  listdir = rc.listdir
+  monkeypatch.setattr(rc, 'listdir', lambda p: scans.append(p) or listdir(p))
+  cache = ResponseCache(str(tmp_path), size=25)
+  for k in 'abcd':
+    cache.put(k, 'x'*10)
+  assert len(scans) == 2 # The first put and the overflowing third one
+  assert cache.get('a') is None and cache.get('b') is None
+  assert cache.get('c') == cache.get('d') == 'x'*10
+
+
+def test_response_cache_failed_put(tmp_path, monkeypatch):
+  """ A failed put leaves no temporary files behind """
+  import sm_aicli.respcache as rc
+  def _replace(src, dst):
+    raise OSError("disk full")
+  monkeypatch.setattr(rc, 'replace', _replace)
+  cache = ResponseCache(str(tmp_path))
+  try:
+    cache.put('a', 'x')
+    assert False, "put should fail"
+  except OSError:
+    pass
+  assert listdir(str(tmp_path)) == []
+
+
+def test_response_cache_processes(tmp_path):
+  """ Concurrent writers never expose partially written responses """
+  code = ("import sys; from sm_aicli.respcache import ResponseCache; "
+          "c = ResponseCache(sys.argv[1]); [c.put('k', sys.argv[2]*100000) for _ in range(20)]")
+  env = dict(environ, PYTHONPATH=PYDIR)
+  procs = [Popen([sys.executable, '-c', code, str(tmp_path), ch], env=env) for ch in 'ab']
+  assert all(p.wait() == 0 for p in procs)
+  assert ResponseCache(str(tmp_path)).get('k') in ['a'*100000, 'b'*100000]
+
+
+def test_text_chunk_stream_complete():
+  from sm_aicli.actor.openai import TextChunkStream
+  class _Recorder:
+    def record(self, chunk):
+      pass
+  acc = []
+  s = TextChunkStream(_Recorder(), iter(["Hel", "lo"]), acc.append)
+  assert list(s.gen()) == ["Hel", "lo", "\n"]
+  assert acc == ["Hello\n"]
@@ -0,0 +1,79 @@
+from json import loads as json_loads, dumps as json_dumps
+from time import sleep
+
+from sm_aicli import *
+from sm_aicli.stats import Histogram, Stats, StreamStats
+
+
+def test_histogram():
+  h = Histogram()
+  assert h.quantile(0.5) is None
+  for v in range(1, 1001):
+    h.add(float(v))
+  assert h.count == 1000 and h.min == 1 and h.max == 1000
+  assert abs(h.quantile(0.5) - 500) < 100
+  assert abs(h.quantile(0.9) - 900) < 180
+  assert h.quantile(1.0) == 1000
+  h2 = Histogram()
+  h2.add(0.0)
+  h2.merge(h)
+  assert h2.count == 1001 and h2.min == 0 and h2.quantile(0) == 0
+
+
+def test_stream_stats():
+  def _gen():
+    sleep(0.05)
+    for t in ["a", "bb", "ccc"]:
+      yield t
+      sleep(0.01)
+  s = IterableStream(_gen())
+  assert list(s.gen()) == ["a", "bb", "ccc"]
+  st = s.stats
+  assert st.ntokens == 3 and st.nbytes == 6
+  assert st.ttft() >= 0.05
+  assert st.itl.count == 2 and st.itl.min >= 10
+  assert st.tps() is not None
+
+
+def test_ttft_request(monkeypatch):
+  """ Time to the first token of a model reply includes sending the request """
+  from types import SimpleNamespace
+  import sm_aicli.actor.openai as oa
+  def _create(**kwargs):
+    sleep(0.1) # Waiting for the response headers
+    return iter([SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content="Hi"))])])
+  class _Recorder:
+    def record(self, chunk):
+      pass
+  actor = oa.OpenAITextActor(ModelName('openai', 'gpt-4o'), ActorOptions(apikey='sk-test'),
+                             None, _Recorder())
+  actor.client = SimpleNamespace(base_url='http://x',
+                                 chat=SimpleNamespace(completions=SimpleNamespace(create=_create)))
+  cnv = Conversation([Utterance.init(UserName(), Intention.init(actor_next=actor.name),
+                                     IterableStream(iter(["Hello"])))])
+  u = actor.react(None, cnv)
+  assert list(u.contents.gen()) == ["Hi", "\n"]
+  assert u.contents.stats.ttft() >= 0.1
+
+
+def test_stats_dump():
+  stats = Stats()
+  s = IterableStream(iter(["x", "y"]))
+  list(s.gen())
+  stats.add("dummy:a", s.stats)
+  stats.add("dummy:b", StreamStats())
+  dump = json_loads(json_dumps(stats.dump()))
+  assert list(dump.keys()) == ["dummy:a"]
+  assert dump["dummy:a"]["tokens"] == 2 and dump["dummy:a"]["streams"] == 1
+  table = stats.table().splitlines()
+  assert table[0].startswith("ACTOR") and table[1].startswith("dummy:a")
+
+
+def test_stats_command(tmp_path, capsys):
+  from sm_aicli.main import main
+  script = tmp_path / 'script.aicli'
+  script.write_text("/model dummy:dummy\nHello\n/ask\n/stats json\n")
+  main(['--rc', 'none', str(script)])
+  out = capsys.readouterr().out
+  dump = json_loads(out[out.index('{\n'):])
+  assert dump["dummy:dummy"]["streams"] == 1
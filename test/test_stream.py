@@ -13,3 +13,145 @@ def test_stream_deepcopy():
   lines=[s for s in s.gen()]
   assert lines==["FOO","BAR"]
   s2 = deepcopy(deepcopy(s))
+
+def test_stream_agen():
+  """ The default `agen` yields the tokens of `gen` """
+  from asyncio import run
+  async def _collect(s):
+    return [t async for t in s.agen()]
+  assert run(_collect(IterableStream(iter(["FOO", "BAR"])))) == ["FOO", "BAR"]
+  assert run(_collect(TextStream(iter(["FOO"]), ensure_eol=True))) == ["FOO", "\n"]
+
+def test_stream_agen_batch():
+  """ `agen` delivers the tokens produced while the loop was busy as one batch and re-raises the
+  errors of `gen` after the last token """
+  from asyncio import run
+  from threading import Event
+  produced = Event()
+  class _Failing(Stream):
+    def gen(self):
+      yield "A"
+      yield "B"
+      produced.set()
+      raise ValueError("remote")
+  async def _collect(s):
+    acc = []
+    with pytest.raises(ValueError):
+      async for t in s.agen():
+        produced.wait()
+        acc.append(t)
+    return acc
+  assert run(_collect(_Failing())) == ["A", "B"]
+
+def test_recording():
+  """ Runs of tokens of the same type are joined """
+  r = Recording(["a", "b", b"c", b"d", LocalReference("image", "x.png"), "e"])
+  assert r.items() == ["ab", b"cd", LocalReference("image", "x.png"), "e"]
+  r.append("f")
+  r.append(b"g")
+  r.append(b"h")
+  assert list(r) == ["ab", b"cd", LocalReference("image", "x.png"), "ef", b"gh"]
+  assert r.items() is r.items()
+  # Binary tokens appended after reading are not copied into the joined run until the next reading
+  r.append(b"i")
+  assert r.runs[-2:] == [b"gh", bytearray(b"i")]
+  assert r.items()[-1] == b"ghi" and len(r.runs) == 5
+
+def test_stream_recording():
+  """ Replayed streams yield the joined recording """
+  s = IterableStream(iter(["FOO", "BAR"]))
+  assert list(s.gen()) == ["FOO", "BAR"]
+  assert list(s.gen()) == ["FOOBAR"]
+  assert cont2str(s) == "FOOBAR"
+  assert cont2str(IterableStream(iter([b"A", b"B"]))) == b"AB"
+  assert cont2str(IterableStream(iter([]))) == ''
+  with pytest.raises(ValueError):
+    cont2str(IterableStream(iter(["A", LocalReference("image", "x.png")])))
+
+def test_cont2str_linear():
+  """ Long streams of small tokens are joined in linear time """
+  from time import perf_counter
+  t0 = perf_counter()
+  assert len(cont2str(IterableStream(iter(["x"]*1000000)))) == 1000000
+  assert perf_counter() - t0 < 5
+
+def test_buffer():
+  from sm_aicli.actor.user import Buffer, bufferadd, buffer2str, buffer2bytes, ref_read, ref_write
+  b = Buffer()
+  for _ in range(100000):
+    bufferadd(b, "ab")
+  assert b.size == 200000
+  assert buffer2str(b) == "ab"*100000
+  assert buffer2str(b) is buffer2str(b)
+  bufferadd(b, "c")
+  assert buffer2str(b).endswith("abc") and b.size == 200001
+  assert Buffer(["ü", b"\x00"]).size == 3
+  buffers = {'x': Buffer(["foo"])}
+  ref_write(('buffer','x'), ref_read(('buffer','x'), buffers), buffers, append=True)
+  assert buffer2str(buffers['x']) == "foofoo"
+  ref_write(('buffer','y'), ref_read(('buffer','x'), buffers), buffers)
+  bufferadd(buffers['y'], "bar")
+  assert buffer2str(buffers['x']) == "foofoo"
+  assert buffer2bytes(buffers['y']) == b"foofoobar"
+
+def test_recording_spill():
+  seg = Segment()
+  r = Recording(["a", "b", LocalReference("image", "x.png"), b"\x00", b"\x01"])
+  items = r.items()
+  assert r.nbytes() == 4
+  assert r.spill(seg) == 4
+  assert r.nbytes() == 0 and seg.size == 4
+  assert r.items() == items
+  r.append("c")
+  assert r.items()[-1] == "c"
+  r2 = Recording(["ü"*10])
+  r2.spill(seg)
+  assert r2.items() == ["ü"*10] and r.items() == items + ["c"]
+
+def test_stream_save(tmp_path):
+  path = str(tmp_path / 'out.bin')
+  s = IterableStream(iter([b"\x00"*10, b"\x01"*10]), binary=True)
+  ref = s.save(path, 'image/png', fsync=True)
+  assert ref == LocalReference('image/png', path)
+  assert open(path, 'rb').read() == b"\x00"*10 + b"\x01"*10
+  assert list(s.gen()) == [ref]
+  assert s.recording.nbytes() == 0
+  # Downloads interrupted before they start saving stop right away
+  s = IterableStream(iter([b"\x00"*10, b"\x01"*10]), binary=True)
+  s.interrupt()
+  s.save(path, 'image/png')
+  assert open(path, 'rb').read() == b"\x00"*10
+
+def test_traverse_stream_readahead():
+  """ References are fetched concurrently, while the handler sees the items in order """
+  from concurrent.futures import ThreadPoolExecutor
+  from threading import Barrier
+  refs = [RemoteReference('image', f"http://x/{i}.png") for i in range(3)]
+  barrier = Barrier(len(refs), timeout=5) # Breaks unless all the fetches run at once
+  def _fetch(ref):
+    barrier.wait()
+    return IterableStream(iter([ref.url]))
+  futures = {}
+  def _readahead(token):
+    if isinstance(token, Reference):
+      futures[token] = pool.submit(_fetch, token)
+  acc = []
+  def _handler(s, token):
+    acc.append(token)
+    return futures[token].result() if isinstance(token, Reference) else None
+  with ThreadPoolExecutor(max_workers=len(refs)) as pool:
+    traverse_stream(IterableStream(iter(["A", *refs, "B"])), _handler, readahead=_readahead)
+  assert acc == ["A", refs[0], refs[0].url, refs[1], refs[1].url, refs[2], refs[2].url, "B"]
+
+def test_b64save(tmp_path):
+  from base64 import b64encode
+  data = bytes(range(256)) * 5000
+  path = b64save(b64encode(data).decode(), str(tmp_path), 'png')
+  assert path.startswith(str(tmp_path)) and path.endswith('.png')
+  assert open(path, 'rb').read() == data
+  assert b64save(b64encode(data).decode(), str(tmp_path), 'png') == path
+  assert [p.name for p in tmp_path.iterdir()] == [path.split('/')[-1]]
+  # The partial file is removed if the data turns out to be broken
+  with pytest.raises(ValueError):
+    b64save(b64encode(data).decode()[:-1], str(tmp_path), 'png')
+  assert [p.name for p in tmp_path.iterdir()] == [path.split('/')[-1]]
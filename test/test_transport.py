@@ -0,0 +1,14 @@
+from pytest import importorskip
+
+from sm_aicli.transport import http_client
+
+def test_http_client_pool():
+  """ HTTP clients are shared between the users of the same configuration """
+  importorskip('httpx')
+  c = http_client()
+  assert c is http_client(None, None, None)
+  assert http_client('http://localhost:3128') is http_client('http://localhost:3128')
+  assert http_client('http://localhost:3128') is not c
+  c2 = http_client(pool_size=2, timeout=10)
+  assert c2 is not c
+  assert c2.timeout.read == 10
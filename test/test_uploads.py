@@ -0,0 +1,116 @@
+from os import utime
+from time import time, sleep
+from threading import Lock, Thread, Barrier, BrokenBarrierError
+from types import SimpleNamespace
+
+from sm_aicli.uploads import Upload, UploadIndex, account_key, upload_file_parallel
+
+
+def test_upload_digest(tmp_path):
+  index = UploadIndex(None)
+  f = tmp_path / 'doc.pdf'
+  f.write_bytes(b"v1")
+  d1 = index.digest(str(f))
+  assert index.digest(str(f)) == d1
+  (tmp_path / 'copy.pdf').write_bytes(b"v1")
+  assert index.digest(str(tmp_path / 'copy.pdf')) == d1
+  f.write_bytes(b"v2")
+  utime(f, ns=(0, 12345))
+  assert index.digest(str(f)) != d1
+
+
+def test_upload_index(tmp_path):
+  path = str(tmp_path / 'uploads.json')
+  acc = account_key('key', 'https://api.openai.com/v1')
+  now = time()
+  UploadIndex(path).put(acc, 'd1', Upload('file-1', now, now))
+  # The index is persistent and is per-account
+  index = UploadIndex(path, verify_after=60)
+  u = index.get(acc, 'd1')
+  assert u.file_id == 'file-1' and not index.needs_verification(u)
+  assert index.get(account_key('other'), 'd1') is None
+  # Old uploads need verification, expired uploads are forgotten
+  index.put(acc, 'd2', Upload('file-2', now-3600, now-3600))
+  assert index.needs_verification(index.get(acc, 'd2'))
+  index.put(acc, 'd3', Upload('file-3', now, now, expires=now-1))
+  assert index.get(acc, 'd3') is None
+  index.put(acc, 'd1', None)
+  assert index.get(acc, 'd1') is None
+  assert UploadIndex(path, max_age=1800).get(acc, 'd2') is None
+
+
+def test_upload_file_parallel(tmp_path):
+  class _Uploads:
+    def __init__(self):
+      self.data, self.lock = {}, Lock()
+    def create(self, bytes, filename, mime_type, purpose):
+      self.size, self.filename = bytes, filename
+      return SimpleNamespace(id='upload-1')
+    def complete(self, upload_id, part_ids):
+      return b''.join(self.data[p] for p in part_ids)
+  def _create_part(upload_id, data):
+    with uploads.lock:
+      pid = f"part-{len(uploads.data)}"
+      uploads.data[pid] = data
+    sleep(0.01 * (len(data) % 3)) # Complete out of order
+    return SimpleNamespace(id=pid)
+
+  uploads = _Uploads()
+  uploads.parts = SimpleNamespace(create=_create_part)
+  f = tmp_path / 'doc.pdf'
+  f.write_bytes(bytes(range(256)) * 40 + b'tail')
+  data = upload_file_parallel(uploads, str(f), 'application/pdf', 'assistants', part_size=1000)
+  assert data == f.read_bytes()
+  assert uploads.size == len(data) and uploads.filename == 'doc.pdf'
+  assert len(uploads.data) == 11
+
+
+def test_upload_reference(tmp_path, monkeypatch):
+  """ References seen before keep their uploads after the file is gone, unverifiable uploads are
+  kept """
+  from httpx import Request
+  from openai import APIConnectionError
+  import sm_aicli.actor.openai as oa
+  from sm_aicli import ActorOptions, ModelName, LocalReference
+  uploaded = []
+  def _upload(uploads, path, mime_type, purpose):
+    uploaded.append(path)
+    return SimpleNamespace(status='completed', file=SimpleNamespace(id=f"file-{len(uploaded)}"))
+  monkeypatch.setattr(oa, 'upload_file_parallel', _upload)
+  actor = oa.OpenAITextActor(ModelName('openai', 'gpt-4o'), ActorOptions(apikey='sk-test'),
+                             None, None)
+  actor.upload_index = UploadIndex(None)
+  f = tmp_path / 'doc.pdf'
+  f.write_bytes(b"v1")
+  ref = LocalReference('application/pdf', str(f))
+  assert actor.upload_reference_async(ref).result() == 'file-1'
+  f.unlink()
+  assert actor.upload_reference_async(ref).result() == 'file-1'
+  assert uploaded == [str(f)]
+
+  # Concurrent callers share one upload: the second caller waits for the first one to register its
+  # upload rather than meeting it in `submit`
+  f.write_bytes(b"v2")
+  ref2 = LocalReference('application/pdf', str(f))
+  pool, barrier = actor.upload_pool, Barrier(2, timeout=1)
+  def _submit(*args):
+    try:
+      barrier.wait()
+    except BrokenBarrierError:
+      pass
+    return pool.submit(*args)
+  actor.upload_pool = SimpleNamespace(submit=_submit)
+  futures = []
+  threads = [Thread(target=lambda: futures.append(actor.upload_reference_async(ref2)))
+             for _ in range(2)]
+  for t in threads: t.start()
+  for t in threads: t.join()
+  assert futures[0] is futures[1] and futures[0].result() == 'file-2'
+  assert uploaded == [str(f), str(f)]
+
+  def _retrieve(file_id):
+    raise APIConnectionError(request=Request('GET', 'https://api.openai.com/v1/files'))
+  actor.client = SimpleNamespace(files=SimpleNamespace(retrieve=_retrieve))
+  upload = Upload('file-1', time()-3600, time()-3600)
+  assert actor._verify_upload(upload)
+  assert UploadIndex(None, verify_after=60).needs_verification(upload)